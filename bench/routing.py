@@ -0,0 +1,146 @@
+"""
+Маршрутизация апдейтов: цепочка фильтров против поиска в словаре.
+
+Сравнивает dp.feed_update через прежнюю цепочку (по хэндлеру на каждую
+кнопку: lambda-фильтр по префиксу callback_data и F.text == ... для меню,
+в том порядке, в каком они были в bot.py) и через route_callback /
+route_text. Хэндлеры в обоих случаях пустые, callback_data собираются
+настоящими фабриками из CALLBACK_ROUTES — меряется только выбор хэндлера.
+
+    python bench/routing.py [--count 20000]
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+tmp = tempfile.mkdtemp(prefix="bench-routing-")
+os.environ.update({
+    "TOKEN": "123456:BENCH-TOKEN",
+    "DATABASE_URL": f"sqlite:///{tmp}/bench.db",
+    "ISSUE_JOURNAL": os.path.join(tmp, "issues.journal"),
+})
+
+from aiogram import Dispatcher, F  # noqa: E402
+from aiogram.types import Update  # noqa: E402
+
+import bot  # noqa: E402
+
+# порядок регистрации хэндлеров до перехода на таблицы маршрутов
+OLD_CALLBACK_PREFIXES = [
+    "clear_history", "ins_dept", "menu", "fix_dept", "fix_page", "fix",
+    "approve", "return", "dg_ok", "dg_ret", "hist_dept",
+]
+MENU_TEXTS = [
+    "ОЧИСТИТЬ ИСТОРИЮ", "СДЕЛАТЬ ОБХОД", "ЗАВЕРШИТЬ ОБХОД", "Отмена",
+    "ИСПРАВИТЬ ЗАМЕЧАНИЯ", "ИСТОРИЯ ОБХОДОВ", "НАЗАД",
+]
+
+
+async def noop(*args, **kwargs):
+    pass
+
+
+def old_dispatcher() -> Dispatcher:
+    dp = Dispatcher()
+    dp.message(F.text == "ОЧИСТИТЬ ИСТОРИЮ")(noop)
+    for prefix in OLD_CALLBACK_PREFIXES:
+        dp.callback_query(lambda c, prefix=prefix: c.data and c.data.startswith(prefix + ":"))(noop)
+    dp.message(F.text == "СДЕЛАТЬ ОБХОД")(noop)
+    dp.message(
+        F.text
+        & (~F.text.startswith("/"))
+        & (F.text != "СДЕЛАТЬ ОБХОД")
+        & (F.text != "ИСТОРИЯ ОБХОДОВ")
+        & (F.text != "ОЧИСТИТЬ ИСТОРИЮ")
+        & (F.text != "ЗАВЕРШИТЬ ОБХОД")
+        & (F.text != "НАЗАД")
+        & (F.text != "ИСПРАВИТЬ ЗАМЕЧАНИЯ")
+    )(noop)
+    for text in ("ЗАВЕРШИТЬ ОБХОД", "Отмена", "ИСПРАВИТЬ ЗАМЕЧАНИЯ", "ИСТОРИЯ ОБХОДОВ"):
+        dp.message(F.text == text)(noop)
+    return dp
+
+
+def new_dispatcher() -> Dispatcher:
+    # настоящие route_callback / route_text, но с пустыми хэндлерами
+    for prefix, (factory, _) in list(bot.CALLBACK_ROUTES.items()):
+        bot.CALLBACK_ROUTES[prefix] = (factory, noop)
+    for text in bot.TEXT_ROUTES:
+        bot.TEXT_ROUTES[text] = noop
+    bot.handle_text_comment = noop
+
+    dp = Dispatcher()
+    dp.callback_query()(bot.route_callback)
+    dp.message(F.text & ~F.text.startswith("/"))(bot.route_text)
+    return dp
+
+
+def _user() -> dict:
+    return {"id": 1, "is_bot": False, "first_name": "bench"}
+
+
+def callback(data: str) -> Update:
+    return Update.model_validate(
+        {"update_id": 1, "callback_query": {"id": "1", "from": _user(), "chat_instance": "1", "data": data}},
+        context={"bot": bot.bot},
+    )
+
+
+def message(text: str) -> Update:
+    return Update.model_validate(
+        {
+            "update_id": 1,
+            "message": {
+                "message_id": 1,
+                "date": 0,
+                "chat": {"id": 1, "type": "private"},
+                "from": _user(),
+                "text": text,
+            },
+        },
+        context={"bot": bot.bot},
+    )
+
+
+CASES = [
+    ("callback, последний в цепочке", callback(bot.HistDeptCb(dept_id=3).pack())),
+    ("callback сводки", callback(bot.DigestRetCb(digest_id=3, issue_id=9).pack())),
+    ("callback, первый в цепочке", callback(bot.ClearHistoryCb(period="7").pack())),
+    ("текст замечания", message("трещина в стене")),
+    ("кнопка меню", message("ИСТОРИЯ ОБХОДОВ")),
+]
+
+
+async def per_update(dp: Dispatcher, update: Update, count: int) -> float:
+    for _ in range(count // 20):
+        await dp.feed_update(bot.bot, update)
+    started = time.perf_counter()
+    for _ in range(count):
+        await dp.feed_update(bot.bot, update)
+    return (time.perf_counter() - started) / count * 1e6
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--count", type=int, default=20000, help="апдейтов на замер")
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+
+    old, new = old_dispatcher(), new_dispatcher()
+    print(f"{'апдейт':<32} {'цепочка, мкс':>13} {'словарь, мкс':>13}")
+    for name, update in CASES:
+        before = await per_update(old, update, args.count)
+        after = await per_update(new, update, args.count)
+        print(f"{name:<32} {before:>13.1f} {after:>13.1f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
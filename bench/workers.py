@@ -0,0 +1,135 @@
+"""
+Пропускная способность режима --workers при 1, 2, 4 и 8 процессах.
+
+Главный процесс раскладывает записанные апдейты по процессам-обработчикам
+(route_update) так же, как poll_to_workers; обработчики отвечают в локальную
+заглушку Bot API (TELEGRAM_API_URL). Время — от первого апдейта до последнего
+ответа. Каждый пользователь шлёт «ИСПРАВИТЬ ЗАМЕЧАНИЯ» и выбирает отдел:
+запрос страницы открытых замечаний в БД, альбом и список.
+
+    python bench/workers.py [--users 200] [--workers 1 2 4 8] 2>/dev/null
+"""
+
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from tests.telegram_stub import TelegramStub  # noqa: E402
+from tests.updates import callback_update, message_update  # noqa: E402
+
+
+def configure(stub: TelegramStub):
+    # настройки читаются при импорте bot.py — и в этом процессе, и в обработчиках (spawn)
+    tmp = tempfile.mkdtemp(prefix="bench-workers-")
+    os.environ.update({
+        "TOKEN": "123456:BENCH-TOKEN",
+        "TELEGRAM_API_URL": stub.url,
+        "DATABASE_URL": f"sqlite:///{tmp}/bench.db",
+        "ISSUE_JOURNAL": os.path.join(tmp, "issues.journal"),
+        "STATE_BACKEND": "sqlite",
+        # лимиты Telegram заглушке не нужны
+        "TG_GLOBAL_RATE": "100000",
+        "TG_CHAT_RATE": "100000",
+        "TG_GROUP_RATE": "100000",
+        "OUTBOX_POLL_INTERVAL": "3600",
+        "RETENTION_INTERVAL": "86400",
+    })
+
+
+def seed(bot, issues_per_department: int):
+    bot.migrate_db()
+    bot.department_registry.load()
+    s = bot.get_session()
+    user = bot.User(tg_id=1, name="Аудитор")
+    s.add(user)
+    s.flush()
+    inspections = [
+        bot.Inspection(department_id=dept_id, inspector_id=user.id)
+        for dept_id in bot.department_registry._names
+    ]
+    s.add_all(inspections)
+    s.commit()
+    next_id = s.query(bot.IdSequence).filter_by(name="issues").one().next_id
+    records = []
+    for ins in inspections:
+        for _ in range(issues_per_department):
+            records.append({
+                "id": next_id,
+                "inspection_id": ins.id,
+                "department_id": ins.department_id,
+                "photo_url": f"photo-{next_id}",
+                "comment": f"Замечание {next_id}",
+                "created_at": bot.datetime.utcnow().isoformat(),
+            })
+            next_id += 1
+    s.query(bot.IdSequence).filter_by(name="issues").update({"next_id": next_id})
+    s.commit()
+    s.close()
+    bot.db_insert_issues(records)
+
+
+def workload(users: int, first_user: int, departments: list[int]) -> list[dict]:
+    updates = []
+    for i in range(users):
+        user_id = first_user + i
+        updates.append(message_update(user_id, "ИСПРАВИТЬ ЗАМЕЧАНИЯ"))
+        updates.append(callback_update(user_id, f"fix_dept:{departments[i % len(departments)]}"))
+    return updates
+
+
+def run(bot, stub: TelegramStub, workers: int, users: int, first_user: int) -> float:
+    departments = list(bot.department_registry._names)
+    queues, processes = bot.start_workers(workers)
+    try:
+        # прогрев: каждый обработчик импортировал bot.py и ответил
+        sent = len(stub.calls_of("sendMessage"))
+        warmup = workload(workers * 8, first_user + users, departments)
+        for update in warmup:
+            bot.route_update(update, queues)
+        stub.wait_calls("sendMessage", sent + len(warmup), timeout=120)
+
+        sent = len(stub.calls_of("sendMessage"))
+        updates = workload(users, first_user, departments)
+        started = time.perf_counter()
+        for update in updates:
+            bot.route_update(update, queues)
+        done = stub.wait_calls("sendMessage", sent + len(updates), timeout=300)
+        if len(done) < sent + len(updates):
+            raise RuntimeError(f"ответов {len(done) - sent} из {len(updates)}")
+        return done[-1][1] - started
+    finally:
+        bot.stop_workers(queues, processes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--issues", type=int, default=5, help="открытых замечаний на отдел")
+    args = parser.parse_args()
+
+    stub = TelegramStub().start()
+    configure(stub)
+    import bot
+    logging.disable(logging.INFO)
+    seed(bot, args.issues)
+
+    print(f"{args.users} пользователей, {args.users * 2} апдейтов, CPU: {os.cpu_count()}")
+    print(f"{'процессов':>9} {'время, с':>9} {'апдейтов/с':>11} {'ускорение':>10}")
+    base = None
+    for i, workers in enumerate(args.workers):
+        elapsed = run(bot, stub, workers, args.users, first_user=10_000 * (i + 1))
+        rate = args.users * 2 / elapsed
+        base = base or rate
+        print(f"{workers:>9} {elapsed:>9.2f} {rate:>11.0f} {rate / base:>9.2f}x")
+    stub.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,45 @@
 import os
+import sys
+import glob
+import hashlib
+import heapq
+import json
+import time
+import math
 import asyncio
+from collections import OrderedDict, deque
+import argparse
+from abc import ABC, abstractmethod
+import multiprocessing
 import logging
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime, date, timedelta
+from contextlib import asynccontextmanager, contextmanager
+from functools import partial
 from aiogram import F
 from sqlalchemy import text
 
-from aiogram import Bot, Dispatcher, types
+from aiogram import BaseMiddleware, Bot, Dispatcher, types
 from aiogram.enums import ParseMode
-from aiogram.exceptions import TelegramBadRequest
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
 from aiogram.filters import Command
-from aiogram.types import ReplyKeyboardMarkup, InlineKeyboardMarkup
+from aiogram.filters.callback_data import CallbackData
+from aiogram.types import BufferedInputFile, ReplyKeyboardMarkup, InlineKeyboardMarkup, InputMediaPhoto
 from aiogram.utils.keyboard import InlineKeyboardBuilder, ReplyKeyboardBuilder
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+
+from collage import render_collage
 
 from sqlalchemy import (
     create_engine,
+    func,
+    literal,
+    select,
+    union_all,
     Column,
     Integer,
     String,
@@ -21,6 +47,14 @@ from sqlalchemy import (
     Text,
     DateTime,
     ForeignKey,
+    Index,
+    and_,
+    delete,
+    event,
+    true,
+    tuple_,
+    update,
+    inspect,
 )
 from sqlalchemy.orm import declarative_base
 from sqlalchemy.orm import sessionmaker
@@ -31,7 +65,88 @@ from dotenv import load_dotenv
 load_dotenv()
 
 TOKEN = os.getenv("TOKEN")
+# Свой сервер Bot API (локальный telegram-bot-api или заглушка в бенчмарке);
+# пусто — api.telegram.org
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "")
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///data_simple.db")
+# Сколько потоков обслуживают запросы к БД (см. run_db)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "4"))
+
+# Хранение истории: обходы старше RETENTION_DAYS удаляются фоновой задачей
+# раз в RETENTION_INTERVAL секунд, пачками по DELETE_BATCH_SIZE обходов
+RETENTION_DAYS = int(os.getenv("RETENTION_DAYS", "15"))
+RETENTION_INTERVAL = int(os.getenv("RETENTION_INTERVAL", "3600"))
+DELETE_BATCH_SIZE = int(os.getenv("DELETE_BATCH_SIZE", "200"))
+# Сколько замечаний показывать на одной странице «ИСПРАВИТЬ ЗАМЕЧАНИЯ» (2–10: альбом)
+FIX_PAGE_SIZE = int(os.getenv("FIX_PAGE_SIZE", "5"))
+# Срок исправления: FIX_DEADLINE_DAYS дней с даты обхода. Если замечание
+# не исправлено, напоминание приходит на следующий день в OVERDUE_REMIND_HOUR часов
+FIX_DEADLINE_DAYS = int(os.getenv("FIX_DEADLINE_DAYS", "7"))
+OVERDUE_REMIND_HOUR = int(os.getenv("OVERDUE_REMIND_HOUR", "9"))
+
+# Лимиты Telegram на исходящие сообщения (сообщений в секунду)
+TG_GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE", "30"))
+TG_CHAT_RATE = float(os.getenv("TG_CHAT_RATE", "1"))
+TG_GROUP_RATE = float(os.getenv("TG_GROUP_RATE", str(20 / 60)))
+# Сколько раз повторять запрос после TelegramRetryAfter
+TG_SEND_RETRIES = int(os.getenv("TG_SEND_RETRIES", "3"))
+
+# Outbox: сколько уведомлений доставлять за один проход, как часто проверять
+# очередь без явного пробуждения (сек), сколько попыток и максимальная пауза
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "50"))
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "10"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "10"))
+OUTBOX_MAX_BACKOFF = int(os.getenv("OUTBOX_MAX_BACKOFF", "600"))
+
+# Где хранить состояния диалогов: memory / sqlite / redis (см. make_state_storage).
+# Брошенный диалог забывается через STATE_TTL секунд после последнего шага.
+STATE_BACKEND = os.getenv("STATE_BACKEND", "memory")
+STATE_TTL = int(os.getenv("STATE_TTL", str(24 * 3600)))
+STATE_MAX_USERS = int(os.getenv("STATE_MAX_USERS", "10000"))
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+
+# Режим получения апдейтов: polling / webhook (можно переопределить --mode)
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+# Внешний https-адрес сервера; если не задан, webhook в Telegram не регистрируем
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+# Секрет из заголовка X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+
+# Сколько процессов-обработчиков апдейтов (1 — всё в одном процессе)
+WORKERS = int(os.getenv("WORKERS", "1"))
+# Сколько апдейтов обрабатывается одновременно и сколько апдейтов одного
+# пользователя может ждать своей очереди (лишние отбрасываются)
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "64"))
+USER_QUEUE_DEPTH = int(os.getenv("USER_QUEUE_DEPTH", "10"))
+# Замечания обхода копятся в буфере и пишутся в БД пачкой: когда набралось
+# ISSUE_FLUSH_SIZE штук, через ISSUE_FLUSH_INTERVAL сек или на «ЗАВЕРШИТЬ ОБХОД».
+# До записи они лежат в журнале ISSUE_JOURNAL; номера берутся блоками по ISSUE_ID_BLOCK.
+ISSUE_FLUSH_SIZE = int(os.getenv("ISSUE_FLUSH_SIZE", "10"))
+ISSUE_FLUSH_INTERVAL = float(os.getenv("ISSUE_FLUSH_INTERVAL", "2"))
+ISSUE_ID_BLOCK = int(os.getenv("ISSUE_ID_BLOCK", "20"))
+ISSUE_JOURNAL = os.getenv("ISSUE_JOURNAL", "issues.journal")
+# Сколько ждать следующего фото альбома (media_group_id), прежде чем сохранять его (сек)
+ALBUM_WAIT = float(os.getenv("ALBUM_WAIT", "0.8"))
+# Исправления на проверку копятся REVIEW_DIGEST_WINDOW сек и приходят админу
+# одной сводкой (0 — каждое сразу отдельной карточкой); в сводке до REVIEW_DIGEST_MAX
+REVIEW_DIGEST_WINDOW = int(os.getenv("REVIEW_DIGEST_WINDOW", "0"))
+REVIEW_DIGEST_MAX = int(os.getenv("REVIEW_DIGEST_MAX", "20"))
+# Локальные копии фото замечаний (пусто — не хранить): каталог и предел по размеру
+MEDIA_DIR = os.getenv("MEDIA_DIR", "")
+MEDIA_MAX_MB = int(os.getenv("MEDIA_MAX_MB", "500"))
+# Коллаж «до/после» для админа: сколько процессов рисуют, сколько готовых
+# коллажей помнить и каким шрифтом подписывать (нужен Pillow, без него — два фото)
+COLLAGE_WORKERS = int(os.getenv("COLLAGE_WORKERS", "2"))
+COLLAGE_CACHE_SIZE = int(os.getenv("COLLAGE_CACHE_SIZE", "256"))
+COLLAGE_FONT = os.getenv("COLLAGE_FONT", "DejaVuSans.ttf")
+# Панель прогресса обхода редактируется не чаще раза в PANEL_EDIT_INTERVAL сек
+PANEL_EDIT_INTERVAL = float(os.getenv("PANEL_EDIT_INTERVAL", "2"))
+# «ОЧИСТИТЬ ИСТОРИЮ»: пауза между пачками и как часто обновлять прогресс (сек)
+CLEAR_BATCH_PAUSE = float(os.getenv("CLEAR_BATCH_PAUSE", "0.05"))
+CLEAR_PROGRESS_INTERVAL = float(os.getenv("CLEAR_PROGRESS_INTERVAL", "2"))
 
 # ID чата-конфы магазина (Бализаж), куда слать уведомления
 BALIZAG_CHAT_ID = -1002017069706     # правильный ID группы
@@ -69,6 +184,10 @@ class Inspection(Base):
     status = Column(String, default="open")  # open/completed
     created_at = Column(DateTime, default=datetime.utcnow)
 
+    __table_args__ = (
+        Index("ix_inspections_date", "date"),
+    )
+
 
 class Issue(Base):
     __tablename__ = "issues"
@@ -81,23 +200,540 @@ class Issue(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
     fixed_at = Column(DateTime, nullable=True)
     fixed_photo_url = Column(Text)
+    fixed_photo_unique_id = Column(Text, nullable=True)  # file_unique_id фото исправления
     fixed_by_tg_id = Column(Integer, nullable=True)  # кто отправлял исправление
+    reminded_at = Column(DateTime, nullable=True)  # когда напомнили о просрочке
+
+    __table_args__ = (
+        # открытые замечания отдела по порядку (show_issues_for_fix)
+        Index("ix_issues_department_status_created", "department_id", "status", "created_at"),
+        Index("ix_issues_inspection_id", "inspection_id"),
+        # открытые замечания без напоминания (DeadlineScheduler.load)
+        Index("ix_issues_status_reminded", "status", "reminded_at", "inspection_id"),
+    )
+
+
+class OutboxMessage(Base):
+    """
+    Уведомление, которое нужно доставить в Telegram. Пишется в той же
+    транзакции, что и изменение статуса; доставляет его OutboxWorker.
+    """
+    __tablename__ = "outbox"
+    id = Column(Integer, primary_key=True)
+    kind = Column(String, nullable=False)  # fix_review/fix_returned/inspection_done/issues_overdue
+    chat_id = Column(Integer, nullable=False)
+    payload = Column(Text, nullable=False)  # JSON
+    attempts = Column(Integer, nullable=False, default=0)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    next_attempt_at = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        Index("ix_outbox_next_attempt_at", "next_attempt_at"),
+    )
+
+
+class MediaFile(Base):
+    """Фото, скачанное в MEDIA_DIR: файл на диске называется по sha256 содержимого."""
+    __tablename__ = "media_files"
+    file_unique_id = Column(String, primary_key=True)
+    sha256 = Column(String, nullable=False, index=True)
+    size = Column(Integer, nullable=False)
+    last_used_at = Column(DateTime, default=datetime.utcnow, index=True)
+
+
+class MediaFileId(Base):
+    """file_id, под которым фото известно конкретному боту (file_id у ботов разные)."""
+    __tablename__ = "media_file_ids"
+    file_id = Column(String, primary_key=True)
+    file_unique_id = Column(String, nullable=False, index=True)
+    bot_id = Column(Integer, nullable=False)
+
+
+class ReviewDigest(Base):
+    """Сводка исправлений, отправленная админу (для «Принять все»)."""
+    __tablename__ = "review_digests"
+    id = Column(Integer, primary_key=True)
+    chat_id = Column(Integer, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
+
+
+class ReviewDigestItem(Base):
+    __tablename__ = "review_digest_items"
+    digest_id = Column(Integer, ForeignKey("review_digests.id"), primary_key=True)
+    issue_id = Column(Integer, primary_key=True)
+
+
+class UserState(Base):
+    """Состояние диалога пользователя для SQLiteStateStorage."""
+    __tablename__ = "user_states"
+    tg_id = Column(Integer, primary_key=True)
+    state = Column(Text, nullable=False)  # JSON
+    updated_at = Column(DateTime, default=datetime.utcnow, index=True)
+
+
+class IdSequence(Base):
+    """Следующий свободный id для выдачи блоками (см. db_reserve_ids)."""
+    __tablename__ = "id_sequences"
+    name = Column(String, primary_key=True)
+    next_id = Column(Integer, nullable=False)
+
+
+class SchemaVersion(Base):
+    __tablename__ = "schema_version"
+    version = Column(Integer, primary_key=True)
+    applied_at = Column(DateTime, default=datetime.utcnow)
+
+
+class DepartmentStat(Base):
+    """
+    Счётчики обходов/замечаний по отделу и статусу.
+    Ведутся триггерами БД (см. STATS_TRIGGERS) в той же транзакции,
+    что и любое изменение inspections/issues.
+    """
+    __tablename__ = "department_stats"
+    department_id = Column(Integer, primary_key=True)
+    entity = Column(String, primary_key=True)  # inspection/issue
+    status = Column(String, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
 
 
 # DB
 engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
 SessionLocal = sessionmaker(bind=engine, expire_on_commit=False)
-Base.metadata.create_all(bind=engine)
 
-# Добавляем колонку для старой базы, если её ещё нет
-try:
-    with engine.connect() as conn:
+
+@event.listens_for(engine, "connect")
+def _sqlite_pragmas(dbapi_conn, _record):
+    # WAL: чтения не ждут пишущую транзакцию (например, пачку очистки),
+    # busy_timeout: писатели ждут освобождения блокировки, а не падают
+    cursor = dbapi_conn.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA busy_timeout=5000")
+    cursor.close()
+
+
+def _stats_triggers(table: str, entity: str) -> list[str]:
+    inc = (
+        "INSERT INTO department_stats (department_id, entity, status, count) "
+        "VALUES ({row}.department_id, '" + entity + "', {row}.status, 1) "
+        "ON CONFLICT (department_id, entity, status) DO UPDATE SET count = count + 1;"
+    )
+    dec = (
+        "UPDATE department_stats SET count = count - 1 "
+        "WHERE department_id = {row}.department_id "
+        "AND entity = '" + entity + "' AND status = {row}.status;"
+    )
+    return [
+        f"CREATE TRIGGER IF NOT EXISTS {table}_stats_ins AFTER INSERT ON {table} "
+        f"BEGIN {inc.format(row='NEW')} END",
+        f"CREATE TRIGGER IF NOT EXISTS {table}_stats_del AFTER DELETE ON {table} "
+        f"BEGIN {dec.format(row='OLD')} END",
+        f"CREATE TRIGGER IF NOT EXISTS {table}_stats_upd AFTER UPDATE OF status, department_id ON {table} "
+        f"WHEN OLD.status IS NOT NEW.status OR OLD.department_id IS NOT NEW.department_id "
+        f"BEGIN {dec.format(row='OLD')} {inc.format(row='NEW')} END",
+    ]
+
+
+STATS_TRIGGERS = _stats_triggers("inspections", "inspection") + _stats_triggers("issues", "issue")
+
+
+def db_actual_stats(conn) -> dict[tuple, int]:
+    """Пересчитывает счётчики department_stats по «сырым» таблицам."""
+    rows = conn.execute(
+        union_all(
+            select(
+                Inspection.department_id,
+                literal("inspection"),
+                Inspection.status,
+                func.count(),
+            ).group_by(Inspection.department_id, Inspection.status),
+            select(
+                Issue.department_id,
+                literal("issue"),
+                Issue.status,
+                func.count(),
+            ).group_by(Issue.department_id, Issue.status),
+        )
+    ).all()
+    return {(dept_id, entity, status): cnt for dept_id, entity, status, cnt in rows}
+
+
+def stats_drift(conn, fix: bool = False) -> list[tuple]:
+    """
+    Сверяет department_stats с таблицами inspections/issues.
+    Возвращает список расхождений (department_id, entity, status, stored, actual);
+    при fix=True перестраивает счётчики в той же транзакции.
+    """
+    actual = db_actual_stats(conn)
+    stored = {
+        (r.department_id, r.entity, r.status): r.count
+        for r in conn.execute(select(DepartmentStat.__table__))
+    }
+
+    drift = []
+    for key in sorted(set(actual) | set(stored), key=str):
+        if actual.get(key, 0) != stored.get(key, 0):
+            drift.append((*key, stored.get(key, 0), actual.get(key, 0)))
+
+    if fix and drift:
+        conn.execute(DepartmentStat.__table__.delete())
+        conn.execute(
+            DepartmentStat.__table__.insert(),
+            [
+                {"department_id": d, "entity": e, "status": st, "count": c}
+                for (d, e, st), c in actual.items()
+            ],
+        )
+
+    return drift
+
+
+def db_verify_stats(fix: bool = False) -> list[tuple]:
+    with engine.begin() as conn:
+        return stats_drift(conn, fix=fix)
+
+
+# ---------- МИГРАЦИИ ----------
+# Каждая миграция выполняется один раз в своей транзакции, номер
+# применённой версии записывается в schema_version. Новые изменения
+# схемы — только новой функцией в конце MIGRATIONS.
+
+def _migration_fixed_by_tg_id(conn):
+    # колонка для старой базы, созданной до появления fixed_by_tg_id
+    columns = {c["name"] for c in inspect(conn).get_columns("issues")}
+    if "fixed_by_tg_id" not in columns:
         conn.execute(text("ALTER TABLE issues ADD COLUMN fixed_by_tg_id INTEGER"))
-except Exception:
-    pass
 
-bot = Bot(token=TOKEN)
+
+def _migration_stats_triggers(conn):
+    for ddl in STATS_TRIGGERS:
+        conn.execute(text(ddl))
+    stats_drift(conn, fix=True)
+
+
+def _migration_indexes(conn):
+    # список зафиксирован: на новой базе эти индексы уже создал create_all
+    # (они же объявлены в моделях), новые индексы добавляются своими миграциями
+    for ddl in (
+        "CREATE INDEX IF NOT EXISTS ix_inspections_date ON inspections (date)",
+        "CREATE INDEX IF NOT EXISTS ix_issues_department_status_created "
+        "ON issues (department_id, status, created_at)",
+        "CREATE INDEX IF NOT EXISTS ix_issues_inspection_id ON issues (inspection_id)",
+    ):
+        conn.execute(text(ddl))
+
+
+def _migration_issue_id_sequence(conn):
+    # номера замечаний теперь выдаёт IssueBuffer блоками из id_sequences
+    last_id = conn.execute(select(func.max(Issue.id))).scalar() or 0
+    conn.execute(IdSequence.__table__.insert().values(name="issues", next_id=last_id + 1))
+
+def _migration_fixed_photo_unique_id(conn):
+    columns = {c["name"] for c in inspect(conn).get_columns("issues")}
+    if "fixed_photo_unique_id" not in columns:
+        conn.execute(text("ALTER TABLE issues ADD COLUMN fixed_photo_unique_id TEXT"))
+
+
+def _migration_reminded_at(conn):
+    columns = {c["name"] for c in inspect(conn).get_columns("issues")}
+    if "reminded_at" not in columns:
+        conn.execute(text("ALTER TABLE issues ADD COLUMN reminded_at DATETIME"))
+    conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_issues_status_reminded "
+        "ON issues (status, reminded_at, inspection_id)"
+    ))
+
+
+MIGRATIONS = [
+    (1, _migration_fixed_by_tg_id),
+    (2, _migration_stats_triggers),
+    (3, _migration_indexes),
+    (4, _migration_issue_id_sequence),
+    (5, _migration_fixed_photo_unique_id),
+    (6, _migration_reminded_at),
+]
+
+
+def migrate_db():
+    """
+    Создаёт недостающие таблицы и применяет миграции новее записанной версии.
+    """
+    Base.metadata.create_all(bind=engine)
+
+    with engine.connect() as conn:
+        current = conn.execute(select(func.max(SchemaVersion.version))).scalar() or 0
+
+    for version, migration in MIGRATIONS:
+        if version <= current:
+            continue
+        logger.info("Применяю миграцию схемы БД #%s (%s)", version, migration.__name__)
+        with engine.begin() as conn:
+            migration(conn)
+            conn.execute(SchemaVersion.__table__.insert().values(version=version))
+
+# ---------- ИСХОДЯЩИЕ ЗАПРОСЫ К TELEGRAM ----------
+
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше capacity про запас."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def reserve(self, amount: float = 1) -> float:
+        """
+        Забирает amount токенов (можно уйти в долг) и возвращает,
+        сколько секунд нужно подождать, пока они станут «настоящими».
+        Долг гарантирует очерёдность: кто раньше занял, тот раньше отправит.
+        """
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= amount
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def is_idle(self) -> bool:
+        elapsed = time.monotonic() - self.updated
+        return self.tokens + elapsed * self.rate >= self.capacity
+
+
+class _ChatChannel:
+    def __init__(self, bucket: TokenBucket):
+        self.bucket = bucket
+        self.lock = asyncio.Lock()
+        self.pending = 0
+
+
+class OutboundScheduler(BaseRequestMiddleware):
+    """
+    Планировщик исходящих сообщений: middleware сессии бота, поэтому через
+    него проходит любой send*/edit*/copy*/forward* из bot.py.
+
+    - общий лимит TG_GLOBAL_RATE сообщений/с на бота;
+    - лимит на чат: TG_CHAT_RATE для личек, TG_GROUP_RATE для групп;
+    - внутри одного чата запросы уходят строго по очереди, разные чаты —
+      параллельно;
+    - на TelegramRetryAfter ждём retry_after и повторяем (до TG_SEND_RETRIES раз).
+    """
+
+    LIMITED_PREFIXES = ("Send", "Edit", "Copy", "Forward")
+    PRUNE_THRESHOLD = 1000
+
+    def __init__(self, global_rate: float, chat_rate: float, group_rate: float, retries: int):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.retries = retries
+        self._chats: dict[int | str, _ChatChannel] = {}
+        self.sent = 0
+        self.retried = 0
+        self.waiting = 0
+
+    def _channel(self, chat_id) -> _ChatChannel:
+        channel = self._chats.get(chat_id)
+        if channel is None:
+            if len(self._chats) > self.PRUNE_THRESHOLD:
+                self._prune()
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            rate = self.group_rate if is_group else self.chat_rate
+            channel = self._chats[chat_id] = _ChatChannel(TokenBucket(rate, max(1.0, rate * 3)))
+        return channel
+
+    def _prune(self):
+        # забываем чаты, где никто не ждёт и ведро уже снова полное
+        for chat_id, channel in list(self._chats.items()):
+            if not channel.pending and channel.bucket.is_idle():
+                del self._chats[chat_id]
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None or not type(method).__name__.startswith(self.LIMITED_PREFIXES):
+            return await make_request(bot, method)
+
+        # альбом — это несколько сообщений
+        cost = len(getattr(method, "media", None) or ()) or 1
+
+        channel = self._channel(chat_id)
+        channel.pending += 1
+        self.waiting += 1
+        try:
+            async with channel.lock:
+                attempt = 0
+                while True:
+                    delay = channel.bucket.reserve(cost)
+                    if delay:
+                        await asyncio.sleep(delay)
+                    delay = self.global_bucket.reserve(cost)
+                    if delay:
+                        await asyncio.sleep(delay)
+
+                    try:
+                        response = await make_request(bot, method)
+                    except TelegramRetryAfter as e:
+                        if attempt >= self.retries:
+                            raise
+                        attempt += 1
+                        self.retried += 1
+                        logger.warning(
+                            "Telegram просит подождать %s с (чат %s, %s)",
+                            e.retry_after,
+                            chat_id,
+                            type(method).__name__,
+                        )
+                        await asyncio.sleep(e.retry_after)
+                        continue
+
+                    self.sent += 1
+                    return response
+        finally:
+            channel.pending -= 1
+            self.waiting -= 1
+
+    def status_lines(self) -> list[str]:
+        return [
+            f"Исходящие сообщения: отправлено {self.sent}, "
+            f"в очереди {self.waiting}, повторов после RetryAfter {self.retried}",
+        ]
+
+
+outbound_scheduler = OutboundScheduler(
+    TG_GLOBAL_RATE, TG_CHAT_RATE, TG_GROUP_RATE, TG_SEND_RETRIES
+)
+
+
+# ---------- ВХОДЯЩИЕ АПДЕЙТЫ ----------
+
+class _UserLane:
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.pending = 0
+        # о пропущенных апдейтах уже сказали (раз на переполнение очереди)
+        self.warned = False
+
+
+class UpdateSerializer(BaseMiddleware):
+    """
+    Порядок обработки апдейтов: outer-middleware диспетчера.
+
+    - апдейты одного пользователя обрабатываются строго по очереди (фото и
+      следующий за ним комментарий не обгоняют друг друга), разных — параллельно;
+    - одновременно обрабатывается не больше concurrency апдейтов;
+    - если у пользователя в очереди уже max_depth апдейтов, новый отбрасывается,
+      а пользователю говорим, что его надо повторить;
+    - время ожидания в очереди копится для /status.
+    """
+
+    WAIT_SAMPLES = 1000
+
+    def __init__(self, concurrency: int, max_depth: int):
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.concurrency = concurrency
+        self.max_depth = max_depth
+        self._lanes: dict[int, _UserLane] = {}
+        self.active = 0
+        self.waiting = 0
+        self.handled = 0
+        self.dropped = 0
+        self.max_wait = 0.0
+        self._waits: deque[float] = deque(maxlen=self.WAIT_SAMPLES)
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if user is None:
+            self.waiting += 1
+            return await self._run(handler, event, data, time.monotonic())
+
+        lane = self._lanes.get(user.id)
+        if lane is not None and lane.pending >= self.max_depth:
+            self.dropped += 1
+            logger.warning("Очередь апдейтов пользователя %s переполнена, апдейт пропущен", user.id)
+            await self._notify_dropped(event, lane)
+            return None
+
+        queued_at = time.monotonic()
+        self.waiting += 1
+        async with self.lane(user.id):
+            return await self._run(handler, event, data, queued_at)
+
+    DROPPED_TEXT = "Слишком много сообщений подряд — это не сохранено. Подожди немного и отправь ещё раз."
+
+    async def _notify_dropped(self, update: types.Update, lane: _UserLane):
+        """Без ответа фото или комментарий пропали бы молча."""
+        try:
+            if update.callback_query is not None:
+                # кнопку нужно «отпустить» в любом случае
+                await bot.answer_callback_query(update.callback_query.id, self.DROPPED_TEXT, show_alert=True)
+            elif update.message is not None and not lane.warned:
+                lane.warned = True
+                await bot.send_message(update.message.chat.id, self.DROPPED_TEXT)
+        except Exception as e:
+            logger.warning("Не удалось сообщить о пропущенном апдейте: %s", e)
+
+    @asynccontextmanager
+    async def lane(self, user_id: int):
+        """
+        Очередь пользователя. Через неё идут и его апдейты, и фоновая работа
+        от его имени (сохранение альбома), чтобы они не обгоняли друг друга.
+        """
+        lane = self._lanes.get(user_id)
+        if lane is None:
+            lane = self._lanes[user_id] = _UserLane()
+        lane.pending += 1
+        try:
+            async with lane.lock:
+                yield
+        finally:
+            lane.pending -= 1
+            if not lane.pending:
+                del self._lanes[user_id]
+
+    async def _run(self, handler, event, data, queued_at: float):
+        async with self.semaphore:
+            self.waiting -= 1
+            wait = time.monotonic() - queued_at
+            self._waits.append(wait)
+            self.max_wait = max(self.max_wait, wait)
+            self.active += 1
+            try:
+                return await handler(event, data)
+            finally:
+                self.active -= 1
+                self.handled += 1
+
+    def status_lines(self) -> list[str]:
+        waits = sorted(self._waits)
+        if waits:
+            avg = sum(waits) / len(waits)
+            p95 = waits[min(len(waits) - 1, int(len(waits) * 0.95))]
+            wait_line = (
+                f"Ожидание в очереди: среднее {avg:.3f} с, p95 {p95:.3f} с, "
+                f"максимум {self.max_wait:.3f} с"
+            )
+        else:
+            wait_line = "Ожидание в очереди: данных пока нет"
+        return [
+            f"Входящие апдейты: обработано {self.handled}, "
+            f"в работе {self.active}/{self.concurrency}, ждут {self.waiting}, "
+            f"отброшено {self.dropped}",
+            wait_line,
+        ]
+
+
+update_serializer = UpdateSerializer(UPDATE_CONCURRENCY, USER_QUEUE_DEPTH)
+
+bot = Bot(
+    token=TOKEN,
+    session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None,
+)
+bot.session.middleware(outbound_scheduler)
 dp = Dispatcher()
+dp.update.outer_middleware(update_serializer)
+
+
+# Точка отсчёта для курсора страниц замечаний (см. encode_page_cursor)
+CURSOR_EPOCH = datetime(2000, 1, 1)
 
 # Отделы
 DEPARTMENTS = [
@@ -119,297 +755,2478 @@ DEPARTMENTS = [
     "Закассовая зона",
     "Выдача",
 ]
-# Память процесса: режимы пользователя
-# mode: None / 'inspection' / 'fix'
-USER_STATE: dict[int, dict] = {}
 
 
 def get_session():
     return SessionLocal()
 
 
-def is_admin(tg_id: int) -> bool:
-    return tg_id in ADMIN_IDS
+# Все обращения к БД идут через отдельный пул потоков, чтобы синхронный
+# SQLAlchemy не блокировал event loop и апдейты других пользователей.
+db_executor = ThreadPoolExecutor(max_workers=DB_POOL_SIZE, thread_name_prefix="db")
+
 
-def purge_old_data(days: int = 15):
+async def run_db(func, *args, **kwargs):
     """
-    Удаляет обходы и связанные с ними замечания, которым больше `days` дней.
+    Выполняет синхронную функцию работы с БД в пуле db_executor
+    и возвращает её результат.
     """
-    cutoff_date = date.today() - timedelta(days=days)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_executor, partial(func, *args, **kwargs))
 
-    s = get_session()
 
-    # Находим обходы старше cutoff_date
-    old_inspections = (
-        s.query(Inspection)
-        .filter(Inspection.date < cutoff_date)
-        .all()
+def enqueue_outbox(s, kind: str, chat_id: int, payload: dict, deliver_at: datetime | None = None):
+    """
+    Добавляет уведомление в outbox в рамках транзакции сессии s.
+    deliver_at — не раньше какого момента доставлять (по умолчанию сразу).
+    """
+    s.add(
+        OutboxMessage(
+            kind=kind,
+            chat_id=chat_id,
+            payload=json.dumps(payload, ensure_ascii=False),
+            next_attempt_at=deliver_at or datetime.utcnow(),
+        )
     )
 
-    if not old_inspections:
-        s.close()
-        return
 
-    ins_ids = [ins.id for ins in old_inspections]
+def review_digest_due(now: datetime) -> datetime | None:
+    """
+    Когда доставить исправление на проверку: конец текущего окна
+    REVIEW_DIGEST_WINDOW. Окна общие (кратны эпохе), поэтому всё, что
+    пришло в одно окно, outbox заберёт разом и отправит одной сводкой.
+    """
+    if REVIEW_DIGEST_WINDOW <= 0:
+        return None
+    epoch = datetime(1970, 1, 1)
+    elapsed = (now - epoch).total_seconds()
+    return epoch + timedelta(seconds=math.ceil(elapsed / REVIEW_DIGEST_WINDOW) * REVIEW_DIGEST_WINDOW)
+
 
-    # Сначала удаляем связанные замечания
-    s.query(Issue).filter(Issue.inspection_id.in_(ins_ids)).delete(
-        synchronize_session=False
+def db_claim_outbox(limit: int, lease_seconds: int) -> list:
+    """
+    Забирает до limit готовых к отправке уведомлений: одним UPDATE ... RETURNING
+    откладывает их next_attempt_at на lease_seconds, чтобы их не взял
+    параллельный обработчик. Возвращает строки (id, kind, chat_id, payload, attempts).
+    """
+    now = datetime.utcnow()
+    ready_ids = (
+        select(OutboxMessage.id)
+        .where(OutboxMessage.next_attempt_at <= now)
+        .order_by(OutboxMessage.id)
+        .limit(limit)
+        .scalar_subquery()
     )
+    with engine.begin() as conn:
+        rows = conn.execute(
+            update(OutboxMessage)
+            .where(OutboxMessage.id.in_(ready_ids))
+            .values(next_attempt_at=now + timedelta(seconds=lease_seconds))
+            .returning(
+                OutboxMessage.id,
+                OutboxMessage.kind,
+                OutboxMessage.chat_id,
+                OutboxMessage.payload,
+                OutboxMessage.attempts,
+            )
+        ).all()
+    return sorted(rows, key=lambda r: r.id)
+
+
+def db_finish_outbox(delivered: list[int], failed: list[tuple[int, int]]):
+    """Удаляет доставленные уведомления, неудачным назначает следующую попытку."""
+    with engine.begin() as conn:
+        if delivered:
+            conn.execute(delete(OutboxMessage).where(OutboxMessage.id.in_(delivered)))
+        for outbox_id, attempts in failed:
+            conn.execute(
+                update(OutboxMessage)
+                .where(OutboxMessage.id == outbox_id)
+                .values(
+                    attempts=attempts,
+                    next_attempt_at=datetime.utcnow()
+                    + timedelta(seconds=min(OUTBOX_MAX_BACKOFF, 5 * 2 ** attempts)),
+                )
+            )
 
-    # Потом сами обходы
-    s.query(Inspection).filter(Inspection.id.in_(ins_ids)).delete(
-        synchronize_session=False
-    )
 
-    s.commit()
+def db_outbox_backlog() -> int:
+    s = get_session()
+    count = s.execute(select(func.count(OutboxMessage.id))).scalar()
     s.close()
+    return count
 
 
-# ---------- КЛАВИАТУРЫ ----------
+# ---------- СОСТОЯНИЕ ПОЛЬЗОВАТЕЛЕЙ ----------
+# Режим пользователя: {"mode": None / 'inspection' / 'fix', ...}.
+# Хэндлеры меняют полученный dict и сохраняют его обратно через set().
 
-def main_menu_kb(is_admin_user: bool) -> ReplyKeyboardMarkup:
+class StateStorage(ABC):
     """
-    Главное меню:
-    - обычный пользователь: только 'ИСПРАВИТЬ ЗАМЕЧАНИЯ'
-    - админ:
-        [СДЕЛАТЬ ОБХОД]
-        [ИСТОРИЯ ОБХОДОВ] [ОЧИСТИТЬ ИСТОРИЮ]
-        [ИСПРАВИТЬ ЗАМЕЧАНИЯ]
+    Хранилище состояний диалога по tg_id. Значения — JSON-совместимые dict.
+    evictions — сколько состояний вытеснено (None — бэкенд их не считает).
     """
-    builder = ReplyKeyboardBuilder()
 
-    if is_admin_user:
-        # верхняя строка – одна большая
-        builder.button(text="СДЕЛАТЬ ОБХОД")
+    name = "?"
 
-        # средняя строка – две кнопки
-        builder.button(text="ИСТОРИЯ ОБХОДОВ")
-        builder.button(text="ОЧИСТИТЬ ИСТОРИЮ")
+    def __init__(self, ttl: int):
+        self.ttl = ttl
+        self.evictions: int | None = 0
 
-        # нижняя строка – одна кнопка
-        builder.button(text="ИСПРАВИТЬ ЗАМЕЧАНИЯ")
+    @abstractmethod
+    async def get(self, user_id: int) -> dict | None:
+        ...
 
-        # раскладка строк: 1 / 2 / 1
-        builder.adjust(1, 2, 1)
-    else:
-        # для обычного пользователя только одна кнопка
-        builder.button(text="ИСПРАВИТЬ ЗАМЕЧАНИЯ")
-        builder.adjust(1)
+    @abstractmethod
+    async def set(self, user_id: int, state: dict):
+        ...
 
-    return builder.as_markup(resize_keyboard=True)
+    @abstractmethod
+    async def pop(self, user_id: int):
+        ...
 
-def inspection_menu_kb() -> ReplyKeyboardMarkup:
-    builder = ReplyKeyboardBuilder()
-    builder.button(text="ЗАВЕРШИТЬ ОБХОД")
-    builder.button(text="НАЗАД")
-    builder.adjust(1)
-    return builder.as_markup(resize_keyboard=True)
+    @abstractmethod
+    async def size(self) -> int:
+        ...
 
+    async def sweep(self):
+        """Удаляет состояния, к которым не возвращались дольше ttl."""
 
-def clear_history_kb() -> InlineKeyboardMarkup:
-    builder = InlineKeyboardBuilder()
-    builder.button(text="За 7 дней", callback_data="clear_history:7")
-    builder.button(text="За 30 дней", callback_data="clear_history:30")
-    builder.button(text="За всё время", callback_data="clear_history:all")
-    builder.adjust(2)
-    return builder.as_markup()
+    async def status_lines(self) -> list[str]:
+        evicted = "неизвестно" if self.evictions is None else self.evictions
+        return [f"Состояния пользователей ({self.name}): {await self.size()}, вытеснено {evicted}"]
 
 
-def departments_kb(prefix: str) -> InlineKeyboardMarkup:
-    builder = InlineKeyboardBuilder()
-    for i, d in enumerate(DEPARTMENTS, start=1):
-        builder.button(text=d, callback_data=f"{prefix}{i}")
-    builder.adjust(3)
-    return builder.as_markup()
+class MemoryStateStorage(StateStorage):
+    """В памяти процесса: TTL с момента последнего set() и LRU-лимит max_size."""
 
+    name = "memory"
 
-def fix_issue_kb(issue_id: int) -> InlineKeyboardMarkup:
-    builder = InlineKeyboardBuilder()
-    builder.button(text="✅ Исправлено", callback_data=f"fix:{issue_id}")
-    builder.adjust(1)
-    return builder.as_markup()
+    def __init__(self, ttl: int, max_size: int):
+        super().__init__(ttl)
+        self.max_size = max_size
+        self._data: OrderedDict[int, tuple[float, dict]] = OrderedDict()
 
+    async def get(self, user_id: int) -> dict | None:
+        item = self._data.get(user_id)
+        if item is None:
+            return None
+        expires_at, state = item
+        if expires_at < time.monotonic():
+            del self._data[user_id]
+            self.evictions += 1
+            return None
+        self._data.move_to_end(user_id)
+        return state
 
-def admin_review_kb(issue_id: int) -> InlineKeyboardMarkup:
-    builder = InlineKeyboardBuilder()
-    builder.button(text="✅ ОК", callback_data=f"approve:{issue_id}")
-    builder.button(text="↩️ Вернуть в работу", callback_data=f"return:{issue_id}")
-    builder.adjust(2)
-    return builder.as_markup()
+    async def set(self, user_id: int, state: dict):
+        self._data[user_id] = (time.monotonic() + self.ttl, state)
+        self._data.move_to_end(user_id)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+            self.evictions += 1
 
+    async def pop(self, user_id: int):
+        self._data.pop(user_id, None)
 
-# ---------- ХЭНДЛЕРЫ ----------
+    async def size(self) -> int:
+        return len(self._data)
 
-@dp.message(Command("start"))
-async def cmd_start(message: types.Message):
-    logger.info("START from %s", message.from_user.id)
-    USER_STATE.pop(message.from_user.id, None)
+    async def sweep(self):
+        now = time.monotonic()
+        for user_id, (expires_at, _) in list(self._data.items()):
+            if expires_at < now:
+                del self._data[user_id]
+                self.evictions += 1
 
-    # авто-очистка старых данных (всё, что старше 15 дней)
-    purge_old_data(days=15)
 
-    s = get_session()
+class SQLiteStateStorage(StateStorage):
+    """В таблице user_states основной БД: переживает перезапуск и общая для процессов."""
 
-    # создаём отделы при первом запуске и добавляем недостающие (для старой БД)
-    existing = {d.name for d in s.query(Department).all()}
-    for name in DEPARTMENTS:
-        if name not in existing:
-            s.add(Department(name=name))
-    s.commit()
+    name = "sqlite"
 
-    # регистрируем пользователя
-    user = s.query(User).filter_by(tg_id=message.from_user.id).first()
-    if not user:
-        s.add(User(tg_id=message.from_user.id, name=message.from_user.full_name))
+    def _expired_before(self) -> datetime:
+        return datetime.utcnow() - timedelta(seconds=self.ttl)
+
+    def _get(self, user_id: int):
+        s = get_session()
+        row = s.get(UserState, user_id)
+        state = None
+        if row is not None:
+            if row.updated_at < self._expired_before():
+                s.delete(row)
+                s.commit()
+                self.evictions += 1
+            else:
+                state = json.loads(row.state)
+        s.close()
+        return state
+
+    def _set(self, user_id: int, state: dict):
+        s = get_session()
+        s.merge(UserState(tg_id=user_id, state=json.dumps(state), updated_at=datetime.utcnow()))
         s.commit()
+        s.close()
 
-    s.close()
+    def _pop(self, user_id: int):
+        with engine.begin() as conn:
+            conn.execute(delete(UserState).where(UserState.tg_id == user_id))
 
-    is_admin_user = is_admin(message.from_user.id)
+    def _size(self) -> int:
+        s = get_session()
+        count = s.execute(select(func.count(UserState.tg_id))).scalar()
+        s.close()
+        return count
 
-    await message.answer(
-        "Выбери нужное действие",
-        reply_markup=main_menu_kb(is_admin_user),
-    )
+    def _sweep(self) -> int:
+        with engine.begin() as conn:
+            return conn.execute(
+                delete(UserState).where(UserState.updated_at < self._expired_before())
+            ).rowcount
 
+    async def get(self, user_id: int) -> dict | None:
+        return await run_db(self._get, user_id)
 
+    async def set(self, user_id: int, state: dict):
+        await run_db(self._set, user_id, state)
 
-# ===== ОЧИСТКА ИСТОРИИ =====
+    async def pop(self, user_id: int):
+        await run_db(self._pop, user_id)
 
-@dp.message(F.text == "ОЧИСТИТЬ ИСТОРИЮ")
-async def ask_clear_history(message: types.Message):
-    # только для админов
-    if not is_admin(message.from_user.id):
-        await message.answer("У тебя нет прав для очистки истории.")
-        return
+    async def size(self) -> int:
+        return await run_db(self._size)
 
-    await message.answer(
-        "Выбери период, за который нужно удалить историю обходов и связанных замечаний:",
-        reply_markup=clear_history_kb(),
-    )
+    async def sweep(self):
+        self.evictions += await run_db(self._sweep)
 
 
-@dp.callback_query(lambda c: c.data and c.data.startswith("clear_history:"))
-async def clear_history_callback(callback: types.CallbackQuery):
-    if not is_admin(callback.from_user.id):
-        await callback.answer("У тебя нет прав для этой операции.", show_alert=True)
-        return
+class RedisStateStorage(StateStorage):
+    """
+    В Redis (или любом сервере с протоколом Redis): ключ на пользователя
+    с EX=ttl, истечение делает сам сервер. Нужен пакет redis.
+    """
 
-    _, period = callback.data.split(":")  # "7" / "30" / "all"
+    name = "redis"
+    PREFIX = "balibot:state:"
 
-    s = get_session()
+    def __init__(self, ttl: int, url: str):
+        super().__init__(ttl)
+        import redis.asyncio as redis
 
-    if period == "all":
-        inspections_q = s.query(Inspection)
-        period_text = "за всё время"
-    else:
-        days = int(period)
-        cutoff_date = date.today() - timedelta(days=days)
-        inspections_q = s.query(Inspection).filter(
-            Inspection.date >= cutoff_date,
-            Inspection.date <= date.today(),
-        )
-        period_text = f"за последние {days} дней"
+        self._redis = redis.from_url(url, decode_responses=True)
+        # ключи истекают на сервере, общем для всех процессов бота, —
+        # честного счётчика вытеснений у бота нет
+        self.evictions = None
 
-    inspections = inspections_q.all()
+    async def get(self, user_id: int) -> dict | None:
+        raw = await self._redis.get(f"{self.PREFIX}{user_id}")
+        return json.loads(raw) if raw else None
 
-    if not inspections:
-        s.close()
-        await callback.answer("Под этот период обходов не найдено.", show_alert=True)
-        try:
-            await callback.message.edit_reply_markup(reply_markup=None)
-        except Exception:
-            pass
-        return
+    async def set(self, user_id: int, state: dict):
+        await self._redis.set(f"{self.PREFIX}{user_id}", json.dumps(state), ex=self.ttl)
 
-    ins_ids = [i.id for i in inspections]
+    async def pop(self, user_id: int):
+        await self._redis.delete(f"{self.PREFIX}{user_id}")
+
+    async def size(self) -> int:
+        count = 0
+        async for _ in self._redis.scan_iter(match=f"{self.PREFIX}*"):
+            count += 1
+        return count
+
+
+def make_state_storage() -> StateStorage:
+    if STATE_BACKEND == "sqlite":
+        return SQLiteStateStorage(STATE_TTL)
+    if STATE_BACKEND == "redis":
+        return RedisStateStorage(STATE_TTL, REDIS_URL)
+    return MemoryStateStorage(STATE_TTL, STATE_MAX_USERS)
 
-    issues_deleted = (
-        s.query(Issue)
-        .filter(Issue.inspection_id.in_(ins_ids))
-        .delete(synchronize_session=False)
-    )
 
-    inspections_deleted = (
-        s.query(Inspection)
-        .filter(Inspection.id.in_(ins_ids))
-        .delete(synchronize_session=False)
+user_states = make_state_storage()
+
+
+def is_admin(tg_id: int) -> bool:
+    return tg_id in ADMIN_IDS
+
+def db_delete_inspections_batch(condition, batch_size: int) -> tuple[int, int]:
+    """
+    Удаляет одну пачку — до batch_size обходов, подходящих под condition,
+    вместе с их замечаниями. Одна короткая транзакция, id выбираются
+    подзапросом на стороне БД (без загрузки ORM-объектов).
+    Возвращает (inspections_deleted, issues_deleted).
+    """
+    batch_ids = (
+        select(Inspection.id)
+        .where(condition)
+        .order_by(Inspection.id)
+        .limit(batch_size)
+        .scalar_subquery()
     )
+    with engine.begin() as conn:
+        issues_deleted = conn.execute(
+            delete(Issue).where(Issue.inspection_id.in_(batch_ids))
+        ).rowcount
+        inspections_deleted = conn.execute(
+            delete(Inspection).where(Inspection.id.in_(batch_ids))
+        ).rowcount
+    return inspections_deleted, issues_deleted
 
-    s.commit()
-    s.close()
 
-    await callback.answer("История очищена.", show_alert=True)
+def purge_old_data(days: int = RETENTION_DAYS, batch_size: int = DELETE_BATCH_SIZE):
+    """
+    Удаляет обходы и связанные с ними замечания, которым больше `days` дней.
+    Удаляет пачками по batch_size обходов, каждая пачка — своя транзакция.
+    Возвращает (inspections_deleted, issues_deleted).
+    """
+    cutoff_date = date.today() - timedelta(days=days)
 
-    try:
-        await callback.message.edit_text(
-            f"Очистка истории завершена.\n"
-            f"Период: {period_text}.\n"
-            f"Удалено обходов: {inspections_deleted}\n"
-            f"Удалено замечаний: {issues_deleted}"
+    inspections_total = issues_total = 0
+    while True:
+        inspections_deleted, issues_deleted = db_delete_inspections_batch(
+            Inspection.date < cutoff_date, batch_size
         )
-    except Exception:
-        pass
+        inspections_total += inspections_deleted
+        issues_total += issues_deleted
+        if inspections_deleted < batch_size:
+            break
 
+    # сводки для админов нужны, пока по ним можно нажать «Принять все»
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    old_digests = select(ReviewDigest.id).where(ReviewDigest.created_at < cutoff)
+    with engine.begin() as conn:
+        conn.execute(delete(ReviewDigestItem).where(ReviewDigestItem.digest_id.in_(old_digests)))
+        conn.execute(delete(ReviewDigest).where(ReviewDigest.created_at < cutoff))
 
-# ===== ОБХОД =====
+    return inspections_total, issues_total
 
-@dp.message(F.text == "СДЕЛАТЬ ОБХОД")
-async def start_inspection(message: types.Message):
-    logger.info("Сделать обход from %s", message.from_user.id)
 
-    if not is_admin(message.from_user.id):
-        await message.answer(
-            "Сейчас создавать обходы могут только администраторы.\n"
-            "Если нужен обход по отделу — напиши своему администратору 👍",
-            reply_markup=main_menu_kb(False),
+class RetentionJob:
+    """
+    Фоновая очистка старых данных (purge_old_data) раз в interval секунд.
+    Хранит время, длительность и результат последнего прогона для /status.
+    """
+
+    def __init__(self, days: int, interval: int, batch_size: int):
+        self.days = days
+        self.interval = interval
+        self.batch_size = batch_size
+        self.last_run_at: datetime | None = None
+        self.last_duration: float | None = None
+        self.last_inspections_deleted = 0
+        self.last_issues_deleted = 0
+
+    async def run_once(self):
+        started = time.monotonic()
+        inspections_deleted, issues_deleted = await run_db(
+            purge_old_data, self.days, self.batch_size
+        )
+        # заодно забываем брошенные диалоги
+        await user_states.sweep()
+        self.last_run_at = datetime.now()
+        self.last_duration = time.monotonic() - started
+        self.last_inspections_deleted = inspections_deleted
+        self.last_issues_deleted = issues_deleted
+        logger.info(
+            "Очистка старых данных: обходов %s, замечаний %s, %.2f с",
+            inspections_deleted,
+            issues_deleted,
+            self.last_duration,
         )
-        return
 
-    USER_STATE[message.from_user.id] = {"mode": None}
-    await message.answer(
-        "Выбери отдел, по которому делаешь обход:",
-        reply_markup=departments_kb("ins_dept:"),
-    )
+    async def run_forever(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                logger.exception("Ошибка фоновой очистки старых данных: %s", e)
+            await asyncio.sleep(self.interval)
 
+    def status_lines(self) -> list[str]:
+        if self.last_run_at is None:
+            return ["Очистка старых данных: ещё не запускалась"]
+        return [
+            f"Очистка старых данных (старше {self.days} дн.): "
+            f"{self.last_run_at.strftime('%d.%m.%Y %H:%M:%S')}, "
+            f"{self.last_duration:.2f} с",
+            f"  удалено обходов: {self.last_inspections_deleted}, "
+            f"замечаний: {self.last_issues_deleted}",
+        ]
 
-@dp.callback_query(lambda c: c.data and c.data.startswith("ins_dept:"))
-async def choose_inspection_department(callback: types.CallbackQuery):
-    user_id = callback.from_user.id
-    _, idx = callback.data.split(":")
-    idx = int(idx)
 
-    s = get_session()
-    dept = s.query(Department).filter_by(id=idx).first()
-    user = s.query(User).filter_by(tg_id=user_id).first()
-    if not dept or not user:
-        s.close()
-        await callback.answer("Не удалось найти отдел или пользователя.", show_alert=True)
-        return
+retention_job = RetentionJob(RETENTION_DAYS, RETENTION_INTERVAL, DELETE_BATCH_SIZE)
 
-    ins = Inspection(
-        department_id=dept.id,
-        inspector_id=user.id,
-        date=date.today(),
-        status="open",
-    )
+
+# ---------- ОТДЕЛЫ ----------
+
+class DepartmentRegistry:
+    """
+    Кэш отделов в памяти процесса: id -> название и готовые клавиатуры
+    выбора отдела. Заполняется один раз при старте (load); если отделы
+    в БД поменялись — вызвать invalidate().
+    """
+
+    def __init__(self):
+        self._names: dict[int, str] = {}
+        self._keyboards: dict[type[CallbackData], InlineKeyboardMarkup] = {}
+
+    def load(self):
+        """Создаёт недостающие отделы из DEPARTMENTS и читает все отделы. Синхронно, через run_db."""
+        s = get_session()
+        existing = {d.name for d in s.query(Department).all()}
+        for name in DEPARTMENTS:
+            if name not in existing:
+                s.add(Department(name=name))
+        s.commit()
+        names = {d.id: d.name for d in s.query(Department).order_by(Department.id)}
+        s.close()
+
+        self._names = names
+        self._keyboards = {}
+
+    async def invalidate(self):
+        await run_db(self.load)
+
+    def name(self, dept_id: int) -> str | None:
+        return self._names.get(dept_id)
+
+    def display_name(self, dept_id: int) -> str:
+        return self._names.get(dept_id) or f"Отдел #{dept_id}"
+
+    def keyboard(self, factory: type[CallbackData]) -> InlineKeyboardMarkup:
+        kb = self._keyboards.get(factory)
+        if kb is None:
+            builder = InlineKeyboardBuilder()
+            for dept_id, name in self._names.items():
+                builder.button(text=name, callback_data=factory(dept_id=dept_id))
+            builder.adjust(3)
+            kb = self._keyboards[factory] = builder.as_markup()
+        return kb
+
+
+department_registry = DepartmentRegistry()
+
+
+# ---------- ЗАПРОСЫ К БД ----------
+# Синхронные функции: вызываются из хэндлеров только через run_db.
+
+def db_register_user(tg_id: int, full_name: str):
+    s = get_session()
+
+    # регистрируем пользователя
+    user = s.query(User).filter_by(tg_id=tg_id).first()
+    if not user:
+        s.add(User(tg_id=tg_id, name=full_name))
+        s.commit()
+
+    s.close()
+
+
+def clear_history_condition(period: str):
+    """
+    Условие отбора обходов для «ОЧИСТИТЬ ИСТОРИЮ» по периоду "7" / "30" / "all".
+    Возвращает (condition, period_text).
+    """
+    if period == "all":
+        return true(), "за всё время"
+
+    days = int(period)
+    cutoff_date = date.today() - timedelta(days=days)
+    condition = and_(Inspection.date >= cutoff_date, Inspection.date <= date.today())
+    return condition, f"за последние {days} дней"
+
+
+def db_count_inspections(condition) -> tuple[int, int | None]:
+    """Возвращает (количество, максимальный id) обходов под условием."""
+    s = get_session()
+    total, max_id = s.execute(
+        select(func.count(Inspection.id), func.max(Inspection.id)).where(condition)
+    ).one()
+    s.close()
+    return total, max_id
+
+
+def db_create_inspection(dept_id: int, tg_id: int):
+    """
+    Создаёт обход по отделу. Возвращает (inspection_id, dept_name)
+    или None, если отдел/пользователь не найден.
+    """
+    dept_name = department_registry.name(dept_id)
+    if not dept_name:
+        return None
+
+    s = get_session()
+    user = s.query(User).filter_by(tg_id=tg_id).first()
+    if not user:
+        s.close()
+        return None
+
+    ins = Inspection(
+        department_id=dept_id,
+        inspector_id=user.id,
+        date=date.today(),
+        status="open",
+    )
     s.add(ins)
     s.commit()
     s.refresh(ins)
     inspection_id = ins.id
     s.close()
+    return inspection_id, dept_name
+
+
+def db_reserve_ids(name: str, count: int) -> int:
+    """Резервирует count id подряд одним UPDATE … RETURNING, возвращает первый."""
+    s = get_session()
+    start = s.execute(
+        update(IdSequence)
+        .where(IdSequence.name == name)
+        .values(next_id=IdSequence.next_id + count)
+        .returning(IdSequence.next_id - count)
+    ).scalar_one()
+    s.commit()
+    s.close()
+    return start
+
+
+def db_insert_issues(records: list[dict], comments: dict[int, str] | None = None):
+    """
+    Записывает пачку замечаний из IssueBuffer одной транзакцией.
+    INSERT OR IGNORE — повтор после сбоя не создаёт дублей.
+    comments — комментарии к уже записанным замечаниям (при восстановлении).
+    """
+    rows = [
+        {**record, "status": "open", "created_at": datetime.fromisoformat(record["created_at"])}
+        for record in records
+    ]
+    s = get_session()
+    if rows:
+        s.execute(Issue.__table__.insert().prefix_with("OR IGNORE"), rows)
+    for issue_id, comment in (comments or {}).items():
+        s.execute(update(Issue).where(Issue.id == issue_id).values(comment=comment))
+    s.commit()
+    s.close()
+
+
+def db_set_issue_comment(issue_id: int, comment: str) -> bool:
+    s = get_session()
+    issue = s.query(Issue).filter_by(id=issue_id).first()
+    if not issue:
+        s.close()
+        return False
+
+    issue.comment = comment
+    s.commit()
+    s.close()
+    return True
+
+
+# Допустимые переходы статуса замечания: действие -> (из каких статусов, в какой)
+ISSUE_TRANSITIONS = {
+    "submit": (("open", "pending"), "pending"),
+    "approve": (("pending",), "fixed"),
+    "return": (("pending",), "open"),
+}
+
+
+def db_transition_issue(s, issue_id: int, action: str, **values):
+    """
+    Переводит замечание по ISSUE_TRANSITIONS одним условным UPDATE … RETURNING:
+    статус проверяется в WHERE, поэтому два админа, одновременно нажавшие
+    «ОК» и «Вернуть в работу», не перетрут друг друга — второй получит None.
+    Возвращает строку (id, department_id, dept_name, photo_url, comment,
+    fixed_by_tg_id) или None, если замечания нет или переход недопустим.
+    Коммит — на вызывающем (обычно вместе с уведомлениями в outbox).
+    """
+    from_statuses, to_status = ISSUE_TRANSITIONS[action]
+    dept_name = (
+        select(Department.name)
+        .where(Department.id == Issue.department_id)
+        .scalar_subquery()
+        .label("dept_name")
+    )
+    stmt = (
+        update(Issue)
+        .where(Issue.id == issue_id, Issue.status.in_(from_statuses))
+        .values(status=to_status, **values)
+        .returning(
+            Issue.id,
+            Issue.department_id,
+            dept_name,
+            Issue.photo_url,
+            Issue.comment,
+            Issue.fixed_by_tg_id,
+        )
+    )
+    return s.execute(stmt).first()
+
+
+def db_submit_fix(
+    issue_id: int,
+    fixed_photo_id,
+    fixed_by_tg_id: int,
+    fixer_name: str,
+    fix_comment: str,
+    fixed_photo_unique_id: str | None = None,
+) -> bool:
+    """
+    Переводит замечание в статус "pending" (отправлено на проверку) и в той же
+    транзакции ставит уведомления админам в outbox.
+    Возвращает False, если замечание не найдено или уже закрыто.
+    """
+    s = get_session()
+    issue = db_transition_issue(
+        s,
+        issue_id,
+        "submit",
+        fixed_photo_url=fixed_photo_id,
+        fixed_photo_unique_id=fixed_photo_unique_id,
+        fixed_at=datetime.utcnow(),
+        fixed_by_tg_id=fixed_by_tg_id,
+    )
+    if not issue:
+        s.close()
+        return False
+
+    payload = {
+        "issue_id": issue_id,
+        "dept_name": issue.dept_name or f"Отдел #{issue.department_id}",
+        "original_photo_id": issue.photo_url,
+        "original_comment": issue.comment or "(без текста)",
+        "fixed_photo_id": fixed_photo_id,
+        "fixed_photo_unique_id": fixed_photo_unique_id,
+        "fixer_name": fixer_name,
+        "fix_comment": fix_comment,
+    }
+    deliver_at = review_digest_due(datetime.utcnow())
+    for admin_id in ADMIN_IDS:
+        enqueue_outbox(s, "fix_review", admin_id, payload, deliver_at)
+    s.commit()
+    s.close()
+    return True
+
+
+def db_complete_inspection(inspection_id: int, inspector_name: str):
+    """
+    Закрывает обход и в той же транзакции ставит в outbox уведомление
+    для BALIZAG_CHAT_ID.
+    """
+    s = get_session()
+    ins = s.query(Inspection).filter_by(id=inspection_id).first()
+    dept_name = "неизвестный отдел"
+    ins_date = date.today()
+
+    if ins:
+        ins.status = "completed"
+
+        dept_name = department_registry.name(ins.department_id) or dept_name
+
+        inspector = s.query(User).filter_by(id=ins.inspector_id).first()
+        if inspector and inspector.name:
+            inspector_name = inspector.name
+
+        ins_date = ins.date
+
+    issues_count = (
+        s.query(Issue)
+        .filter(Issue.inspection_id == inspection_id)
+        .count()
+    )
+
+    if BALIZAG_CHAT_ID:
+        enqueue_outbox(
+            s,
+            "inspection_done",
+            BALIZAG_CHAT_ID,
+            {
+                "dept_name": dept_name,
+                "issues_count": issues_count,
+                "inspector_name": inspector_name,
+                "ins_date": ins_date.isoformat(),
+            },
+        )
+
+    s.commit()
+    s.close()
+
+
+def db_open_issues_page(dept_id: int, cursor=None, backward: bool = False, limit: int = 5):
+    """
+    Страница открытых замечаний отдела по ключу (created_at, id)
+    — без OFFSET, поэтому стоимость не зависит от номера страницы.
+
+    cursor — (created_at, id) крайнего замечания соседней страницы или None
+    для первой; backward=True — страница перед cursor.
+    Возвращает (rows, has_before, has_after, total), rows — кортежи
+    (id, comment, status, photo_url, created_at) по возрастанию.
+    """
+    key = tuple_(Issue.created_at, Issue.id)
+    base = select(
+        Issue.id, Issue.comment, Issue.status, Issue.photo_url, Issue.created_at
+    ).where(
+        Issue.department_id == dept_id,
+        Issue.status.in_(["open", "pending"]),
+    )
+
+    if backward:
+        query = base.where(key < tuple_(*cursor)).order_by(
+            Issue.created_at.desc(), Issue.id.desc()
+        )
+    else:
+        if cursor is not None:
+            base = base.where(key > tuple_(*cursor))
+        query = base.order_by(Issue.created_at.asc(), Issue.id.asc())
+
+    s = get_session()
+    rows = s.execute(query.limit(limit + 1)).all()
+    total = s.execute(
+        select(func.count()).where(
+            Issue.department_id == dept_id,
+            Issue.status.in_(["open", "pending"]),
+        )
+    ).scalar()
+    s.close()
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if backward:
+        rows.reverse()
+        return rows, has_more, True, total
+    return rows, cursor is not None, has_more, total
+
+
+def db_approve_issue(issue_id: int) -> bool:
+    """Закрывает замечание на проверке. False — уже закрыто или возвращено."""
+    s = get_session()
+    issue = db_transition_issue(s, issue_id, "approve")
+    s.commit()
+    s.close()
+    return issue is not None
+
+
+def db_return_issue(issue_id: int) -> bool:
+    """
+    Возвращает замечание с проверки в работу и ставит в outbox уведомление
+    тому, кто присылал исправление. False — замечание уже обработано.
+    """
+    s = get_session()
+    # reminded_at сбрасывается: вернувшееся замечание снова ждёт напоминания о сроке
+    issue = db_transition_issue(
+        s,
+        issue_id,
+        "return",
+        fixed_photo_url=None,
+        fixed_photo_unique_id=None,
+        fixed_at=None,
+        reminded_at=None,
+    )
+    if not issue:
+        s.close()
+        return False
+
+    if issue.fixed_by_tg_id:
+        enqueue_outbox(
+            s,
+            "fix_returned",
+            issue.fixed_by_tg_id,
+            {
+                "issue_id": issue_id,
+                "dept_name": issue.dept_name or f"Отдел #{issue.department_id}",
+                "comment": issue.comment or "(без текста)",
+            },
+        )
+    s.commit()
+    s.close()
+    return True
+
+
+def issue_due(ins_date: date) -> datetime:
+    """Когда замечание обхода от ins_date считается просроченным (местное время)."""
+    control_date = ins_date + timedelta(days=FIX_DEADLINE_DAYS + 1)
+    return datetime.combine(control_date, datetime.min.time()) + timedelta(hours=OVERDUE_REMIND_HOUR)
+
+
+def db_issue_deadlines(issue_ids: list[int] | None = None) -> list[tuple[int, datetime]]:
+    """
+    Сроки открытых замечаний, о которых ещё не напоминали: [(id, срок)].
+    issue_ids=None — все такие замечания (по индексу ix_issues_status_reminded).
+    """
+    s = get_session()
+    q = (
+        s.query(Issue.id, Inspection.date)
+        .join(Inspection, Inspection.id == Issue.inspection_id)
+        .filter(Issue.status == "open", Issue.reminded_at.is_(None))
+    )
+    if issue_ids is not None:
+        q = q.filter(Issue.id.in_(issue_ids))
+    rows = [(issue_id, issue_due(ins_date)) for issue_id, ins_date in q.all()]
+    s.close()
+    return rows
+
+
+def db_remind_overdue(issue_ids: list[int]) -> int:
+    """
+    Отмечает просроченные замечания (reminded_at) и в той же транзакции
+    ставит в outbox по одному напоминанию на отдел для BALIZAG_CHAT_ID.
+    Условие в WHERE отсекает исправленные, удалённые и уже напомненные
+    замечания, поэтому повторный вызов (или вызов из другого процесса)
+    второго напоминания не пришлёт. Возвращает число замечаний в напоминаниях.
+    """
+    dept_name = (
+        select(Department.name)
+        .where(Department.id == Issue.department_id)
+        .scalar_subquery()
+        .label("dept_name")
+    )
+    ins_date = (
+        select(Inspection.date)
+        .where(Inspection.id == Issue.inspection_id)
+        .scalar_subquery()
+        .label("ins_date")
+    )
+    s = get_session()
+    rows = s.execute(
+        update(Issue)
+        .where(Issue.id.in_(issue_ids), Issue.status == "open", Issue.reminded_at.is_(None))
+        .values(reminded_at=datetime.utcnow())
+        .returning(Issue.id, Issue.department_id, dept_name, ins_date, Issue.comment)
+    ).all()
+
+    by_dept: dict[int, list] = {}
+    for row in sorted(rows, key=lambda r: r.id):
+        by_dept.setdefault(row.department_id, []).append(row)
+
+    if BALIZAG_CHAT_ID:
+        for dept_id, dept_rows in by_dept.items():
+            enqueue_outbox(
+                s,
+                "issues_overdue",
+                BALIZAG_CHAT_ID,
+                {
+                    "dept_name": dept_rows[0].dept_name or f"Отдел #{dept_id}",
+                    "issues": [
+                        {
+                            "id": row.id,
+                            "comment": row.comment or "(без текста)",
+                            "control_date": (row.ins_date + timedelta(days=FIX_DEADLINE_DAYS)).isoformat(),
+                        }
+                        for row in dept_rows
+                    ],
+                },
+            )
+    s.commit()
+    s.close()
+    return len(rows)
+
+
+def db_create_review_digest(chat_id: int, issue_ids: list[int]) -> int:
+    s = get_session()
+    digest = ReviewDigest(chat_id=chat_id)
+    s.add(digest)
+    s.flush()
+    digest_id = digest.id
+    s.execute(
+        ReviewDigestItem.__table__.insert(),
+        [{"digest_id": digest_id, "issue_id": issue_id} for issue_id in issue_ids],
+    )
+    s.commit()
+    s.close()
+    return digest_id
+
+
+def db_delete_review_digest(digest_id: int):
+    s = get_session()
+    s.execute(delete(ReviewDigestItem).where(ReviewDigestItem.digest_id == digest_id))
+    s.execute(delete(ReviewDigest).where(ReviewDigest.id == digest_id))
+    s.commit()
+    s.close()
+
+
+def db_approve_digest(digest_id: int) -> list[int]:
+    """
+    «Принять все»: закрывает все ещё ожидающие проверки замечания сводки
+    одним UPDATE … RETURNING. Возвращает id закрытых.
+    """
+    from_statuses, to_status = ISSUE_TRANSITIONS["approve"]
+    s = get_session()
+    approved = s.execute(
+        update(Issue)
+        .where(
+            Issue.status.in_(from_statuses),
+            Issue.id.in_(
+                select(ReviewDigestItem.issue_id).where(ReviewDigestItem.digest_id == digest_id)
+            ),
+        )
+        .values(status=to_status)
+        .returning(Issue.id)
+    ).scalars().all()
+    s.commit()
+    s.close()
+    return sorted(approved)
+
+
+def db_history_stats(dept_id=None):
+    """
+    Статистика для «ИСТОРИЯ ОБХОДОВ»: по всем отделам или по одному.
+    Читается из счётчиков department_stats одним запросом —
+    O(число отделов), без скана issues.
+
+    Возвращает (total_inspections, completed, active,
+    total_issues, open_issues, closed_issues).
+    """
+    query = select(
+        DepartmentStat.entity,
+        DepartmentStat.status,
+        func.sum(DepartmentStat.count),
+    ).group_by(DepartmentStat.entity, DepartmentStat.status)
+    if dept_id is not None:
+        query = query.where(DepartmentStat.department_id == dept_id)
+
+    s = get_session()
+    rows = s.execute(query).all()
+    s.close()
+
+    inspections: dict[str, int] = {}
+    issues: dict[str, int] = {}
+    for entity, status, cnt in rows:
+        if entity == "inspection":
+            inspections[status] = cnt
+        else:
+            issues[status] = cnt
+
+    total_inspections = sum(inspections.values())
+    completed = inspections.get("completed", 0)
+    active = total_inspections - completed
+
+    total_issues = sum(issues.values())
+    open_issues = issues.get("open", 0) + issues.get("pending", 0)
+    closed_issues = issues.get("fixed", 0)
+
+    return total_inspections, completed, active, total_issues, open_issues, closed_issues
+
+
+# ---------- БУФЕР ЗАМЕЧАНИЙ ОБХОДА ----------
+
+class IssueBuffer:
+    """
+    Write-behind для замечаний обхода: add() сразу выдаёт номер (из блока
+    id, зарезервированного в id_sequences) и дописывает замечание в журнал
+    на диске, а в БД замечания уходят пачкой одной транзакцией (flush).
+
+    Журнал — JSON-строки "add"/"comment". Перед записью пачки он
+    переименовывается в *.flushing и удаляется после коммита; при старте
+    recover() дописывает в БД всё, что осталось в журналах после падения.
+    """
+
+    def __init__(self, path: str, flush_size: int, flush_interval: float, id_block: int):
+        self.path = path
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.id_block = id_block
+        self._pending: dict[int, dict] = {}
+        self._next_id = 0
+        self._end_id = 0
+        self._fd = None
+        self._lock = asyncio.Lock()
+        self._id_lock = asyncio.Lock()
+        self._timer: asyncio.Task | None = None
+        self._flushes: set[asyncio.Task] = set()
+        self.written = 0
+        self.batches = 0
+
+    async def _allocate_id(self) -> int:
+        if self._next_id >= self._end_id:
+            async with self._id_lock:
+                if self._next_id >= self._end_id:
+                    start = await run_db(db_reserve_ids, "issues", self.id_block)
+                    self._next_id, self._end_id = start, start + self.id_block
+        issue_id = self._next_id
+        self._next_id += 1
+        return issue_id
+
+    def _journal(self, entry: dict) -> int:
+        if self._fd is None:
+            self._fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        os.write(self._fd, (json.dumps(entry, ensure_ascii=False) + "\n").encode())
+        return self._fd
+
+    async def _sync(self, fd: int):
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, os.fsync, fd)
+        except OSError:
+            # журнал уже записан в БД и закрыт
+            pass
+
+    async def _append(self, inspection_id: int, department_id: int, photo_ids: list[str], comment) -> list[int]:
+        issue_ids = [await self._allocate_id() for _ in photo_ids]
+        created_at = datetime.utcnow().isoformat()
+        # запись в журнал и в буфер — без await между ними, чтобы flush
+        # не разделил их между старым и новым журналом
+        for issue_id, photo_id in zip(issue_ids, photo_ids):
+            record = {
+                "id": issue_id,
+                "inspection_id": inspection_id,
+                "department_id": department_id,
+                "photo_url": photo_id,
+                "comment": comment,
+                "created_at": created_at,
+            }
+            fd = self._journal({"op": "add", **record})
+            self._pending[issue_id] = record
+        await self._sync(fd)
+        return issue_ids
+
+    async def add(self, inspection_id: int, department_id: int, photo_id: str, comment) -> int:
+        issue_id = (await self._append(inspection_id, department_id, [photo_id], comment))[0]
+        if len(self._pending) >= self.flush_size:
+            task = asyncio.create_task(self.flush())
+            self._flushes.add(task)
+            task.add_done_callback(self._flushes.discard)
+        elif self._timer is None:
+            self._timer = asyncio.create_task(self._flush_later())
+        return issue_id
+
+    async def add_album(self, inspection_id: int, department_id: int, photo_ids: list[str], comment) -> list[int]:
+        """Альбом: по замечанию на фото, всё сразу одной транзакцией."""
+        issue_ids = await self._append(inspection_id, department_id, photo_ids, comment)
+        await self.flush()
+        return issue_ids
+
+    async def set_comments(self, issue_ids: list[int], comment: str) -> bool:
+        saved = [await self.set_comment(issue_id, comment) for issue_id in issue_ids]
+        return all(saved)
+
+    async def set_comment(self, issue_id: int, comment: str) -> bool:
+        record = self._pending.get(issue_id)
+        if record is not None:
+            record["comment"] = comment
+            await self._sync(self._journal({"op": "comment", "id": issue_id, "comment": comment}))
+            return True
+        # замечание могло как раз записываться — дождёмся конца flush
+        async with self._lock:
+            pass
+        return await run_db(db_set_issue_comment, issue_id, comment)
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_interval)
+        self._timer = None
+        await self.flush()
+
+    async def flush(self):
+        """Пишет всё накопленное в БД. Ошибку логирует и повторит по таймеру."""
+        async with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if not self._pending:
+                return
+
+            batch, self._pending = self._pending, {}
+            fd, self._fd = self._fd, None
+            flushing = self.path + ".flushing"
+            os.replace(self.path, flushing)
+            try:
+                await run_db(db_insert_issues, list(batch.values()))
+            except Exception as e:
+                logger.exception("Не удалось записать пачку замечаний (%s шт.): %s", len(batch), e)
+                # возвращаем пачку в буфер и в текущий журнал
+                for record in batch.values():
+                    self._journal({"op": "add", **record})
+                await self._sync(self._fd)
+                self._pending = {**batch, **self._pending}
+                self._timer = asyncio.create_task(self._flush_later())
+                return
+            finally:
+                os.close(fd)
+            os.remove(flushing)
+            self.written += len(batch)
+            self.batches += 1
+        await deadline_scheduler.refresh(list(batch))
+
+    def recover(self, paths: list[str] | None = None) -> int:
+        """
+        Дописывает в БД замечания из журналов, оставшихся после падения.
+        Синхронно, через run_db (или до старта цикла). Возвращает количество.
+        """
+        if paths is None:
+            paths = [self.path + ".flushing", self.path]
+        records: dict[int, dict] = {}
+        comments: dict[int, str] = {}
+        found = [path for path in paths if os.path.exists(path)]
+        for path in found:
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # недописанная последняя строка
+                        continue
+                    op = entry.pop("op")
+                    if op == "add":
+                        records[entry["id"]] = entry
+                    elif entry["id"] in records:
+                        records[entry["id"]]["comment"] = entry["comment"]
+                    else:
+                        comments[entry["id"]] = entry["comment"]
+
+        if records or comments:
+            db_insert_issues(list(records.values()), comments)
+            logger.info("Восстановлено замечаний из журнала: %s", len(records))
+        for path in found:
+            os.remove(path)
+        return len(records)
+
+    def status_lines(self) -> list[str]:
+        return [
+            f"Буфер замечаний: ждут записи {len(self._pending)}, "
+            f"записано {self.written} за {self.batches} транзакций",
+        ]
+
+
+def issue_journals() -> list[str]:
+    """
+    Все журналы буфера замечаний, включая журналы процессов --workers
+    (ISSUE_JOURNAL.N). *.flushing читается раньше своего журнала: он старше.
+    """
+    return sorted(
+        glob.glob(ISSUE_JOURNAL + "*"),
+        key=lambda path: (path.removesuffix(".flushing"), not path.endswith(".flushing")),
+    )
+
+
+issue_buffer = IssueBuffer(ISSUE_JOURNAL, ISSUE_FLUSH_SIZE, ISSUE_FLUSH_INTERVAL, ISSUE_ID_BLOCK)
+
+
+# ---------- ЛОКАЛЬНОЕ ХРАНИЛИЩЕ ФОТО ----------
+
+def db_media_lookup(file_id: str, bot_id: int):
+    """
+    По file_id: (file_unique_id, sha256, file_id для bot_id или None);
+    None — фото не сохранено. Заодно отмечает использование (для LRU).
+    """
+    s = get_session()
+    row = s.execute(
+        select(MediaFile.file_unique_id, MediaFile.sha256)
+        .join(MediaFileId, MediaFileId.file_unique_id == MediaFile.file_unique_id)
+        .where(MediaFileId.file_id == file_id)
+    ).first()
+    if row is None:
+        s.close()
+        return None
+    own_file_id = s.execute(
+        select(MediaFileId.file_id).where(
+            MediaFileId.file_unique_id == row.file_unique_id, MediaFileId.bot_id == bot_id
+        )
+    ).scalars().first()
+    s.execute(
+        update(MediaFile)
+        .where(MediaFile.file_unique_id == row.file_unique_id)
+        .values(last_used_at=datetime.utcnow())
+    )
+    s.commit()
+    s.close()
+    return row.file_unique_id, row.sha256, own_file_id
+
+
+def db_media_known(file_unique_id: str) -> bool:
+    s = get_session()
+    found = s.get(MediaFile, file_unique_id) is not None
+    s.close()
+    return found
+
+
+def db_media_save(
+    file_unique_id: str,
+    sha256: str | None,
+    size: int,
+    file_id: str,
+    bot_id: int,
+    stale_file_id: str | None = None,
+):
+    """
+    Записывает фото (если sha256 передан) и его file_id для бота; повторы
+    игнорируются. stale_file_id — file_id, который Telegram перестал принимать:
+    он остаётся для поиска, но боту больше не предлагается (bot_id = 0).
+    """
+    s = get_session()
+    if stale_file_id is not None:
+        s.execute(update(MediaFileId).where(MediaFileId.file_id == stale_file_id).values(bot_id=0))
+    if sha256 is not None:
+        s.execute(
+            MediaFile.__table__.insert().prefix_with("OR IGNORE"),
+            {"file_unique_id": file_unique_id, "sha256": sha256, "size": size, "last_used_at": datetime.utcnow()},
+        )
+    s.execute(
+        MediaFileId.__table__.insert().prefix_with("OR REPLACE"),
+        {"file_id": file_id, "file_unique_id": file_unique_id, "bot_id": bot_id},
+    )
+    s.commit()
+    s.close()
+
+
+def db_media_evict(max_bytes: int) -> list[str]:
+    """
+    Удаляет давно не использованные фото, пока общий размер (по уникальному
+    содержимому) больше max_bytes. Возвращает sha256 файлов, которые можно стереть.
+    """
+    s = get_session()
+    files = s.execute(
+        select(MediaFile.sha256, func.max(MediaFile.size), func.max(MediaFile.last_used_at))
+        .group_by(MediaFile.sha256)
+        .order_by(func.max(MediaFile.last_used_at))
+    ).all()
+    total = sum(size for _, size, _ in files)
+    evicted = []
+    for sha256, size, _ in files:
+        if total <= max_bytes:
+            break
+        evicted.append(sha256)
+        total -= size
+    if evicted:
+        unique_ids = select(MediaFile.file_unique_id).where(MediaFile.sha256.in_(evicted))
+        s.execute(delete(MediaFileId).where(MediaFileId.file_unique_id.in_(unique_ids)))
+        s.execute(delete(MediaFile).where(MediaFile.sha256.in_(evicted)))
+    s.commit()
+    s.close()
+    return evicted
+
+
+class MediaStore:
+    """
+    Необязательное (MEDIA_DIR) локальное хранилище фото замечаний.
+
+    Каждое фото один раз скачивается в файл, названный по sha256 содержимого
+    (одинаковые фото хранятся один раз), и записывается по file_unique_id.
+    При повторной отправке берём file_id, известный текущему боту; если
+    Telegram его не принимает — загружаем файл с диска и запоминаем новый
+    file_id. Сверх max_bytes удаляются давно не использованные файлы (LRU).
+    """
+
+    def __init__(self, root: str, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.enabled = bool(root)
+        self._fetching: dict[str, asyncio.Task] = {}
+        self.stored = 0
+        self.uploads = 0
+        self.evicted = 0
+
+    def _path(self, sha256: str) -> str:
+        return os.path.join(self.root, sha256[:2], sha256)
+
+    def track(self, photo: types.PhotoSize):
+        """Фоном сохраняет фото, если его ещё нет (не задерживает хэндлер)."""
+        if not self.enabled or photo.file_unique_id in self._fetching:
+            return
+        task = asyncio.create_task(self._fetch(photo.file_id, photo.file_unique_id))
+        self._fetching[photo.file_unique_id] = task
+        task.add_done_callback(lambda _: self._fetching.pop(photo.file_unique_id, None))
+
+    async def _fetch(self, file_id: str, file_unique_id: str):
+        try:
+            if await run_db(db_media_known, file_unique_id):
+                await run_db(db_media_save, file_unique_id, None, 0, file_id, bot.id)
+                return
+            data = (await bot.download(file_id)).getvalue()
+            sha256 = hashlib.sha256(data).hexdigest()
+            await asyncio.get_running_loop().run_in_executor(None, self._write, sha256, data)
+            await run_db(db_media_save, file_unique_id, sha256, len(data), file_id, bot.id)
+            self.stored += 1
+            await self._evict()
+        except Exception as e:
+            logger.warning("Не удалось сохранить фото %s: %s", file_unique_id, e)
+
+    def _write(self, sha256: str, data: bytes):
+        path = self._path(sha256)
+        if os.path.exists(path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    async def _evict(self):
+        for sha256 in await run_db(db_media_evict, self.max_bytes):
+            try:
+                os.remove(self._path(sha256))
+            except FileNotFoundError:
+                pass
+            self.evicted += 1
+
+    def _read(self, sha256: str) -> bytes | None:
+        try:
+            with open(self._path(sha256), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    async def _load(self, sha256: str) -> bytes | None:
+        # чтение с диска — в пуле потоков, а не в event loop
+        return await asyncio.get_running_loop().run_in_executor(None, self._read, sha256)
+
+    async def read(self, file_id: str) -> bytes | None:
+        """Содержимое фото с диска или None, если его нет в хранилище."""
+        if not self.enabled:
+            return None
+        found = await run_db(db_media_lookup, file_id, bot.id)
+        if found is None:
+            return None
+        return await self._load(found[1])
+
+    async def download(self, file_id: str) -> bytes:
+        data = await self.read(file_id)
+        if data is None:
+            data = (await bot.download(file_id)).getvalue()
+        return data
+
+    async def send_photo(self, chat_id: int, file_id: str, **kwargs) -> types.Message:
+        """send_photo с file_id этого бота, а если Telegram его не знает — из локального файла."""
+        if not self.enabled:
+            return await bot.send_photo(chat_id, file_id, **kwargs)
+
+        found = await run_db(db_media_lookup, file_id, bot.id)
+        own_file_id = found[2] if found and found[2] else file_id
+        try:
+            return await bot.send_photo(chat_id, own_file_id, **kwargs)
+        except TelegramBadRequest:
+            data = await self._load(found[1]) if found else None
+            if data is None:
+                raise
+            msg = await bot.send_photo(
+                chat_id, BufferedInputFile(data, filename=f"{found[1]}.jpg"), **kwargs
+            )
+            self.uploads += 1
+            # новый file_id — для этого бота и под исходным file_unique_id
+            await run_db(
+                db_media_save, found[0], None, 0, msg.photo[-1].file_id, bot.id, own_file_id
+            )
+            return msg
+
+    async def send_album(self, chat_id: int, photos: list[tuple[str, str]]) -> set[str]:
+        """
+        Фото [(file_id, подпись)] одним альбомом. Если Telegram не принял
+        file_id, альбом повторяется с локальными копиями; не вышло и так —
+        фото уходят по одному (send_photo). Возвращает file_id фото,
+        которые отправить не удалось.
+        """
+        if len(photos) > 1:
+            found = [
+                await run_db(db_media_lookup, file_id, bot.id) if self.enabled else None
+                for file_id, _ in photos
+            ]
+            own_file_ids = [f[2] if f and f[2] else file_id for f, (file_id, _) in zip(found, photos)]
+            try:
+                await bot.send_media_group(
+                    chat_id,
+                    media=[
+                        InputMediaPhoto(media=own, caption=caption)
+                        for own, (_, caption) in zip(own_file_ids, photos)
+                    ],
+                )
+                return set()
+            except Exception:
+                pass
+            if any(found) and await self._send_album_from_disk(chat_id, photos, found, own_file_ids):
+                return set()
+
+        unavailable = set()
+        for file_id, caption in photos:
+            try:
+                await self.send_photo(chat_id, file_id, caption=caption)
+            except Exception:
+                unavailable.add(file_id)
+        return unavailable
+
+    async def _send_album_from_disk(self, chat_id: int, photos, found, own_file_ids) -> bool:
+        """Альбом, где сохранённые фото загружаются с диска; False — не ушёл."""
+        media, uploaded = [], []
+        for (file_id, caption), f, own in zip(photos, found, own_file_ids):
+            data = await self._load(f[1]) if f else None
+            if data is None:
+                media.append(InputMediaPhoto(media=own, caption=caption))
+                uploaded.append(None)
+            else:
+                media.append(
+                    InputMediaPhoto(media=BufferedInputFile(data, filename=f"{f[1]}.jpg"), caption=caption)
+                )
+                uploaded.append((f[0], own))
+        try:
+            messages = await bot.send_media_group(chat_id, media=media)
+        except Exception as e:
+            logger.warning("Альбом с локальными копиями не отправлен: %s", e)
+            return False
+        for msg, up in zip(messages, uploaded):
+            if up is None or not msg.photo:
+                continue
+            self.uploads += 1
+            await run_db(db_media_save, up[0], None, 0, msg.photo[-1].file_id, bot.id, up[1])
+        return True
+
+    def status_lines(self) -> list[str]:
+        if not self.enabled:
+            return []
+        return [
+            f"Локальные фото: сохранено {self.stored}, загружено с диска {self.uploads}, "
+            f"вытеснено {self.evicted}",
+        ]
+
+
+media_store = MediaStore(MEDIA_DIR, MEDIA_MAX_MB * 1024 * 1024)
+
+
+# ---------- КОЛЛАЖ «ДО / ПОСЛЕ» ----------
+
+@contextmanager
+def collage_as_main():
+    """
+    Процессы пула коллажей (spawn) при старте исполняют модуль __main__
+    родителя — а это весь bot.py: Bot, движок БД, диспетчер. На время
+    запуска задачи (процессы пула стартуют в submit) главным модулем
+    считается collage, и процессу достаточно его и Pillow.
+    """
+    main = sys.modules["__main__"]
+    sys.modules["__main__"] = sys.modules["collage"]
+    try:
+        yield
+    finally:
+        sys.modules["__main__"] = main
+
+
+class CollageRenderer:
+    """
+    Коллажи для админов. Фото скачиваются через Bot API, рисуются в пуле
+    из workers процессов (Pillow грузит CPU и не должен стоять в event loop).
+    Готовый коллаж после первой отправки запоминается как file_id по ключу
+    (issue_id, file_unique_id фото исправления) — остальным админам и при
+    повторной доставке уходит без скачивания и отрисовки.
+    """
+
+    def __init__(self, workers: int, cache_size: int, font_name: str):
+        self.workers = workers
+        self.cache_size = cache_size
+        self.font_name = font_name
+        self._pool: ProcessPoolExecutor | None = None
+        self._cache: OrderedDict[tuple, str] = OrderedDict()
+        self._rendering: dict[tuple, asyncio.Task] = {}
+        self._semaphore = asyncio.Semaphore(workers)
+        self.rendered = 0
+        self.cache_hits = 0
+        try:
+            import PIL  # noqa: F401
+            self.available = workers > 0
+        except ImportError:
+            self.available = False
+
+    async def collage(self, issue_id: int, fixed_key: str, before_id: str, after_id: str, title: str):
+        """file_id готового коллажа или BufferedInputFile; None — нарисовать не вышло."""
+        key = (issue_id, fixed_key)
+        file_id = self._cache.get(key)
+        if file_id is not None:
+            self._cache.move_to_end(key)
+            self.cache_hits += 1
+            return file_id
+
+        # уведомления разным админам доставляются параллельно — рисуем один раз
+        task = self._rendering.get(key)
+        if task is None:
+            task = self._rendering[key] = asyncio.create_task(self._render(before_id, after_id, title))
+            task.add_done_callback(lambda _: self._rendering.pop(key, None))
+        try:
+            data = await task
+        except Exception as e:
+            logger.warning("Не удалось собрать коллаж для замечания #%s: %s", issue_id, e)
+            return None
+        return BufferedInputFile(data, filename=f"issue_{issue_id}.jpg")
+
+    async def _render(self, before_id: str, after_id: str, title: str) -> bytes:
+        # не больше workers коллажей одновременно: очередь ждёт здесь,
+        # а не держит скачанные фото в памяти
+        async with self._semaphore:
+            before, after = await asyncio.gather(
+                media_store.download(before_id), media_store.download(after_id)
+            )
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(
+                    self.workers, mp_context=multiprocessing.get_context("spawn")
+                )
+            with collage_as_main():
+                future = asyncio.get_running_loop().run_in_executor(
+                    self._pool,
+                    render_collage,
+                    before,
+                    after,
+                    title,
+                    self.font_name,
+                )
+            data = await future
+        self.rendered += 1
+        return data
+
+    def remember(self, issue_id: int, fixed_key: str, msg: types.Message):
+        if not msg or not msg.photo:
+            return
+        self._cache[(issue_id, fixed_key)] = msg.photo[-1].file_id
+        self._cache.move_to_end((issue_id, fixed_key))
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    def status_lines(self) -> list[str]:
+        if not self.available:
+            return ["Коллажи: выключены (нет Pillow), админам уходят два фото"]
+        return [
+            f"Коллажи: нарисовано {self.rendered}, из кэша {self.cache_hits}, "
+            f"в кэше {len(self._cache)}",
+        ]
+
+
+collage_renderer = CollageRenderer(COLLAGE_WORKERS, COLLAGE_CACHE_SIZE, COLLAGE_FONT)
+
+
+# ---------- КЛАВИАТУРЫ ----------
+
+# Callback-данные кнопок. Префикс — ключ в таблице CALLBACK_ROUTES,
+# поля упаковываются через ":" в том же формате, что и раньше собирался
+# руками, поэтому кнопки в уже отправленных сообщениях продолжают работать.
+
+class ClearHistoryCb(CallbackData, prefix="clear_history"):
+    period: str  # "7" / "30" / "all"
+
+
+class MenuCb(CallbackData, prefix="menu"):
+    action: str
+
+
+class InsDeptCb(CallbackData, prefix="ins_dept"):
+    dept_id: int
+
+
+class FixDeptCb(CallbackData, prefix="fix_dept"):
+    dept_id: int
+
+
+class HistDeptCb(CallbackData, prefix="hist_dept"):
+    dept_id: int
+
+
+class FixPageCb(CallbackData, prefix="fix_page"):
+    dept_id: int
+    direction: str  # "p" — назад, "n" — вперёд
+    micros: int
+    issue_id: int
+
+
+class FixIssueCb(CallbackData, prefix="fix"):
+    issue_id: int
+
+
+class ApproveCb(CallbackData, prefix="approve"):
+    issue_id: int
+    # карточка из одного сообщения (коллаж), без отдельного фото «до»
+    single: bool = False
+
+
+class ReturnCb(CallbackData, prefix="return"):
+    issue_id: int
+    single: bool = False
+
+
+class DigestOkCb(CallbackData, prefix="dg_ok"):
+    digest_id: int
+    # None — «Принять все»
+    issue_id: int | None = None
+
+
+class DigestRetCb(CallbackData, prefix="dg_ret"):
+    digest_id: int
+    issue_id: int
+
+
+def _build_main_menu_kb(is_admin_user: bool) -> ReplyKeyboardMarkup:
+    """
+    Главное меню:
+    - обычный пользователь: только 'ИСПРАВИТЬ ЗАМЕЧАНИЯ'
+    - админ:
+        [СДЕЛАТЬ ОБХОД]
+        [ИСТОРИЯ ОБХОДОВ] [ОЧИСТИТЬ ИСТОРИЮ]
+        [ИСПРАВИТЬ ЗАМЕЧАНИЯ]
+    """
+    builder = ReplyKeyboardBuilder()
+
+    if is_admin_user:
+        # верхняя строка – одна большая
+        builder.button(text="СДЕЛАТЬ ОБХОД")
+
+        # средняя строка – две кнопки
+        builder.button(text="ИСТОРИЯ ОБХОДОВ")
+        builder.button(text="ОЧИСТИТЬ ИСТОРИЮ")
+
+        # нижняя строка – одна кнопка
+        builder.button(text="ИСПРАВИТЬ ЗАМЕЧАНИЯ")
+
+        # раскладка строк: 1 / 2 / 1
+        builder.adjust(1, 2, 1)
+    else:
+        # для обычного пользователя только одна кнопка
+        builder.button(text="ИСПРАВИТЬ ЗАМЕЧАНИЯ")
+        builder.adjust(1)
+
+    return builder.as_markup(resize_keyboard=True)
+
+def _build_inspection_menu_kb() -> ReplyKeyboardMarkup:
+    builder = ReplyKeyboardBuilder()
+    builder.button(text="ЗАВЕРШИТЬ ОБХОД")
+    builder.button(text="НАЗАД")
+    builder.adjust(1)
+    return builder.as_markup(resize_keyboard=True)
+
+
+def _build_clear_history_kb() -> InlineKeyboardMarkup:
+    builder = InlineKeyboardBuilder()
+    builder.button(text="За 7 дней", callback_data=ClearHistoryCb(period="7"))
+    builder.button(text="За 30 дней", callback_data=ClearHistoryCb(period="30"))
+    builder.button(text="За всё время", callback_data=ClearHistoryCb(period="all"))
+    builder.adjust(2)
+    return builder.as_markup()
+
+
+# Статичные клавиатуры собираются один раз: разметка aiogram неизменяема
+# (frozen), поэтому один и тот же объект можно отдавать во все ответы.
+MAIN_MENU_ADMIN_KB = _build_main_menu_kb(True)
+MAIN_MENU_USER_KB = _build_main_menu_kb(False)
+INSPECTION_MENU_KB = _build_inspection_menu_kb()
+CLEAR_HISTORY_KB = _build_clear_history_kb()
+
+
+def main_menu_kb(is_admin_user: bool) -> ReplyKeyboardMarkup:
+    return MAIN_MENU_ADMIN_KB if is_admin_user else MAIN_MENU_USER_KB
+
+
+def inspection_menu_kb() -> ReplyKeyboardMarkup:
+    return INSPECTION_MENU_KB
+
+
+def clear_history_kb() -> InlineKeyboardMarkup:
+    return CLEAR_HISTORY_KB
+
+
+def departments_kb(factory: type[CallbackData]) -> InlineKeyboardMarkup:
+    return department_registry.keyboard(factory)
+
+
+def admin_review_kb(issue_id: int, single: bool = False) -> InlineKeyboardMarkup:
+    # single — карточка из одного сообщения (коллаж), без отдельного фото «до»
+    builder = InlineKeyboardBuilder()
+    builder.button(text="✅ ОК", callback_data=ApproveCb(issue_id=issue_id, single=single))
+    builder.button(text="↩️ Вернуть в работу", callback_data=ReturnCb(issue_id=issue_id, single=single))
+    builder.adjust(2)
+    return builder.as_markup()
+
+
+def review_digest_kb(digest_id: int, issue_ids: list[int]) -> InlineKeyboardMarkup:
+    builder = InlineKeyboardBuilder()
+    builder.button(text=f"✅ Принять все ({len(issue_ids)})", callback_data=DigestOkCb(digest_id=digest_id))
+    for issue_id in issue_ids:
+        builder.button(text=f"✅ #{issue_id}", callback_data=DigestOkCb(digest_id=digest_id, issue_id=issue_id))
+        builder.button(text=f"↩️ #{issue_id}", callback_data=DigestRetCb(digest_id=digest_id, issue_id=issue_id))
+    builder.adjust(1, *([2] * len(issue_ids)))
+    return builder.as_markup()
+
+
+# ---------- OUTBOX: ДОСТАВКА УВЕДОМЛЕНИЙ ----------
+
+async def deliver_fix_review(chat_id: int, p: dict):
+    issue_id = p["issue_id"]
+    dept_name = p["dept_name"]
+
+    caption_after = (
+        f"После исправления замечания #{issue_id} по отделу «{dept_name}».\n"
+        f"Исправил: {p['fixer_name']}\n\n"
+        f"Комментарий к исправлению: {p['fix_comment']}"
+    )
+    if p["original_photo_id"] and p["fixed_photo_id"] and collage_renderer.available:
+        # одна картинка «до | после» вместо двух фото
+        photo = await collage_renderer.collage(
+            issue_id,
+            p.get("fixed_photo_unique_id") or p["fixed_photo_id"],
+            p["original_photo_id"],
+            p["fixed_photo_id"],
+            f"#{issue_id} · {dept_name}",
+        )
+        if photo is not None:
+            caption = (
+                f"Замечание #{issue_id} по отделу «{dept_name}»: до и после исправления.\n"
+                f"Замечание: {p['original_comment']}\n"
+                f"Исправил: {p['fixer_name']}\n\n"
+                f"Комментарий к исправлению: {p['fix_comment']}"
+            )
+            msg = await bot.send_photo(
+                chat_id, photo, caption=caption, reply_markup=admin_review_kb(issue_id, single=True)
+            )
+            collage_renderer.remember(issue_id, p.get("fixed_photo_unique_id") or p["fixed_photo_id"], msg)
+            return
+
+    if p["original_photo_id"]:
+        await media_store.send_photo(
+            chat_id,
+            p["original_photo_id"],
+            caption=(
+                f"До исправления. Замечание #{issue_id} по отделу «{dept_name}».\n"
+                f"{p['original_comment']}"
+            ),
+        )
+
+    if p["fixed_photo_id"]:
+        await media_store.send_photo(
+            chat_id,
+            p["fixed_photo_id"],
+            caption=caption_after,
+            reply_markup=admin_review_kb(issue_id),
+        )
+    else:
+        await bot.send_message(
+            chat_id,
+            text=caption_after + "\nФото после исправления: (не приложено)",
+            reply_markup=admin_review_kb(issue_id),
+        )
+
+
+async def deliver_review_digest(chat_id: int, payloads: list[dict]):
+    """
+    Несколько исправлений одной сводкой: фото «до/после» альбомами
+    (по 5 замечаний на альбом) и одно сообщение со списком и кнопками,
+    включая «Принять все».
+    """
+    issue_ids = [p["issue_id"] for p in payloads]
+
+    # «до» и «после» одного замечания всегда в одном альбоме (до 10 фото)
+    albums, album = [], []
+    for p in payloads:
+        photos = [
+            (p["issue_id"], file_id, f"#{p['issue_id']} {label}")
+            for file_id, label in ((p["original_photo_id"], "до"), (p["fixed_photo_id"], "после"))
+            if file_id
+        ]
+        if len(album) + len(photos) > 10:
+            albums.append(album)
+            album = []
+        album.extend(photos)
+    if album:
+        albums.append(album)
+    unavailable: set[int] = set()
+    for album in albums:
+        failed = await media_store.send_album(chat_id, [(file_id, caption) for _, file_id, caption in album])
+        unavailable |= {issue_id for issue_id, file_id, _ in album if file_id in failed}
+
+    lines = [f"На проверку пришло исправлений: {len(payloads)}", ""]
+    for p in payloads:
+        lines.append(
+            f"#{p['issue_id']} «{p['dept_name']}»: {short_comment(p['original_comment'], 60)}\n"
+            f"   ➜ {short_comment(p['fix_comment'], 60)} ({p['fixer_name']})"
+            + ("" if p["fixed_photo_id"] else " — без фото")
+            + (" (фото недоступно)" if p["issue_id"] in unavailable else "")
+        )
+    # сводка в БД — только под сообщение с кнопками, чтобы повтор доставки
+    # не оставлял сводок без сообщения
+    digest_id = await run_db(db_create_review_digest, chat_id, issue_ids)
+    try:
+        await bot.send_message(
+            chat_id,
+            text="\n".join(lines),
+            reply_markup=review_digest_kb(digest_id, issue_ids),
+        )
+    except Exception:
+        await run_db(db_delete_review_digest, digest_id)
+        raise
+
+
+async def deliver_fix_returned(chat_id: int, p: dict):
+    await bot.send_message(
+        chat_id=chat_id,
+        text=(
+            f"Твоё исправление по замечанию #{p['issue_id']} вернули в работу.\n"
+            f"Отдел: {p['dept_name']}\n"
+            f"Текст замечания: {p['comment']}\n\n"
+            "Пожалуйста, проверь ещё раз и исправь️🙂"
+        ),
+    )
+
+
+async def deliver_inspection_done(chat_id: int, p: dict):
+    ins_date = date.fromisoformat(p["ins_date"])
+    control_date = ins_date + timedelta(days=FIX_DEADLINE_DAYS)
+
+    text = (
+        f"Завершён обход по бализажу\n"
+        f"📌 Отдел: {p['dept_name']}\n"
+        f"⚠️ Замечаний: {p['issues_count']}\n"
+        f"👷 Аудитор: {p['inspector_name']}\n"
+        f"📅 Дата аудита: {ins_date.strftime('%d.%m.%Y')}\n"
+        f"📍 Исправить до: {control_date.strftime('%d.%m.%Y')}\n"
+        f"🤖 Перейти в бота: @BalisageAudit013_bot"
+    )
+
+    await bot.send_message(
+        chat_id=chat_id,
+        text=text,
+        message_thread_id=BALIZAG_THREAD_ID,
+        parse_mode=ParseMode.HTML,
+    )
+
+
+# сколько просроченных замечаний перечислять в одном напоминании
+OVERDUE_LIST_LIMIT = 30
+
+
+async def deliver_issues_overdue(chat_id: int, p: dict):
+    issues = p["issues"]
+    lines = [
+        "⏰ Просрочены замечания по бализажу",
+        f"📌 Отдел: {p['dept_name']}",
+        f"⚠️ Не исправлено: {len(issues)}",
+        "",
+    ]
+    for it in issues[:OVERDUE_LIST_LIMIT]:
+        control_date = date.fromisoformat(it["control_date"])
+        lines.append(f"#{it['id']} (до {control_date.strftime('%d.%m.%Y')}) — {short_comment(it['comment'])}")
+    if len(issues) > OVERDUE_LIST_LIMIT:
+        lines.append(f"…и ещё {len(issues) - OVERDUE_LIST_LIMIT}")
+    lines.append("")
+    lines.append("🤖 Перейти в бота: @BalisageAudit013_bot")
+
+    await bot.send_message(
+        chat_id=chat_id,
+        text="\n".join(lines),
+        message_thread_id=BALIZAG_THREAD_ID,
+    )
+
+
+OUTBOX_DELIVERERS = {
+    "fix_review": deliver_fix_review,
+    "fix_returned": deliver_fix_returned,
+    "inspection_done": deliver_inspection_done,
+    "issues_overdue": deliver_issues_overdue,
+}
+
+
+class OutboxWorker:
+    """
+    Фоновая доставка уведомлений из таблицы outbox пачками.
+    Хэндлеры только пишут в outbox и зовут wake(); доставка — «хотя бы один
+    раз»: строка удаляется только после успешной отправки, а после
+    перезапуска недоставленное подхватывается снова.
+    """
+
+    def __init__(self, batch_size: int, poll_interval: float):
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self._wakeup = asyncio.Event()
+        self.delivered = 0
+        self.failed = 0
+
+    def wake(self):
+        self._wakeup.set()
+
+    async def _deliver_chat(self, rows) -> tuple[list[int], list[tuple[int, int]]]:
+        # уведомления одному чату — строго по порядку
+        delivered, failed = [], []
+
+        # несколько исправлений на проверку из одного окна — одной сводкой
+        reviews = [row for row in rows if row.kind == "fix_review"]
+        if REVIEW_DIGEST_WINDOW > 0 and len(reviews) > 1:
+            rows = [row for row in rows if row.kind != "fix_review"]
+            for i in range(0, len(reviews), REVIEW_DIGEST_MAX):
+                group = reviews[i:i + REVIEW_DIGEST_MAX]
+                payloads = [json.loads(row.payload) for row in group]
+                await self._attempt(group, deliver_review_digest(group[0].chat_id, payloads), delivered, failed)
+
+        for row in rows:
+            await self._attempt(
+                [row], OUTBOX_DELIVERERS[row.kind](row.chat_id, json.loads(row.payload)), delivered, failed
+            )
+        return delivered, failed
+
+    async def _attempt(self, rows, delivery, delivered: list, failed: list):
+        try:
+            await delivery
+            delivered.extend(row.id for row in rows)
+        except Exception as e:
+            logger.exception(
+                "Не удалось доставить уведомления %s (%s) в чат %s: %s",
+                [row.id for row in rows],
+                rows[0].kind,
+                rows[0].chat_id,
+                e,
+            )
+            for row in rows:
+                attempts = row.attempts + 1
+                if attempts >= OUTBOX_MAX_ATTEMPTS:
+                    # сдаёмся, чтобы одно «мёртвое» уведомление не висело вечно
+                    delivered.append(row.id)
+                else:
+                    failed.append((row.id, attempts))
+
+    async def run_once(self) -> int:
+        rows = await run_db(db_claim_outbox, self.batch_size, OUTBOX_MAX_BACKOFF)
+        if not rows:
+            return 0
+
+        by_chat: dict[int, list] = {}
+        for row in rows:
+            by_chat.setdefault(row.chat_id, []).append(row)
+
+        results = await asyncio.gather(*(self._deliver_chat(r) for r in by_chat.values()))
+        delivered = [i for d, _ in results for i in d]
+        failed = [f for _, fl in results for f in fl]
+        await run_db(db_finish_outbox, delivered, failed)
+
+        self.delivered += len(delivered)
+        self.failed += len(failed)
+        return len(rows)
+
+    async def run_forever(self):
+        while True:
+            self._wakeup.clear()
+            try:
+                claimed = await self.run_once()
+            except Exception as e:
+                logger.exception("Ошибка доставки уведомлений из outbox: %s", e)
+                claimed = 0
+
+            if claimed < self.batch_size:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def status_lines(self) -> list[str]:
+        backlog = await run_db(db_outbox_backlog)
+        return [
+            f"Outbox: в очереди {backlog}, доставлено {self.delivered}, "
+            f"неудачных попыток {self.failed}",
+        ]
+
+
+outbox_worker = OutboxWorker(OUTBOX_BATCH_SIZE, OUTBOX_POLL_INTERVAL)
+
+
+# ---------- СРОКИ ИСПРАВЛЕНИЯ ----------
+
+class DeadlineScheduler:
+    """
+    Напоминания о просроченных замечаниях без опроса таблицы по таймеру.
+    Сроки открытых замечаний лежат в min-куче в памяти: при старте она
+    один раз заполняется запросом по индексу (load), дальше её правят
+    переходы замечаний — новые и возвращённые в работу замечания попадают
+    в кучу (refresh), отправленные на проверку — забываются (forget).
+    Задача спит ровно до ближайшего срока и одной транзакцией ставит
+    в outbox напоминания, сгруппированные по отделам.
+
+    Из кучи ничего не удаляется сразу: актуальный срок хранится в _due,
+    а устаревшие записи отбрасываются, когда оказываются на вершине.
+    Исправленные, удалённые и уже напомненные замечания дополнительно
+    отсекает условие в db_remind_overdue, поэтому устаревшая запись
+    (например, после перехода в другом процессе) напоминания не вызовет.
+    """
+
+    def __init__(self):
+        self._heap: list[tuple[datetime, int]] = []
+        self._due: dict[int, datetime] = {}
+        self._wakeup = asyncio.Event()
+        self.reminders = 0
+        self.reminded_issues = 0
+
+    def _push(self, issue_id: int, due: datetime):
+        self._due[issue_id] = due
+        heapq.heappush(self._heap, (due, issue_id))
+        if self._heap[0] == (due, issue_id):
+            # новый ближайший срок — пересчитать время сна
+            self._wakeup.set()
+
+    def load(self, rows: list[tuple[int, datetime]]):
+        self._due = dict(rows)
+        self._heap = [(due, issue_id) for issue_id, due in rows]
+        heapq.heapify(self._heap)
+        self._wakeup.set()
+
+    async def refresh(self, issue_ids: list[int]):
+        """Берёт из БД сроки замечаний (новых или возвращённых в работу)."""
+        try:
+            rows = await run_db(db_issue_deadlines, issue_ids)
+        except Exception as e:
+            logger.exception("Не удалось загрузить сроки замечаний %s: %s", issue_ids, e)
+            return
+        for issue_id, due in rows:
+            self._push(issue_id, due)
+
+    def forget(self, issue_id: int):
+        self._due.pop(issue_id, None)
+
+    def _next_due(self) -> datetime | None:
+        while self._heap:
+            due, issue_id = self._heap[0]
+            if self._due.get(issue_id) == due:
+                return due
+            heapq.heappop(self._heap)
+        return None
+
+    def _pop_due(self, now: datetime) -> list[int]:
+        issue_ids = []
+        while (due := self._next_due()) is not None and due <= now:
+            _, issue_id = heapq.heappop(self._heap)
+            del self._due[issue_id]
+            issue_ids.append(issue_id)
+        return issue_ids
+
+    async def run_once(self, now: datetime):
+        issue_ids = self._pop_due(now)
+        if not issue_ids:
+            return
+        try:
+            reminded = 0
+            for i in range(0, len(issue_ids), 500):
+                reminded += await run_db(db_remind_overdue, issue_ids[i:i + 500])
+        except Exception as e:
+            logger.exception("Не удалось поставить напоминания о просрочке: %s", e)
+            # вернём сроки в кучу и попробуем позже
+            retry_at = now + timedelta(seconds=OUTBOX_MAX_BACKOFF)
+            for issue_id in issue_ids:
+                self._push(issue_id, retry_at)
+            return
+        if reminded:
+            self.reminders += 1
+            self.reminded_issues += reminded
+            outbox_worker.wake()
+            logger.info("Напоминание о просрочке: замечаний %s", reminded)
+
+    async def run_forever(self):
+        while True:
+            try:
+                self.load(await run_db(db_issue_deadlines))
+                break
+            except Exception as e:
+                logger.exception("Не удалось загрузить сроки замечаний: %s", e)
+                await asyncio.sleep(OUTBOX_MAX_BACKOFF)
+
+        while True:
+            self._wakeup.clear()
+            due = self._next_due()
+            timeout = None if due is None else max((due - datetime.now()).total_seconds(), 0)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+                continue
+            except asyncio.TimeoutError:
+                pass
+            await self.run_once(datetime.now())
+
+    def status_lines(self) -> list[str]:
+        due = self._next_due()
+        nearest = due.strftime("%d.%m.%Y %H:%M") if due else "нет"
+        return [
+            f"Сроки исправления: отслеживается {len(self._due)}, ближайший {nearest}, "
+            f"напоминаний {self.reminders} (замечаний {self.reminded_issues})",
+        ]
+
+
+deadline_scheduler = DeadlineScheduler()
+
+
+# ---------- УДАЛЕНИЕ СООБЩЕНИЙ ----------
+
+class MessageCleaner:
+    """
+    Чистка чата вне основного пути хэндлера: schedule() только запоминает
+    id сообщений, а отдельная задача на чат удаляет их пачками до 100 штук
+    одним deleteMessages. По одному удаляем, только если пачка целиком
+    не прошла (например, среди сообщений есть старше 48 часов).
+    """
+
+    BATCH_SIZE = 100
+
+    def __init__(self):
+        self._pending: dict[int, list[int]] = {}
+        self._tasks: dict[int, asyncio.Task] = {}
+        self.deleted = 0
+        self.batches = 0
+        self.fallbacks = 0
+
+    def schedule(self, chat_id: int, message_ids):
+        ids = [mid for mid in message_ids if mid]
+        if not ids:
+            return
+        self._pending.setdefault(chat_id, []).extend(ids)
+        if chat_id not in self._tasks:
+            self._tasks[chat_id] = asyncio.create_task(self._flush(chat_id))
+
+    async def _flush(self, chat_id: int):
+        try:
+            while self._pending.get(chat_id):
+                ids = list(dict.fromkeys(self._pending.pop(chat_id)))
+                for i in range(0, len(ids), self.BATCH_SIZE):
+                    await self._delete_batch(chat_id, ids[i:i + self.BATCH_SIZE])
+        finally:
+            del self._tasks[chat_id]
+
+    async def _delete_batch(self, chat_id: int, ids: list[int]):
+        if len(ids) > 1:
+            try:
+                await bot.delete_messages(chat_id=chat_id, message_ids=ids)
+                self.batches += 1
+                self.deleted += len(ids)
+                return
+            except TelegramBadRequest as e:
+                self.fallbacks += 1
+                logger.info("deleteMessages в чате %s не прошёл (%s), удаляю по одному", chat_id, e)
+            except Exception as e:
+                logger.warning("Не удалось удалить сообщения в чате %s: %s", chat_id, e)
+                return
+
+        for mid in ids:
+            try:
+                await bot.delete_message(chat_id=chat_id, message_id=mid)
+                self.deleted += 1
+            except Exception:
+                pass
+
+    async def drain(self):
+        """Дожидается удаления всего, что уже запланировано (при остановке)."""
+        while self._tasks:
+            await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+
+    def status_lines(self) -> list[str]:
+        return [
+            f"Удаление сообщений: удалено {self.deleted}, пачками {self.batches}, "
+            f"по одному после ошибки {self.fallbacks}, ждут {sum(map(len, self._pending.values()))}",
+        ]
+
+
+message_cleaner = MessageCleaner()
+
+
+# ---------- ПАНЕЛИ ПРОГРЕССА ----------
+
+class PanelEditor:
+    """
+    Сообщения-панели, которые правятся на месте (прогресс обхода).
+    update() только запоминает новый текст; правка уходит не чаще раза
+    в interval секунд, и серия обновлений превращается в одну правку
+    с последним текстом.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._texts: dict[tuple[int, int], str] = {}
+        self._tasks: dict[tuple[int, int], asyncio.Task] = {}
+        self._last_edit: dict[tuple[int, int], float] = {}
+        self.updates = 0
+        self.edits = 0
+
+    PRUNE_THRESHOLD = 1000
+
+    def update(self, chat_id: int, message_id: int, text: str):
+        key = (chat_id, message_id)
+        if len(self._last_edit) > self.PRUNE_THRESHOLD:
+            # брошенные панели: старше interval они уже ничего не ограничивают
+            deadline = time.monotonic() - self.interval
+            self._last_edit = {k: t for k, t in self._last_edit.items() if t > deadline}
+        self._texts[key] = text
+        self.updates += 1
+        if key not in self._tasks:
+            self._tasks[key] = asyncio.create_task(self._edit_later(key))
+
+    async def _edit_later(self, key: tuple[int, int]):
+        try:
+            # update(), пришедший во время правки, не заводит новую задачу —
+            # его текст уходит следующим кругом
+            while key in self._texts:
+                delay = self._last_edit.get(key, 0) + self.interval - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                await self._edit(key, self._texts.pop(key))
+        finally:
+            del self._tasks[key]
+
+    async def _edit(self, key: tuple[int, int], text: str):
+        chat_id, message_id = key
+        self._last_edit[key] = time.monotonic()
+        try:
+            await bot.edit_message_text(text=text, chat_id=chat_id, message_id=message_id)
+            self.edits += 1
+        except TelegramBadRequest as e:
+            if "message is not modified" not in str(e):
+                logger.warning("Не удалось обновить панель %s: %s", key, e)
+        except Exception as e:
+            logger.warning("Не удалось обновить панель %s: %s", key, e)
+
+    async def finish(self, chat_id: int, message_id: int, text: str):
+        """Последняя правка панели — сразу, без ожидания; панель забывается."""
+        key = (chat_id, message_id)
+        task = self._tasks.get(key)
+        if task is not None:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        self._texts.pop(key, None)
+        await self._edit(key, text)
+        self._last_edit.pop(key, None)
+
+    def status_lines(self) -> list[str]:
+        return [
+            f"Панели прогресса: обновлений {self.updates}, правок сообщений {self.edits}, "
+            f"ждут правки {len(self._tasks)}",
+        ]
+
+
+panel_editor = PanelEditor(PANEL_EDIT_INTERVAL)
+
+
+# ---------- МАРШРУТИЗАЦИЯ ----------
+# Вместо цепочки фильтров (aiogram проверяет их по очереди для каждого
+# апдейта) — по одному хэндлеру на тип апдейта и поиск в словаре:
+# callback — по префиксу callback_data, кнопки меню — по точному тексту.
+
+CALLBACK_ROUTES: dict[str, tuple[type[CallbackData], object]] = {}
+TEXT_ROUTES: dict[str, object] = {}
+
+
+def callback_route(factory: type[CallbackData]):
+    """Регистрирует хэндлер кнопок factory: handler(callback, data)."""
+    def register(handler):
+        CALLBACK_ROUTES[factory.__prefix__] = (factory, handler)
+        return handler
+    return register
+
+
+def text_route(*texts: str):
+    """Регистрирует хэндлер кнопок главного меню с данным текстом."""
+    def register(handler):
+        for t in texts:
+            TEXT_ROUTES[t] = handler
+        return handler
+    return register
+
+
+def unpack_callback(factory: type[CallbackData], data: str) -> CallbackData:
+    fields = factory.model_fields
+    parts = data.split(factory.__separator__)[1:]
+    if len(parts) < len(fields):
+        # старые кнопки без хвостовых полей (например, "approve:5"):
+        # недостающие значения берутся по умолчанию
+        missing = list(fields)[len(parts):]
+        if all(not fields[name].is_required() for name in missing):
+            return factory(**dict(zip(fields, parts)))
+    return factory.unpack(data)
+
+
+@dp.callback_query()
+async def route_callback(callback: types.CallbackQuery):
+    data = callback.data or ""
+    route = CALLBACK_ROUTES.get(data.partition(":")[0])
+    if route is None:
+        await callback.answer()
+        return
+
+    factory, handler = route
+    try:
+        cb = unpack_callback(factory, data)
+    except (TypeError, ValueError):
+        logger.warning("Некорректный callback_data от %s: %r", callback.from_user.id, data)
+        await callback.answer()
+        return
+
+    await handler(callback, cb)
+
+
+@dp.message(F.text & ~F.text.startswith("/"))
+async def route_text(message: types.Message):
+    # всё, что не кнопка меню, — комментарий к обходу или исправлению
+    handler = TEXT_ROUTES.get(message.text, handle_text_comment)
+    await handler(message)
+
+
+# ---------- ХЭНДЛЕРЫ ----------
+
+@dp.message(Command("start"))
+async def cmd_start(message: types.Message):
+    logger.info("START from %s", message.from_user.id)
+    await user_states.pop(message.from_user.id)
+
+    await run_db(db_register_user, message.from_user.id, message.from_user.full_name)
+
+    is_admin_user = is_admin(message.from_user.id)
+
+    await message.answer(
+        "Выбери нужное действие",
+        reply_markup=main_menu_kb(is_admin_user),
+    )
+
+
+
+# ===== ОЧИСТКА ИСТОРИИ =====
+
+@text_route("ОЧИСТИТЬ ИСТОРИЮ")
+async def ask_clear_history(message: types.Message):
+    # только для админов
+    if not is_admin(message.from_user.id):
+        await message.answer("У тебя нет прав для очистки истории.")
+        return
+
+    await message.answer(
+        "Выбери период, за который нужно удалить историю обходов и связанных замечаний:",
+        reply_markup=clear_history_kb(),
+    )
+
+
+# Запущенные фоновые очистки (держим ссылки, чтобы задачи не собрал GC)
+CLEAR_TASKS: set[asyncio.Task] = set()
+
+
+async def run_clear_history(message: types.Message, period_text: str, condition, total: int):
+    """
+    Фоновая очистка истории: удаляет обходы пачками по DELETE_BATCH_SIZE
+    короткими транзакциями и по ходу редактирует сообщение админа.
+    """
+    inspections_deleted = issues_deleted = 0
+    last_edit = time.monotonic()
+
+    try:
+        while True:
+            ins_batch, iss_batch = await run_db(
+                db_delete_inspections_batch, condition, DELETE_BATCH_SIZE
+            )
+            inspections_deleted += ins_batch
+            issues_deleted += iss_batch
+            if ins_batch < DELETE_BATCH_SIZE:
+                break
+
+            if time.monotonic() - last_edit >= CLEAR_PROGRESS_INTERVAL:
+                last_edit = time.monotonic()
+                try:
+                    await message.edit_text(
+                        f"Очистка истории {period_text}…\n"
+                        f"Удалено обходов: {inspections_deleted} из {total}\n"
+                        f"Удалено замечаний: {issues_deleted}"
+                    )
+                except Exception:
+                    pass
+
+            # пауза между пачками: даём записать фото тем, кто сейчас на обходе
+            await asyncio.sleep(CLEAR_BATCH_PAUSE)
+    except Exception as e:
+        logger.exception("Ошибка очистки истории: %s", e)
+        try:
+            await message.edit_text(
+                f"Очистка истории прервана из-за ошибки.\n"
+                f"Удалено обходов: {inspections_deleted}\n"
+                f"Удалено замечаний: {issues_deleted}"
+            )
+        except Exception:
+            pass
+        return
+
+    try:
+        await message.edit_text(
+            f"Очистка истории завершена.\n"
+            f"Период: {period_text}.\n"
+            f"Удалено обходов: {inspections_deleted}\n"
+            f"Удалено замечаний: {issues_deleted}"
+        )
+    except Exception:
+        pass
+
+
+@callback_route(ClearHistoryCb)
+async def clear_history_callback(callback: types.CallbackQuery, data: ClearHistoryCb):
+    if not is_admin(callback.from_user.id):
+        await callback.answer("У тебя нет прав для этой операции.", show_alert=True)
+        return
+
+    condition, period_text = clear_history_condition(data.period)
+    total, max_id = await run_db(db_count_inspections, condition)
+
+    if not total:
+        await callback.answer("Под этот период обходов не найдено.", show_alert=True)
+        try:
+            await callback.message.edit_reply_markup(reply_markup=None)
+        except Exception:
+            pass
+        return
+
+    # обходы, начатые уже после нажатия кнопки, не трогаем
+    condition = and_(condition, Inspection.id <= max_id)
+
+    await callback.answer("Очистка истории запущена.")
+    try:
+        await callback.message.edit_text(
+            f"Очистка истории {period_text}…\n"
+            f"Удалено обходов: 0 из {total}"
+        )
+    except Exception:
+        pass
+
+    task = asyncio.create_task(
+        run_clear_history(callback.message, period_text, condition, total)
+    )
+    CLEAR_TASKS.add(task)
+    task.add_done_callback(CLEAR_TASKS.discard)
+
+
+# ===== ОБХОД =====
+
+@text_route("СДЕЛАТЬ ОБХОД")
+async def start_inspection(message: types.Message):
+    logger.info("Сделать обход from %s", message.from_user.id)
+
+    if not is_admin(message.from_user.id):
+        await message.answer(
+            "Сейчас создавать обходы могут только администраторы.\n"
+            "Если нужен обход по отделу — напиши своему администратору 👍",
+            reply_markup=main_menu_kb(False),
+        )
+        return
+
+    await user_states.set(message.from_user.id, {"mode": None})
+    await message.answer(
+        "Выбери отдел, по которому делаешь обход:",
+        reply_markup=departments_kb(InsDeptCb),
+    )
+
+
+@callback_route(InsDeptCb)
+async def choose_inspection_department(callback: types.CallbackQuery, data: InsDeptCb):
+    user_id = callback.from_user.id
+    idx = data.dept_id
 
-    USER_STATE[user_id] = {
+    result = await run_db(db_create_inspection, idx, user_id)
+    if result is None:
+        await callback.answer("Не удалось найти отдел или пользователя.", show_alert=True)
+        return
+
+    inspection_id, dept_name = result
+
+    state = {
         "mode": "inspection",
         "inspection_id": inspection_id,
-        "department_id": dept.id,
+        "department_id": idx,
         "last_issue_id": None,
         "last_issue_cleanup": [],
+        # сообщение с выбором отдела становится панелью прогресса обхода
+        "panel_message_id": callback.message.message_id,
+        "issues_count": 0,
     }
+    await user_states.set(user_id, state)
+    try:
+        await callback.message.edit_text(inspection_panel_text(state))
+    except Exception:
+        state.pop("panel_message_id")
+        await user_states.set(user_id, state)
 
     await callback.message.answer(
-        f"Обход по отделу «{dept.name}».\n\n"
+        f"Обход по отделу «{dept_name}».\n\n"
         "1️⃣ Сфоткай нарушение\n"
         "2️⃣ Потом отправь короткий комментарий текстом.\n"
         "Повтори для всех замечаний.\n\n"
@@ -419,349 +3236,239 @@ async def choose_inspection_department(callback: types.CallbackQuery):
     await callback.answer()
 
 
-@dp.message(F.photo)
-async def handle_photo(message: types.Message):
-    user_id = message.from_user.id
-    state = USER_STATE.get(user_id)
-    if not state:
-        return
-
-    caption = message.caption or ""
+def inspection_panel_text(state: dict, last: str | None = None, finished: bool = False) -> str:
+    dept_name = department_registry.display_name(state["department_id"])
+    if finished:
+        return f"Обход по отделу «{dept_name}» завершён. Замечаний: {state.get('issues_count', 0)}."
+    lines = [f"📋 Обход по отделу «{dept_name}»", f"Замечаний: {state.get('issues_count', 0)}"]
+    if last:
+        lines.append(f"Последнее: {last}")
+    return "\n".join(lines)
 
-    # фото во время обхода
-    if state.get("mode") == "inspection":
-        photo = message.photo[-1]
-        file_id = photo.file_id
 
-        s = get_session()
-        issue = Issue(
-            inspection_id=state["inspection_id"],
-            department_id=state["department_id"],
-            photo_url=file_id,
-            status="open",
-            comment=caption if caption else None,
-        )
-        s.add(issue)
-        s.commit()
-        s.refresh(issue)
-        issue_id = issue.id
-        s.close()
+def short_comment(comment: str, limit: int = 80) -> str:
+    return comment if len(comment) <= limit else comment[: limit - 1] + "…"
 
-        if caption:
-            try:
-                await bot.delete_message(chat_id=user_id, message_id=message.message_id)
-            except Exception:
-                pass
 
-            await bot.send_message(
-                chat_id=user_id,
-                text=f"Замечание #{issue_id} сохранено. Можешь отправить следующее фото или завершить обход.",
-            )
+async def show_inspection_progress(user_id: int, state: dict, last: str):
+    """Обновляет панель обхода; у обходов, начатых до панелей, — отдельным сообщением."""
+    panel_id = state.get("panel_message_id")
+    if panel_id:
+        panel_editor.update(user_id, panel_id, inspection_panel_text(state, last))
+    else:
+        await bot.send_message(chat_id=user_id, text=f"Замечание {last}")
 
-            state["last_issue_id"] = None
-            state["last_issue_cleanup"] = []
-        else:
-            notice_msg = await message.answer(
-                f"Замечание #{issue_id} — фото сохранено. Теперь отправь текст: что тут не так?"
-            )
-            state["last_issue_id"] = issue_id
-            state["last_issue_cleanup"] = [message.message_id, notice_msg.message_id]
 
-        return
+class AlbumCollector:
+    """
+    Собирает фото одного альбома: Telegram присылает каждое фото отдельным
+    апдейтом с общим media_group_id. Альбом считается полным, когда новых фото
+    нет wait секунд; тогда on_complete получает все сообщения разом.
+
+    on_complete выполняется в очереди пользователя (update_serializer.lane),
+    как обычный апдейт. Если следующий апдейт пользователя (комментарий,
+    одиночное фото, «ЗАВЕРШИТЬ ОБХОД») пришёл раньше, он сам завершает
+    альбом через flush_user — альбом сохраняется до этого апдейта.
+    """
 
-    # фото при исправлении
-    elif state.get("mode") == "fix":
-        issue_id = state.get("issue_id")
-        if not issue_id:
+    def __init__(self, wait: float):
+        self.wait = wait
+        self._albums: dict[str, list[types.Message]] = {}
+        self._callbacks: dict[str, object] = {}
+        self._timers: dict[str, asyncio.Task] = {}
+
+    def add(self, message: types.Message, on_complete):
+        key = message.media_group_id
+        self._albums.setdefault(key, []).append(message)
+        self._callbacks[key] = on_complete
+        timer = self._timers.get(key)
+        if timer is not None:
+            timer.cancel()
+        self._timers[key] = asyncio.create_task(self._complete_later(key, message.from_user.id))
+
+    async def _complete_later(self, key: str, user_id: int):
+        await asyncio.sleep(self.wait)
+        async with update_serializer.lane(user_id):
+            await self._complete(key)
+
+    async def _complete(self, key: str):
+        # альбом мог уже завершить flush_user, пока таймер ждал очереди
+        messages = self._albums.pop(key, None)
+        if messages is None:
             return
+        on_complete = self._callbacks.pop(key)
+        timer = self._timers.pop(key, None)
+        if timer is not None and timer is not asyncio.current_task():
+            timer.cancel()
+        try:
+            await on_complete(sorted(messages, key=lambda m: m.message_id))
+        except Exception as e:
+            logger.exception("Не удалось сохранить альбом %s: %s", key, e)
 
-        photo = message.photo[-1]
-        file_id = photo.file_id
+    async def flush_user(self, user_id: int):
+        """Сохраняет недособранные альбомы пользователя. Звать из его апдейта (очередь уже занята)."""
+        for key in [k for k, messages in self._albums.items() if messages[0].from_user.id == user_id]:
+            await self._complete(key)
 
-        # фото + подпись = комментарий, фото без подписи = "(без комментария)"
-        fix_comment = caption if caption else "(без комментария)"
+    async def drain(self):
+        """Дожидается сохранения альбомов, которые ещё собираются."""
+        while self._timers:
+            await asyncio.gather(*self._timers.values(), return_exceptions=True)
 
-        s = get_session()
-        issue = s.query(Issue).filter_by(id=issue_id).first()
-        if not issue:
-            s.close()
-            USER_STATE.pop(user_id, None)
-            await message.answer(
-                "Не нашёл это замечание. Попробуй ещё раз через меню «Исправить замечания»."
-            )
-            return
 
-        original_photo_id = issue.photo_url
-        dept = s.query(Department).filter_by(id=issue.department_id).first()
-        dept_name = dept.name if dept else f"Отдел #{issue.department_id}"
-        original_comment = issue.comment or "(без текста)"
+album_collector = AlbumCollector(ALBUM_WAIT)
 
-        issue.fixed_photo_url = file_id
-        issue.fixed_at = datetime.utcnow()
-        issue.status = "pending"
-        issue.fixed_by_tg_id = message.from_user.id
-        s.commit()
-        s.close()
 
-        cleanup_ids = state.get("cleanup_ids", [])
-        cleanup_ids.append(message.message_id)
-        for mid in cleanup_ids:
-            try:
-                await bot.delete_message(chat_id=user_id, message_id=mid)
-            except Exception:
-                pass
+async def store_inspection_album(messages: list[types.Message]):
+    """Альбом во время обхода: замечание на каждое фото, одна запись в БД и один ответ."""
+    user_id = messages[0].from_user.id
+    state = await user_states.get(user_id)
+    if not state or state.get("mode") != "inspection":
+        return
 
-        USER_STATE.pop(user_id, None)
+    caption = next((m.caption for m in messages if m.caption), None)
+    issue_ids = await issue_buffer.add_album(
+        state["inspection_id"],
+        state["department_id"],
+        [m.photo[-1].file_id for m in messages],
+        caption,
+    )
+    for m in messages:
+        media_store.track(m.photo[-1])
+    numbers = ", ".join(f"#{issue_id}" for issue_id in issue_ids)
+    state["issues_count"] = state.get("issues_count", 0) + len(issue_ids)
 
-        await bot.send_message(
-            chat_id=user_id,
-            text=f"Супер, замечание #{issue_id} отправлено на проверку. Спасибо! 🙌",
-        )
+    if caption:
+        message_cleaner.schedule(user_id, [m.message_id for m in messages])
+        state["last_issue_id"] = None
+        state.pop("last_issue_ids", None)
+        state["last_issue_cleanup"] = []
+        last = f"{numbers} — {short_comment(caption)}"
+    else:
+        state["last_issue_id"] = issue_ids[0]
+        state["last_issue_ids"] = issue_ids
+        state["last_issue_cleanup"] = [m.message_id for m in messages]
+        last = f"{numbers} — жду комментарий текстом (общий для всего альбома)"
 
-        if ADMIN_IDS:
-            for admin_id in ADMIN_IDS:
-                try:
-                    if original_photo_id:
-                        await bot.send_photo(
-                            admin_id,
-                            original_photo_id,
-                            caption=(
-                                f"До исправления. Замечание #{issue_id} по отделу «{dept_name}».\n"
-                                f"{original_comment}"
-                            ),
-                        )
+    await user_states.set(user_id, state)
+    await show_inspection_progress(user_id, state, last)
 
-                    caption_after = (
-                        f"После исправления замечания #{issue_id} по отделу «{dept_name}».\n"
-                        f"Исправил: {message.from_user.full_name}\n\n"
-                        f"Комментарий к исправлению: {fix_comment}"
-                    )
-                    await bot.send_photo(
-                        admin_id,
-                        file_id,
-                        caption=caption_after,
-                        reply_markup=admin_review_kb(issue_id),
-                    )
-                except Exception as e:
-                    logger.exception(
-                        "Не удалось отправить уведомление админу %s: %s",
-                        admin_id,
-                        e,
-                    )
 
-@dp.message(
-    F.text
-    & (~F.text.startswith("/"))
-    & (F.text != "СДЕЛАТЬ ОБХОД")
-    & (F.text != "ИСТОРИЯ ОБХОДОВ")
-    & (F.text != "ОЧИСТИТЬ ИСТОРИЮ")
-    & (F.text != "ЗАВЕРШИТЬ ОБХОД")
-    & (F.text != "НАЗАД")
-    & (F.text != "ИСПРАВИТЬ ЗАМЕЧАНИЯ")
-)
-async def handle_text_comment(message: types.Message):
+@dp.message(F.photo)
+async def handle_photo(message: types.Message):
     user_id = message.from_user.id
-    state = USER_STATE.get(user_id)
+    if not message.media_group_id:
+        # одиночное фото — после альбома, отправленного до него
+        await album_collector.flush_user(user_id)
+    state = await user_states.get(user_id)
     if not state:
         return
 
-    # комментарий к исправлению (после фото без подписи)
-    if state.get("mode") == "fix":
-        issue_id = state.get("issue_id")
-        fixed_photo_id = state.get("fixed_photo_id")
+    caption = message.caption or ""
 
-        if not issue_id:
+    # фото во время обхода
+    if state.get("mode") == "inspection":
+        if message.media_group_id:
+            album_collector.add(message, store_inspection_album)
             return
 
-        # Вариант "только комментарий"
-        if not fixed_photo_id:
-            fix_comment = message.text
-
-            s = get_session()
-            issue = s.query(Issue).filter_by(id=issue_id).first()
-            if not issue:
-                s.close()
-                USER_STATE.pop(user_id, None)
-                await message.answer(
-                    "Не нашёл это замечание. Попробуй ещё раз через меню «Исправить замечания»."
-                )
-                return
-
-            original_photo_id = issue.photo_url
-            dept = s.query(Department).filter_by(id=issue.department_id).first()
-            dept_name = dept.name if dept else f"Отдел #{issue.department_id}"
-            original_comment = issue.comment or "(без текста)"
-
-            issue.fixed_photo_url = None
-            issue.fixed_at = datetime.utcnow()
-            issue.status = "pending"
-            issue.fixed_by_tg_id = message.from_user.id
-            s.commit()
-            s.close()
-
-            cleanup_ids = state.get("cleanup_ids", [])
-            cleanup_ids.append(message.message_id)
-            for mid in cleanup_ids:
-                try:
-                    await bot.delete_message(chat_id=user_id, message_id=mid)
-                except Exception:
-                    pass
-
-            USER_STATE.pop(user_id, None)
-
-            await bot.send_message(
-                chat_id=user_id,
-                text=f"Супер, замечание #{issue_id} отправлено на проверку. Спасибо! 🙌",
-            )
+        photo = message.photo[-1]
+        file_id = photo.file_id
 
-            if ADMIN_IDS:
-                for admin_id in ADMIN_IDS:
-                    try:
-                        if original_photo_id:
-                            await bot.send_photo(
-                                admin_id,
-                                original_photo_id,
-                                caption=(
-                                    f"До исправления. Замечание #{issue_id} по отделу «{dept_name}».\n"
-                                    f"{original_comment}"
-                                ),
-                            )
-
-                        await bot.send_message(
-                            admin_id,
-                            text=(
-                                f"После исправления замечания #{issue_id} по отделу «{dept_name}».\n"
-                                f"Исправил: {message.from_user.full_name}\n\n"
-                                f"Комментарий к исправлению: {fix_comment}\n"
-                                f"Фото после исправления: (не приложено)"
-                            ),
-                            reply_markup=admin_review_kb(issue_id),
-                        )
-                    except Exception as e:
-                        logger.exception(
-                            "Не удалось отправить уведомление админу %s: %s",
-                            admin_id,
-                            e,
-                        )
+        issue_id = await issue_buffer.add(
+            state["inspection_id"],
+            state["department_id"],
+            file_id,
+            caption if caption else None,
+        )
+        media_store.track(photo)
 
-            return
+        state["issues_count"] = state.get("issues_count", 0) + 1
+        if caption:
+            message_cleaner.schedule(user_id, [message.message_id])
+            state["last_issue_id"] = None
+            state.pop("last_issue_ids", None)
+            state["last_issue_cleanup"] = []
+            last = f"#{issue_id} — {short_comment(caption)}"
+        else:
+            state["last_issue_id"] = issue_id
+            state.pop("last_issue_ids", None)
+            state["last_issue_cleanup"] = [message.message_id]
+            last = f"#{issue_id} — фото сохранено, жду комментарий текстом"
 
-        # Старый режим "сначала фото без подписи -> потом текст" (оставляем, чтобы ничего не ломать)
-        fix_comment = message.text
+        await user_states.set(user_id, state)
+        await show_inspection_progress(user_id, state, last)
+        return
 
-        s = get_session()
-        issue = s.query(Issue).filter_by(id=issue_id).first()
-        if not issue:
-            s.close()
-            USER_STATE.pop(user_id, None)
-            await message.answer(
-                "Не нашёл это замечание. Попробуй ещё раз через меню «Исправить замечания»."
-            )
+    # фото при исправлении
+    elif state.get("mode") == "fix":
+        issue_id = state.get("issue_id")
+        if not issue_id:
             return
 
-        original_photo_id = issue.photo_url
-        dept = s.query(Department).filter_by(id=issue.department_id).first()
-        dept_name = dept.name if dept else f"Отдел #{issue.department_id}"
-        original_comment = issue.comment or "(без текста)"
+        photo = message.photo[-1]
+        file_id = photo.file_id
 
-        issue.fixed_photo_url = fixed_photo_id
-        issue.fixed_at = datetime.utcnow()
-        issue.status = "pending"
-        issue.fixed_by_tg_id = message.from_user.id
-        s.commit()
-        s.close()
+        # фото + подпись = комментарий, фото без подписи = "(без комментария)"
+        fix_comment = caption if caption else "(без комментария)"
 
-        cleanup_ids = state.get("cleanup_ids", [])
-        cleanup_ids.append(message.message_id)
-        for mid in cleanup_ids:
-            try:
-                await bot.delete_message(chat_id=user_id, message_id=mid)
-            except Exception:
-                pass
+        media_store.track(photo)
+        await submit_fix(message, state, issue_id, file_id, fix_comment, photo.file_unique_id)
 
-        USER_STATE.pop(user_id, None)
 
-        await bot.send_message(
-            chat_id=user_id,
-            text=f"Супер, замечание #{issue_id} отправлено на проверку. Спасибо! 🙌",
-        )
+async def handle_text_comment(message: types.Message):
+    user_id = message.from_user.id
+    # комментарий к альбому мог прийти раньше, чем альбом собран
+    await album_collector.flush_user(user_id)
+    state = await user_states.get(user_id)
+    if not state:
+        return
 
-        if ADMIN_IDS:
-            for admin_id in ADMIN_IDS:
-                try:
-                    if original_photo_id:
-                        await bot.send_photo(
-                            admin_id,
-                            original_photo_id,
-                            caption=(
-                                f"До исправления. Замечание #{issue_id} по отделу «{dept_name}».\n"
-                                f"{original_comment}"
-                            ),
-                        )
+    # комментарий к исправлению (после фото без подписи)
+    if state.get("mode") == "fix":
+        issue_id = state.get("issue_id")
+        fixed_photo_id = state.get("fixed_photo_id")
 
-                    caption_after = (
-                        f"После исправления замечания #{issue_id} по отделу «{dept_name}».\n"
-                        f"Исправил: {message.from_user.full_name}\n\n"
-                        f"Комментарий к исправлению: {fix_comment}"
-                    )
+        if not issue_id:
+            return
 
-                    await bot.send_photo(
-                        admin_id,
-                        fixed_photo_id,
-                        caption=caption_after,
-                        reply_markup=admin_review_kb(issue_id),
-                    )
-                except Exception as e:
-                    logger.exception(
-                        "Не удалось отправить уведомление админу %s: %s",
-                        admin_id,
-                        e,
-                    )
+        # «только комментарий» (fixed_photo_id нет) или старый режим
+        # «сначала фото без подписи -> потом текст»
+        await submit_fix(
+            message, state, issue_id, fixed_photo_id, message.text, state.get("fixed_photo_unique_id")
+        )
         return
 
     # комментарий к замечанию при обходе
     if state.get("mode") != "inspection" or not state.get("last_issue_id"):
         return
 
-    issue_id = state["last_issue_id"]
-    s = get_session()
-    issue = s.query(Issue).filter_by(id=issue_id).first()
-    if not issue:
-        s.close()
+    # после альбома комментарий общий для всех его фото
+    issue_ids = state.get("last_issue_ids") or [state["last_issue_id"]]
+    saved = await issue_buffer.set_comments(issue_ids, message.text)
+    if not saved:
         state["last_issue_id"] = None
+        state.pop("last_issue_ids", None)
         state["last_issue_cleanup"] = []
+        await user_states.set(user_id, state)
         await message.answer("Не получилось привязать комментарий к замечанию, попробуй ещё раз.")
         return
 
-    issue.comment = message.text
-    s.commit()
-    s.close()
-
-    cleanup_ids = state.get("last_issue_cleanup", [])
-    for mid in cleanup_ids:
-        try:
-            await bot.delete_message(chat_id=user_id, message_id=mid)
-        except Exception:
-            pass
-
-    try:
-        await bot.delete_message(chat_id=user_id, message_id=message.message_id)
-    except Exception:
-        pass
+    message_cleaner.schedule(user_id, state.get("last_issue_cleanup", []) + [message.message_id])
 
     state["last_issue_id"] = None
+    state.pop("last_issue_ids", None)
     state["last_issue_cleanup"] = []
+    await user_states.set(user_id, state)
 
-    await bot.send_message(
-        chat_id=user_id,
-        text="Комментарий сохранён. Можешь отправить следующее фото или завершить обход.",
-    )
+    numbers = ", ".join(f"#{issue_id}" for issue_id in issue_ids)
+    await show_inspection_progress(user_id, state, f"{numbers} — {short_comment(message.text)}")
 
 
-@dp.message(F.text == "ЗАВЕРШИТЬ ОБХОД")
+@text_route("ЗАВЕРШИТЬ ОБХОД")
 async def finish_inspection(message: types.Message):
     user_id = message.from_user.id
-    state = USER_STATE.get(user_id)
+    state = await user_states.get(user_id)
     if not state or state.get("mode") != "inspection":
         await message.answer(
             "У тебя сейчас нет активного обхода.",
@@ -769,70 +3476,39 @@ async def finish_inspection(message: types.Message):
         )
         return
 
-    s = get_session()
-    ins = s.query(Inspection).filter_by(id=state["inspection_id"]).first()
-    dept_name = "неизвестный отдел"
-    inspector_name = message.from_user.full_name
-    ins_date = date.today()
-
-    if ins:
-        ins.status = "completed"
-        s.commit()
-
-        dept = s.query(Department).filter_by(id=ins.department_id).first()
-        if dept:
-            dept_name = dept.name
-
-        inspector = s.query(User).filter_by(id=ins.inspector_id).first()
-        if inspector and inspector.name:
-            inspector_name = inspector.name
-
-        ins_date = ins.date
-
-    issues_count = (
-        s.query(Issue)
-        .filter(Issue.inspection_id == state["inspection_id"])
-        .count()
+    # все замечания обхода (и альбом, который ещё собирается) должны
+    # попасть в БД до подсчёта в уведомлении
+    await album_collector.flush_user(user_id)
+    await issue_buffer.flush()
+    state = await user_states.get(user_id) or state
+    await user_states.pop(user_id)
+    await run_db(
+        db_complete_inspection,
+        state["inspection_id"],
+        message.from_user.full_name,
     )
+    outbox_worker.wake()
 
-    s.close()
-
-    if BALIZAG_CHAT_ID:
-        try:
-            control_date = ins_date + timedelta(days=7)
-
-            text = (
-                f"Завершён обход по бализажу\n"
-                f"📌 Отдел: {dept_name}\n"
-                f"⚠️ Замечаний: {issues_count}\n"
-                f"👷 Аудитор: {inspector_name}\n"
-                f"📅 Дата аудита: {ins_date.strftime('%d.%m.%Y')}\n"
-                f"📍 Исправить до: {control_date.strftime('%d.%m.%Y')}\n"
-                f"🤖 Перейти в бота: @BalisageAudit013_bot"
-            )
-
-            await bot.send_message(
-                chat_id=BALIZAG_CHAT_ID,
-                text=text,
-                message_thread_id=BALIZAG_THREAD_ID,
-                parse_mode=ParseMode.HTML,
-            )
-        except Exception as e:
-            logger.exception(
-                "Не удалось отправить уведомление о завершении обхода в BALIZAG_CHAT_ID: %s",
-                e,
-            )
-
-    USER_STATE.pop(user_id, None)
+    if state.get("panel_message_id"):
+        await panel_editor.finish(
+            user_id, state["panel_message_id"], inspection_panel_text(state, finished=True)
+        )
     await message.answer(
         "Обход завершён. Всё сохранил.",
         reply_markup=main_menu_kb(is_admin(user_id)),
     )
 
 
-@dp.message(F.text == "Отмена")
+@text_route("НАЗАД")
+async def inspection_back(message: types.Message):
+    # «НАЗАД» в меню обхода ничего не делает: обход остаётся активным,
+    # а сама кнопка не должна попасть в замечания как комментарий
+    return
+
+
+@text_route("Отмена")
 async def cancel_any(message: types.Message):
-    USER_STATE.pop(message.from_user.id, None)
+    await user_states.pop(message.from_user.id)
     await message.answer(
         "Действие отменено.",
         reply_markup=main_menu_kb(is_admin(message.from_user.id)),
@@ -841,57 +3517,85 @@ async def cancel_any(message: types.Message):
 
 # ===== ИСПРАВЛЕНИЕ ЗАМЕЧАНИЙ =====
 
-@dp.message(F.text == "ИСПРАВИТЬ ЗАМЕЧАНИЯ")
+@text_route("ИСПРАВИТЬ ЗАМЕЧАНИЯ")
 async def start_fix_text(message: types.Message):
     # если кто-то вдруг сам напишет текстом
     await start_fix_flow(message)
 
 
-@dp.callback_query(lambda c: c.data == "menu:fix")
-async def start_fix_inline(callback: types.CallbackQuery):
-    await start_fix_flow(callback.message)
+@callback_route(MenuCb)
+async def start_fix_inline(callback: types.CallbackQuery, data: MenuCb):
+    if data.action == "fix":
+        await start_fix_flow(callback.message)
     await callback.answer()
 
 
 async def start_fix_flow(message: types.Message):
-    USER_STATE[message.from_user.id] = {"mode": None}
+    await user_states.set(message.from_user.id, {"mode": None})
     await message.answer(
         "Выбери отдел, в котором будешь исправлять замечания:",
-        reply_markup=departments_kb("fix_dept:"),
+        reply_markup=departments_kb(FixDeptCb),
     )
 
 
-@dp.callback_query(lambda c: c.data and c.data.startswith("fix_dept:"))
-async def show_issues_for_fix(callback: types.CallbackQuery):
-    _, idx = callback.data.split(":")
-    idx = int(idx)
-    s = get_session()
-    dept = s.query(Department).filter_by(id=idx).first()
-    if not dept:
-        s.close()
-        await callback.message.answer("Отдел не найден.")
-        await callback.answer()
+def encode_page_cursor(dept_id: int, direction: str, created_at: datetime, issue_id: int) -> FixPageCb:
+    # курсор должен влезть в callback_data (64 байта): время — в микросекундах
+    return FixPageCb(
+        dept_id=dept_id,
+        direction=direction,
+        micros=(created_at - CURSOR_EPOCH) // timedelta(microseconds=1),
+        issue_id=issue_id,
+    )
+
+
+def decode_page_cursor(data: FixPageCb):
+    return CURSOR_EPOCH + timedelta(microseconds=data.micros), data.issue_id
+
+
+def issues_page_kb(dept_id: int, rows, has_before: bool, has_after: bool) -> InlineKeyboardMarkup:
+    builder = InlineKeyboardBuilder()
+    for it in rows:
+        builder.button(text=f"✅ Исправлено #{it.id}", callback_data=FixIssueCb(issue_id=it.id))
+    nav = []
+    if has_before:
+        cursor = encode_page_cursor(dept_id, "p", rows[0].created_at, rows[0].id)
+        builder.button(text="⬅️ Назад", callback_data=cursor)
+        nav.append(1)
+    if has_after:
+        cursor = encode_page_cursor(dept_id, "n", rows[-1].created_at, rows[-1].id)
+        builder.button(text="Дальше ➡️", callback_data=cursor)
+        nav.append(1)
+    builder.adjust(*([1] * len(rows)), len(nav) or 1)
+    return builder.as_markup()
+
+
+async def send_issues_page(chat_id: int, dept_id: int, cursor=None, backward: bool = False):
+    """
+    Отправляет одну страницу открытых замечаний отдела: фото одним альбомом
+    (send_media_group) и одно сообщение со списком, кнопками и навигацией.
+    """
+    dept_name = department_registry.name(dept_id)
+    if not dept_name:
+        await bot.send_message(chat_id, "Отдел не найден.")
         return
 
-    issues = (
-        s.query(Issue)
-        .filter(
-            Issue.department_id == dept.id,
-            Issue.status.in_(["open", "pending"]),
-        )
-        .order_by(Issue.created_at.asc())
-        .all()
+    rows, has_before, has_after, total = await run_db(
+        db_open_issues_page, dept_id, cursor, backward, FIX_PAGE_SIZE
     )
-    s.close()
 
-    if not issues:
-        await callback.message.answer(f"По отделу «{dept.name}» открытых замечаний нет.")
-        await callback.answer()
+    if not rows:
+        if cursor is None:
+            await bot.send_message(chat_id, f"По отделу «{dept_name}» открытых замечаний нет.")
+        else:
+            await bot.send_message(chat_id, f"По отделу «{dept_name}» больше открытых замечаний нет.")
         return
 
-    await callback.message.answer(f"Открытые замечания по отделу «{dept.name}»:")
+    photo_rows = [it for it in rows if it.photo_url]
+    failed = await media_store.send_album(chat_id, [(it.photo_url, f"#{it.id}") for it in photo_rows])
+    unavailable = {it.id for it in photo_rows if it.photo_url in failed}
 
-    for it in issues:
+    lines = [f"Открытые замечания по отделу «{dept_name}» (всего {total}):", ""]
+    for it in rows:
         if it.status == "open":
             status_ru = "открыто"
         elif it.status == "pending":
@@ -899,39 +3603,39 @@ async def show_issues_for_fix(callback: types.CallbackQuery):
         else:
             status_ru = it.status
 
-        text = (
-            f"#{it.id}\n"
-            f"{it.comment or '(без текста)'}\n"
-            f"Статус: {status_ru}"
-        )
-        if it.photo_url:
-            try:
-                await bot.send_photo(
-                    callback.from_user.id,
-                    it.photo_url,
-                    caption=text,
-                    reply_markup=fix_issue_kb(it.id),
-                )
-            except Exception:
-                await bot.send_message(
-                    callback.from_user.id,
-                    text + "\n(фото недоступно)",
-                    reply_markup=fix_issue_kb(it.id),
-                )
-        else:
-            await bot.send_message(
-                callback.from_user.id,
-                text,
-                reply_markup=fix_issue_kb(it.id),
-            )
+        lines.append(f"#{it.id} — {status_ru}")
+        lines.append(it.comment or "(без текста)")
+        if it.id in unavailable:
+            lines.append("(фото недоступно)")
+        lines.append("")
+
+    await bot.send_message(
+        chat_id,
+        "\n".join(lines).rstrip(),
+        reply_markup=issues_page_kb(dept_id, rows, has_before, has_after),
+    )
+
+
+@callback_route(FixDeptCb)
+async def show_issues_for_fix(callback: types.CallbackQuery, data: FixDeptCb):
+    await send_issues_page(callback.from_user.id, data.dept_id)
+    await callback.answer()
 
+
+@callback_route(FixPageCb)
+async def show_issues_page(callback: types.CallbackQuery, data: FixPageCb):
+    await send_issues_page(
+        callback.from_user.id,
+        data.dept_id,
+        cursor=decode_page_cursor(data),
+        backward=data.direction == "p",
+    )
     await callback.answer()
 
 
-@dp.callback_query(lambda c: c.data and c.data.startswith("fix:"))
-async def mark_issue_fixed(callback: types.CallbackQuery):
-    _, issue_id_str = callback.data.split(":")
-    issue_id = int(issue_id_str)
+@callback_route(FixIssueCb)
+async def mark_issue_fixed(callback: types.CallbackQuery, data: FixIssueCb):
+    issue_id = data.issue_id
 
     prompt_msg = await callback.message.answer(
         f"Исправление для замечания #{issue_id}.\n"
@@ -941,75 +3645,96 @@ async def mark_issue_fixed(callback: types.CallbackQuery):
         "3) фото + комментарий (в подписи)\n"
     )
 
-    USER_STATE[callback.from_user.id] = {
-        "mode": "fix",
-        "issue_id": issue_id,
-        "cleanup_ids": [callback.message.message_id, prompt_msg.message_id],
-        "fixed_photo_id": None,
-    }
+    await user_states.set(
+        callback.from_user.id,
+        {
+            "mode": "fix",
+            "issue_id": issue_id,
+            # сообщение со страницей замечаний не трогаем — там кнопки других замечаний
+            "cleanup_ids": [prompt_msg.message_id],
+            "fixed_photo_id": None,
+        },
+    )
 
     await callback.answer()
 
 
-@dp.callback_query(lambda c: c.data and c.data.startswith("approve:"))
-async def approve_issue(callback: types.CallbackQuery):
+async def submit_fix(
+    message: types.Message,
+    state: dict,
+    issue_id: int,
+    photo_id,
+    comment: str,
+    photo_unique_id: str | None = None,
+):
+    """
+    Общий конвейер отправки исправления для всех трёх вариантов (фото с
+    подписью, только комментарий, фото и потом текст): одна транзакция в БД
+    (статус + уведомления админам в outbox), затем одновременно чистим
+    сообщения диалога, отвечаем пользователю и будим outbox.
+    """
+    user_id = message.from_user.id
+    submitted = await run_db(
+        db_submit_fix,
+        issue_id,
+        photo_id,
+        user_id,
+        message.from_user.full_name,
+        comment,
+        photo_unique_id,
+    )
+    await user_states.pop(user_id)
+    if not submitted:
+        await message.answer(
+            "Это замечание не найдено или уже закрыто. Посмотри актуальный список в меню «Исправить замечания»."
+        )
+        return
+
+    outbox_worker.wake()
+    deadline_scheduler.forget(issue_id)
+    message_cleaner.schedule(user_id, state.get("cleanup_ids", []) + [message.message_id])
+    await bot.send_message(
+        chat_id=user_id,
+        text=f"Супер, замечание #{issue_id} отправлено на проверку. Спасибо! 🙌",
+    )
+
+
+def delete_review_messages(review_msg: types.Message, single: bool = False):
+    # карточка с кнопками и фото «до», отправленное перед ней (у коллажа его нет)
+    ids = [review_msg.message_id] if single else [review_msg.message_id - 1, review_msg.message_id]
+    message_cleaner.schedule(review_msg.chat.id, ids)
+
+
+@callback_route(ApproveCb)
+async def approve_issue(callback: types.CallbackQuery, data: ApproveCb):
     if not is_admin(callback.from_user.id):
         await callback.answer("Эта кнопка только для админов.", show_alert=True)
         return
 
-    _, issue_id_str = callback.data.split(":")
-    issue_id = int(issue_id_str)
+    issue_id = data.issue_id
+    single = data.single
 
-    s = get_session()
-    issue = s.query(Issue).filter_by(id=issue_id).first()
-    if not issue:
-        s.close()
+    approved = await run_db(db_approve_issue, issue_id)
+    if not approved:
         await callback.answer("Это замечание уже обработано.")
-        try:
-            await callback.message.delete()
-        except Exception:
-            pass
-        try:
-            await bot.delete_message(
-                chat_id=callback.message.chat.id,
-                message_id=callback.message.message_id - 1,
-            )
-        except Exception:
-            pass
+        delete_review_messages(callback.message, single)
         return
 
-    issue.status = "fixed"
-    s.commit()
-    s.close()
-
     await callback.answer("Замечание закрыто. 👍")
 
-    try:
-        await callback.message.delete()
-    except Exception:
-        pass
-    try:
-        await bot.delete_message(
-            chat_id=callback.message.chat.id,
-            message_id=callback.message.message_id - 1,
-        )
-    except Exception:
-        pass
+    delete_review_messages(callback.message, single)
 
 
-@dp.callback_query(lambda c: c.data and c.data.startswith("return:"))
-async def return_issue_to_work(callback: types.CallbackQuery):
+@callback_route(ReturnCb)
+async def return_issue_to_work(callback: types.CallbackQuery, data: ReturnCb):
     if not is_admin(callback.from_user.id):
         await callback.answer("Эта кнопка только для админов.", show_alert=True)
         return
 
-    _, issue_id_str = callback.data.split(":")
-    issue_id = int(issue_id_str)
+    issue_id = data.issue_id
 
-    s = get_session()
-    issue = s.query(Issue).filter_by(id=issue_id).first()
-    if not issue:
-        s.close()
+    returned = await run_db(db_return_issue, issue_id)
+    if not returned:
         await callback.answer("Это замечание уже обработано.")
         try:
             await callback.message.edit_reply_markup(reply_markup=None)
@@ -1017,17 +3742,8 @@ async def return_issue_to_work(callback: types.CallbackQuery):
             pass
         return
 
-    fixed_by_tg_id = issue.fixed_by_tg_id
-    comment_text = issue.comment or "(без текста)"
-
-    dept = s.query(Department).filter_by(id=issue.department_id).first()
-    dept_name = dept.name if dept else f"Отдел #{issue.department_id}"
-
-    issue.status = "open"
-    issue.fixed_photo_url = None
-    issue.fixed_at = None
-    s.commit()
-    s.close()
+    outbox_worker.wake()
+    await deadline_scheduler.refresh([issue_id])
 
     await callback.answer("Замечание возвращено в работу.")
     try:
@@ -1035,46 +3751,103 @@ async def return_issue_to_work(callback: types.CallbackQuery):
     except Exception:
         pass
 
-    if fixed_by_tg_id:
+
+def digest_button_issue(button: types.InlineKeyboardButton) -> int | None:
+    """issue_id кнопки сводки; None — «Принять все» или чужая кнопка."""
+    data = button.callback_data or ""
+    factory = {DigestOkCb.__prefix__: DigestOkCb, DigestRetCb.__prefix__: DigestRetCb}.get(
+        data.partition(":")[0]
+    )
+    if factory is None:
+        return None
+    return unpack_callback(factory, data).issue_id
+
+
+def drop_digest_buttons(markup: InlineKeyboardMarkup, issue_id: int) -> InlineKeyboardMarkup | None:
+    """Убирает из клавиатуры сводки кнопки одного замечания (и «Принять все», если больше нечего)."""
+    rows = [
+        [b for b in row if digest_button_issue(b) != issue_id]
+        for row in markup.inline_keyboard
+    ]
+    rows = [row for row in rows if row]
+    if len(rows) <= 1:
+        return None
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+
+@callback_route(DigestOkCb)
+async def approve_from_digest(callback: types.CallbackQuery, data: DigestOkCb):
+    if not is_admin(callback.from_user.id):
+        await callback.answer("Эта кнопка только для админов.", show_alert=True)
+        return
+
+    digest_id = data.digest_id
+
+    # одно замечание из сводки
+    if data.issue_id is not None:
+        issue_id = data.issue_id
+        approved = await run_db(db_approve_issue, issue_id)
+        await callback.answer("Замечание закрыто. 👍" if approved else "Это замечание уже обработано.")
         try:
-            await bot.send_message(
-                chat_id=fixed_by_tg_id,
-                text=(
-                    f"Твоё исправление по замечанию #{issue_id} вернули в работу.\n"
-                    f"Отдел: {dept_name}\n"
-                    f"Текст замечания: {comment_text}\n\n"
-                    "Пожалуйста, проверь ещё раз и исправь️🙂"
-                ),
-            )
-        except Exception as e:
-            logger.exception(
-                "Не удалось отправить уведомление сотруднику %s: %s",
-                fixed_by_tg_id,
-                e,
+            await callback.message.edit_reply_markup(
+                reply_markup=drop_digest_buttons(callback.message.reply_markup, issue_id)
             )
+        except Exception:
+            pass
+        return
+
+    approved = await run_db(db_approve_digest, digest_id)
+    if approved:
+        await callback.answer(f"Закрыто замечаний: {len(approved)}. 👍")
+        summary = "✅ Приняты: " + ", ".join(f"#{issue_id}" for issue_id in approved)
+    else:
+        await callback.answer("Все замечания сводки уже обработаны.")
+        summary = "Все замечания сводки уже обработаны."
+    try:
+        await callback.message.edit_text(
+            f"{callback.message.text}\n\n{summary}", reply_markup=None
+        )
+    except Exception:
+        pass
+
+
+@callback_route(DigestRetCb)
+async def return_from_digest(callback: types.CallbackQuery, data: DigestRetCb):
+    if not is_admin(callback.from_user.id):
+        await callback.answer("Эта кнопка только для админов.", show_alert=True)
+        return
+
+    issue_id = data.issue_id
+
+    returned = await run_db(db_return_issue, issue_id)
+    if returned:
+        outbox_worker.wake()
+        await deadline_scheduler.refresh([issue_id])
+    await callback.answer("Замечание возвращено в работу." if returned else "Это замечание уже обработано.")
+    try:
+        await callback.message.edit_reply_markup(
+            reply_markup=drop_digest_buttons(callback.message.reply_markup, issue_id)
+        )
+    except Exception:
+        pass
 
 
 # ===== ИСТОРИЯ ОБХОДОВ =====
-@dp.message(F.text == "ИСТОРИЯ ОБХОДОВ")
+@text_route("ИСТОРИЯ ОБХОДОВ")
 async def history(message: types.Message):
     # только для админов
     if not is_admin(message.from_user.id):
         await message.answer("У тебя нет прав для просмотра истории.")
         return
 
-    s = get_session()
-    inspections = s.query(Inspection).all()
-    issues = s.query(Issue).all()
-
-    total_inspections = len(inspections)
-    completed = sum(1 for i in inspections if i.status == "completed")
-    active = total_inspections - completed
-
-    total_issues = len(issues)
-    open_issues = sum(1 for it in issues if it.status in ("open", "pending"))
-    closed_issues = sum(1 for it in issues if it.status == "fixed")
-
-    s.close()
+    (
+        total_inspections,
+        completed,
+        active,
+        total_issues,
+        open_issues,
+        closed_issues,
+    ) = await run_db(db_history_stats)
 
     lines = []
     lines.append("*Общая статистика*")
@@ -1093,37 +3866,30 @@ async def history(message: types.Message):
     await message.answer(
         text,
         parse_mode="Markdown",
-        reply_markup=departments_kb("hist_dept:"),
+        reply_markup=departments_kb(HistDeptCb),
     )
 
 
-@dp.callback_query(lambda c: c.data and c.data.startswith("hist_dept:"))
-async def history_by_department(callback: types.CallbackQuery):
-    _, idx = callback.data.split(":")
-    dept_id = int(idx)
+@callback_route(HistDeptCb)
+async def history_by_department(callback: types.CallbackQuery, data: HistDeptCb):
+    dept_id = data.dept_id
 
-    s = get_session()
-    dept = s.query(Department).filter_by(id=dept_id).first()
-    if not dept:
-        s.close()
+    dept_name = department_registry.name(dept_id)
+    if not dept_name:
         await callback.answer("Отдел не найден.", show_alert=True)
         return
 
-    inspections = s.query(Inspection).filter_by(department_id=dept.id).all()
-    issues = s.query(Issue).filter_by(department_id=dept.id).all()
-
-    total_inspections = len(inspections)
-    completed = sum(1 for i in inspections if i.status == "completed")
-    active = total_inspections - completed
-
-    total_issues = len(issues)
-    open_issues = sum(1 for it in issues if it.status in ("open", "pending"))
-    closed_issues = sum(1 for it in issues if it.status == "fixed")
-
-    s.close()
+    (
+        total_inspections,
+        completed,
+        active,
+        total_issues,
+        open_issues,
+        closed_issues,
+    ) = await run_db(db_history_stats, dept_id)
 
     lines = []
-    lines.append(f"*{dept.name}*")
+    lines.append(f"*{dept_name}*")
     lines.append(f"Обходов: *{total_inspections}*")
     lines.append(f"✔ Завершено: *{completed}*")
     lines.append(f"🟡 Активных: *{active}*")
@@ -1137,13 +3903,328 @@ async def history_by_department(callback: types.CallbackQuery):
     await callback.answer()
 
 
+# ===== СОСТОЯНИЕ БОТА =====
+
+@dp.message(Command("status"))
+async def cmd_status(message: types.Message):
+    if not is_admin(message.from_user.id):
+        return
+
+    lines = []
+    lines.extend(retention_job.status_lines())
+    lines.extend(issue_buffer.status_lines())
+    lines.extend(update_serializer.status_lines())
+    lines.extend(outbound_scheduler.status_lines())
+    lines.extend(await outbox_worker.status_lines())
+    lines.extend(deadline_scheduler.status_lines())
+    lines.extend(message_cleaner.status_lines())
+    lines.extend(panel_editor.status_lines())
+    lines.extend(collage_renderer.status_lines())
+    lines.extend(media_store.status_lines())
+    lines.extend(await user_states.status_lines())
+    await message.answer("\n".join(lines))
+
+
 # ===== ЗАПУСК =====
 
+# Фоновые задачи, живущие всё время работы бота
+BACKGROUND_TASKS: list[asyncio.Task] = []
+
+
+@dp.startup()
+async def on_startup():
+    await run_db(department_registry.load)
+    # и журналы процессов, если прошлый запуск был с --workers
+    await run_db(issue_buffer.recover, issue_journals())
+    BACKGROUND_TASKS.append(asyncio.create_task(retention_job.run_forever()))
+    BACKGROUND_TASKS.append(asyncio.create_task(outbox_worker.run_forever()))
+    BACKGROUND_TASKS.append(asyncio.create_task(deadline_scheduler.run_forever()))
+
+
+@dp.shutdown()
+async def on_shutdown():
+    await album_collector.drain()
+    await issue_buffer.flush()
+    await message_cleaner.drain()
+    collage_renderer.shutdown()
+    for task in BACKGROUND_TASKS:
+        task.cancel()
+    await asyncio.gather(*BACKGROUND_TASKS, return_exceptions=True)
+    BACKGROUND_TASKS.clear()
+
+
 async def main():
+    await run_db(migrate_db)
     logger.info("Bot started")
-    await dp.start_polling(bot)
+    try:
+        await dp.start_polling(bot)
+    finally:
+        db_executor.shutdown(wait=True)
+
+
+def build_webhook_app(path: str, base_url: str | None) -> web.Application:
+    """
+    aiohttp-приложение для режима webhook. Апдейт с неверным
+    X-Telegram-Bot-Api-Secret-Token отклоняется, верный — сразу получает
+    200 OK, а хэндлеры выполняются в фоне (handle_in_background).
+    Если задан base_url, при старте регистрирует webhook в Telegram.
+    """
+    app = web.Application()
+
+    async def on_startup(_app: web.Application):
+        await run_db(migrate_db)
+        if base_url:
+            await bot.set_webhook(
+                base_url.rstrip("/") + path,
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=dp.resolve_used_update_types(),
+            )
+        logger.info("Bot started (webhook %s)", path)
+
+    async def on_cleanup(_app: web.Application):
+        db_executor.shutdown(wait=True)
+
+    # миграции — до запуска фоновых задач диспетчера (setup_application)
+    app.on_startup.append(on_startup)
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        handle_in_background=True,
+        secret_token=WEBHOOK_SECRET,
+    ).register(app, path=path)
+    setup_application(app, dp, bot=bot)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+
+# ===== НЕСКОЛЬКО ПРОЦЕССОВ =====
+# Главный процесс только получает апдейты (polling или webhook) и раскладывает
+# их по N процессам-обработчикам по from_user.id: апдейты одного пользователя
+# всегда попадают в один процесс и идут по порядку, разные пользователи
+# обрабатываются параллельно на всех ядрах. Состояния — в общем хранилище
+# (STATE_BACKEND=sqlite/redis), данные — в общей БД.
+
+def update_shard_key(update: dict) -> int:
+    """tg_id автора апдейта (или id чата), по которому выбирается процесс."""
+    for key, value in update.items():
+        if key == "update_id" or not isinstance(value, dict):
+            continue
+        if isinstance(value.get("from"), dict):
+            return value["from"]["id"]
+        if isinstance(value.get("chat"), dict):
+            return value["chat"]["id"]
+    return 0
+
+
+def update_to_raw(update: types.Update) -> dict:
+    # by_alias: ключи как в Bot API ("from", а не "from_user") —
+    # по ним update_shard_key находит автора апдейта
+    return update.model_dump(mode="json", exclude_none=True, by_alias=True)
+
+
+def route_update(update: dict, queues: list):
+    queues[update_shard_key(update) % len(queues)].put(update)
+
+
+def run_worker(index: int, queue, workers: int):
+    """Точка входа процесса-обработчика."""
+    asyncio.run(worker_loop(index, queue, workers))
+
+
+async def worker_loop(index: int, queue, workers: int):
+    # общий лимит Telegram делим между процессами
+    outbound_scheduler.global_bucket = TokenBucket(TG_GLOBAL_RATE / workers, TG_GLOBAL_RATE / workers)
+    await run_db(department_registry.load)
+    # у каждого процесса свой журнал буфера замечаний
+    issue_buffer.path = f"{ISSUE_JOURNAL}.{index}"
+    await run_db(issue_buffer.recover)
+    BACKGROUND_TASKS.append(asyncio.create_task(outbox_worker.run_forever()))
+    # куча сроков у каждого процесса своя; второе напоминание о том же
+    # замечании отсечёт db_remind_overdue
+    BACKGROUND_TASKS.append(asyncio.create_task(deadline_scheduler.run_forever()))
+    logger.info("Обработчик #%s запущен (pid %s)", index, os.getpid())
+
+    loop = asyncio.get_running_loop()
+    tasks: set[asyncio.Task] = set()
+    try:
+        while True:
+            update = await loop.run_in_executor(None, queue.get)
+            if update is None:
+                break
+            task = asyncio.create_task(dp.feed_raw_update(bot, update))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        await asyncio.gather(*tasks, return_exceptions=True)
+    finally:
+        await on_shutdown()
+        await bot.session.close()
+        db_executor.shutdown(wait=True)
+
+
+def start_workers(workers: int) -> tuple[list, list]:
+    ctx = multiprocessing.get_context("spawn")
+    queues = [ctx.Queue() for _ in range(workers)]
+    processes = [
+        ctx.Process(target=run_worker, args=(i, queues[i], workers), name=f"bot-worker-{i}")
+        for i in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    return queues, processes
+
+
+def stop_workers(queues: list, processes: list):
+    for queue in queues:
+        queue.put(None)
+    for process in processes:
+        process.join()
+
+
+async def poll_to_workers(queues: list):
+    """Long polling в главном процессе: апдейты не обрабатываются, а раздаются."""
+    BACKGROUND_TASKS.append(asyncio.create_task(retention_job.run_forever()))
+    allowed_updates = dp.resolve_used_update_types()
+    offset = None
+    try:
+        while True:
+            try:
+                updates = await bot.get_updates(
+                    offset=offset, timeout=30, allowed_updates=allowed_updates
+                )
+            except Exception as e:
+                logger.exception("Ошибка получения апдейтов: %s", e)
+                await asyncio.sleep(5)
+                continue
+            for update in updates:
+                offset = update.update_id + 1
+                route_update(update_to_raw(update), queues)
+    finally:
+        await on_shutdown()
+        await bot.session.close()
+
+
+def build_router_app(path: str, base_url: str | None, queues: list) -> web.Application:
+    """Webhook главного процесса: проверяет секрет и сразу отдаёт апдейт обработчику."""
+    app = web.Application()
+
+    async def handle(request: web.Request) -> web.Response:
+        if request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+            return web.Response(status=401)
+        route_update(await request.json(), queues)
+        return web.json_response({})
+
+    async def on_startup(_app: web.Application):
+        BACKGROUND_TASKS.append(asyncio.create_task(retention_job.run_forever()))
+        if base_url:
+            await bot.set_webhook(
+                base_url.rstrip("/") + path,
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=dp.resolve_used_update_types(),
+            )
+
+    async def on_cleanup(_app: web.Application):
+        await on_shutdown()
+        await bot.session.close()
+
+    app.router.add_post(path, handle)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+
+def run_multiprocess(args):
+    migrate_db()
+    # журналы буфера замечаний от прошлого запуска (в т.ч. с другим числом процессов)
+    issue_buffer.recover(issue_journals())
+    queues, processes = start_workers(args.workers)
+    try:
+        if args.mode == "webhook":
+            web.run_app(
+                build_router_app(args.webhook_path, args.webhook_url, queues),
+                host=args.host,
+                port=args.port,
+            )
+        else:
+            asyncio.run(poll_to_workers(queues))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_workers(queues, processes)
+
+
+def report_stats_drift(fix: bool) -> int:
+    drift = db_verify_stats(fix=fix)
+    for dept_id, entity, status, stored, actual in drift:
+        print(f"отдел {dept_id}, {entity}/{status}: в счётчике {stored}, на самом деле {actual}")
+    if not drift:
+        print("Счётчики department_stats совпадают с данными.")
+        return 0
+    if fix:
+        print(f"Счётчики перестроены, исправлено расхождений: {len(drift)}.")
+        return 0
+    return 1
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Бот обходов по бализажу")
+    parser.add_argument(
+        "--verify-stats",
+        action="store_true",
+        help="сверить счётчики department_stats с данными и выйти",
+    )
+    parser.add_argument(
+        "--rebuild-stats",
+        action="store_true",
+        help="пересчитать счётчики department_stats по данным и выйти",
+    )
+    parser.add_argument(
+        "--migrate",
+        action="store_true",
+        help="применить миграции схемы БД и выйти",
+    )
+    parser.add_argument(
+        "--mode",
+        choices=("polling", "webhook"),
+        default=BOT_MODE,
+        help="как получать апдейты: long polling или webhook (aiohttp-сервер)",
+    )
+    parser.add_argument("--host", default=WEBHOOK_HOST, help="адрес для webhook-сервера")
+    parser.add_argument("--port", type=int, default=WEBHOOK_PORT, help="порт для webhook-сервера")
+    parser.add_argument("--webhook-path", default=WEBHOOK_PATH, help="путь webhook")
+    parser.add_argument(
+        "--webhook-url",
+        default=WEBHOOK_URL,
+        help="внешний адрес (https://...), по которому Telegram достучится до сервера",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=WORKERS,
+        help="сколько процессов-обработчиков запустить (апдейты делятся по пользователю)",
+    )
+    args = parser.parse_args()
+
+    if args.migrate:
+        migrate_db()
+        sys.exit(0)
+
+    if args.verify_stats or args.rebuild_stats:
+        migrate_db()
+        sys.exit(report_stats_drift(fix=args.rebuild_stats))
+
+    if args.mode == "webhook" and not WEBHOOK_SECRET:
+        parser.error("для режима webhook нужен WEBHOOK_SECRET")
+
     print("Бот запущен. Нажми Ctrl+C для остановки.")
-    asyncio.run(main())
+    if args.workers > 1:
+        if STATE_BACKEND == "memory":
+            parser.error("для нескольких процессов нужен общий STATE_BACKEND (sqlite или redis)")
+        run_multiprocess(args)
+    elif args.mode == "webhook":
+        web.run_app(
+            build_webhook_app(args.webhook_path, args.webhook_url),
+            host=args.host,
+            port=args.port,
+        )
+    else:
+        asyncio.run(main())
@@ -0,0 +1,44 @@
+"""
+Отрисовка коллажа «ДО / ПОСЛЕ» для процессов CollageRenderer (bot.py).
+
+Отдельный модуль без импорта bot.py: процесс пула загружает только его
+и Pillow, а не бота, движок БД и диспетчер.
+"""
+
+from io import BytesIO
+
+
+def render_collage(before: bytes, after: bytes, title: str, font_name: str) -> bytes:
+    """
+    Склеивает два фото бок о бок с подписью сверху. Выполняется в отдельном
+    процессе, поэтому только байты на входе и выходе.
+    """
+    from PIL import Image, ImageDraw, ImageFont
+
+    height = 720
+    gap = 12
+    header = 64
+
+    images = []
+    for data in (before, after):
+        img = Image.open(BytesIO(data)).convert("RGB")
+        img = img.resize((max(1, img.width * height // img.height), height))
+        images.append(img)
+
+    width = images[0].width + gap + images[1].width
+    canvas = Image.new("RGB", (width, header + height), "white")
+    canvas.paste(images[0], (0, header))
+    canvas.paste(images[1], (images[0].width + gap, header))
+
+    try:
+        font = ImageFont.truetype(font_name, 32)
+    except OSError:
+        font = ImageFont.load_default()
+    draw = ImageDraw.Draw(canvas)
+    draw.text((16, 14), title, fill="black", font=font)
+    for x, label in ((16, "ДО"), (images[0].width + gap + 16, "ПОСЛЕ")):
+        draw.text((x, header + 12), label, fill="white", font=font, stroke_width=3, stroke_fill="black")
+
+    out = BytesIO()
+    canvas.save(out, "JPEG", quality=85)
+    return out.getvalue()
@@ -0,0 +1,46 @@
+import asyncio
+import os
+import sys
+import tempfile
+
+import pytest
+
+# bot.py читает настройки при импорте: отдельная БД и журнал на прогон тестов
+_TMP = tempfile.mkdtemp(prefix="botbalitest-")
+os.environ["TOKEN"] = "123456:TEST-TOKEN"
+os.environ["DATABASE_URL"] = f"sqlite:///{_TMP}/test.db"
+os.environ["ISSUE_JOURNAL"] = os.path.join(_TMP, "issues.journal")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot  # noqa: E402
+
+from tests.telegram_stub import TelegramStub  # noqa: E402
+
+
+@pytest.fixture(scope="session", autouse=True)
+def database():
+    bot.migrate_db()
+    bot.department_registry.load()
+
+
+@pytest.fixture(scope="session")
+def telegram():
+    stub = TelegramStub().start()
+    yield stub
+    stub.stop()
+
+
+@pytest.fixture
+def run(telegram):
+    """Выполняет корутину в новом event loop; запросы бота уходят в заглушку Bot API."""
+    def runner(coro):
+        async def main():
+            original = bot.bot.session
+            bot.bot.session = telegram.session()
+            try:
+                return await coro
+            finally:
+                await bot.bot.session.close()
+                bot.bot.session = original
+        return asyncio.run(main())
+    return runner
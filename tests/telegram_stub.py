@@ -0,0 +1,170 @@
+"""
+Локальная заглушка Bot API для тестов и бенчмарков.
+
+Поднимает aiohttp-сервер в отдельном потоке, отвечает на методы Bot API
+правдоподобными результатами и запоминает каждый вызов (метод, параметры,
+время). Файлы из files отдаются через getFile и /file/bot<token>/<path>;
+фото с file_id из dead_files Telegram «не узнаёт» (400, как у чужого бота),
+а failures задаёт, сколько следующих вызовов метода завершатся ошибкой.
+Бот направляется сюда сессией из session().
+"""
+
+import asyncio
+import json
+import threading
+import time
+
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiohttp import web
+
+
+def _message(chat_id, message_id: int) -> dict:
+    return {
+        "message_id": message_id,
+        "date": int(time.time()),
+        "chat": {"id": int(chat_id or 0), "type": "private"},
+    }
+
+
+def _photo_message(chat_id, message_id: int) -> dict:
+    # новый file_id, как у фото, загруженного файлом
+    photo = {"file_id": f"sent-{message_id}", "file_unique_id": f"u-sent-{message_id}", "width": 1280, "height": 960}
+    return {**_message(chat_id, message_id), "photo": [photo]}
+
+
+class TelegramStub:
+    def __init__(self, files: dict[str, bytes] | None = None):
+        self.files = dict(files or {})
+        self.dead_files: set[str] = set()
+        # метод -> сколько следующих вызовов ответить ошибкой
+        self.failures: dict[str, int] = {}
+        self.calls: list[tuple[str, dict, float]] = []
+        self._lock = threading.Lock()
+        self._message_id = 0
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._runner: web.AppRunner | None = None
+        self._thread: threading.Thread | None = None
+        self.url = ""
+
+    # ----- вызовы -----
+
+    def called(self, method: str) -> list[dict]:
+        with self._lock:
+            return [params for name, params, _ in self.calls if name == method]
+
+    def calls_of(self, method: str) -> list[tuple[dict, float]]:
+        """Вызовы method: [(параметры, time.perf_counter() в момент запроса)]."""
+        with self._lock:
+            return [(params, at) for name, params, at in self.calls if name == method]
+
+    def wait_calls(self, method: str, count: int, timeout: float = 10) -> list[tuple[dict, float]]:
+        """Ждёт count вызовов method (из другого потока или процесса)."""
+        deadline = time.monotonic() + timeout
+        while True:
+            found = self.calls_of(method)
+            if len(found) >= count or time.monotonic() > deadline:
+                return found
+            time.sleep(0.005)
+
+    def _next_message_id(self) -> int:
+        with self._lock:
+            self._message_id += 1
+            return self._message_id
+
+    # ----- сервер -----
+
+    def _sends_dead_file(self, method: str, params: dict) -> bool:
+        if method == "sendPhoto":
+            return params.get("photo") in self.dead_files
+        if method == "sendMediaGroup":
+            return any(m["media"] in self.dead_files for m in json.loads(params["media"]))
+        return False
+
+    def _result(self, method: str, params: dict):
+        chat_id = params.get("chat_id")
+        if method == "sendPhoto":
+            return _photo_message(chat_id, self._next_message_id())
+        if method in ("sendMessage", "sendDocument", "editMessageText", "copyMessage"):
+            return _message(chat_id, self._next_message_id())
+        if method == "sendMediaGroup":
+            return [_photo_message(chat_id, self._next_message_id()) for _ in json.loads(params["media"])]
+        if method == "getMe":
+            return {"id": 123456, "is_bot": True, "first_name": "stub", "username": "stub_bot"}
+        if method == "getFile":
+            file_id = params["file_id"]
+            if file_id not in self.files:
+                return None
+            return {
+                "file_id": file_id,
+                "file_unique_id": f"u-{file_id}",
+                "file_size": len(self.files[file_id]),
+                "file_path": f"photos/{file_id}.jpg",
+            }
+        return True
+
+    async def _api(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = dict(await request.post())
+        with self._lock:
+            self.calls.append((method, params, time.perf_counter()))
+        with self._lock:
+            failing = self.failures.get(method, 0)
+            if failing:
+                self.failures[method] = failing - 1
+        if failing:
+            return web.json_response(
+                {"ok": False, "error_code": 400, "description": "Bad Request: chat not found"}
+            )
+        if self._sends_dead_file(method, params):
+            return web.json_response(
+                {"ok": False, "error_code": 400, "description": "Bad Request: wrong file identifier/HTTP URL specified"}
+            )
+        result = self._result(method, params)
+        if result is None:
+            return web.json_response(
+                {"ok": False, "error_code": 400, "description": "Bad Request: file not found"}
+            )
+        return web.json_response({"ok": True, "result": result})
+
+    async def _file(self, request: web.Request) -> web.Response:
+        name = request.match_info["path"].rsplit("/", 1)[-1].removesuffix(".jpg")
+        if name not in self.files:
+            raise web.HTTPNotFound()
+        return web.Response(body=self.files[name])
+
+    def start(self) -> "TelegramStub":
+        ready = threading.Event()
+
+        async def serve():
+            app = web.Application()
+            app.router.add_post("/bot{token}/{method}", self._api)
+            app.router.add_get("/file/bot{token}/{path:.+}", self._file)
+            self._runner = web.AppRunner(app)
+            await self._runner.setup()
+            site = web.TCPSite(self._runner, "127.0.0.1", 0)
+            await site.start()
+            port = site._server.sockets[0].getsockname()[1]
+            self.url = f"http://127.0.0.1:{port}"
+            ready.set()
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            self._loop.run_until_complete(serve())
+            self._loop.run_forever()
+            self._loop.run_until_complete(self._runner.cleanup())
+            self._loop.close()
+
+        self._thread = threading.Thread(target=run, name="telegram-stub", daemon=True)
+        self._thread.start()
+        ready.wait(10)
+        return self
+
+    def stop(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join(10)
+
+    def session(self) -> AiohttpSession:
+        """Сессия aiogram, которая ходит в заглушку (создавать внутри своего event loop)."""
+        return AiohttpSession(api=TelegramAPIServer.from_base(self.url))
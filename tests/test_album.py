@@ -0,0 +1,92 @@
+"""
+Альбом сохраняется в очереди пользователя: апдейт, пришедший после фото
+альбома, но до его сборки, видит альбом уже сохранённым.
+"""
+
+import asyncio
+
+import pytest
+
+import bot
+from tests.updates import message_update, photo_update
+
+
+@pytest.fixture
+def inspection(monkeypatch):
+    monkeypatch.setattr(bot.album_collector, "wait", 0.3)
+    monkeypatch.setattr(bot.panel_editor, "interval", 0)
+    user_id = 301
+    bot.db_register_user(user_id, "Аудитор")
+    inspection_id, _ = bot.db_create_inspection(1, user_id)
+    return user_id, inspection_id
+
+
+async def _start(user_id: int, inspection_id: int):
+    await bot.user_states.set(user_id, {
+        "mode": "inspection",
+        "inspection_id": inspection_id,
+        "department_id": 1,
+        "last_issue_id": None,
+        "last_issue_cleanup": [],
+        "panel_message_id": 1,
+        "issues_count": 0,
+    })
+
+
+async def _feed(*updates):
+    for update in updates:
+        await bot.dp.feed_raw_update(bot.bot, update)
+
+
+def _issues(inspection_id: int) -> list:
+    s = bot.get_session()
+    rows = s.query(bot.Issue).filter_by(inspection_id=inspection_id).order_by(bot.Issue.id).all()
+    s.close()
+    return rows
+
+
+def test_comment_sent_before_album_completes(inspection, run):
+    user_id, inspection_id = inspection
+
+    async def scenario():
+        await _start(user_id, inspection_id)
+        await _feed(
+            photo_update(user_id, "a1", media_group_id="g1"),
+            photo_update(user_id, "a2", media_group_id="g1"),
+            message_update(user_id, "Ценники не по планограмме"),
+        )
+        # таймер альбома срабатывает впустую: альбом уже сохранён
+        await asyncio.sleep(0.5)
+        await bot.issue_buffer.flush()
+        return await bot.user_states.get(user_id)
+
+    state = run(scenario())
+
+    issues = _issues(inspection_id)
+    assert [i.photo_url for i in issues] == ["a1", "a2"]
+    assert [i.comment for i in issues] == ["Ценники не по планограмме"] * 2
+    assert state["issues_count"] == 2
+    assert state["last_issue_id"] is None
+
+
+def test_single_photo_after_album_keeps_order_and_count(inspection, run):
+    user_id, inspection_id = inspection
+
+    async def scenario():
+        await _start(user_id, inspection_id)
+        await _feed(
+            photo_update(user_id, "b1", media_group_id="g2"),
+            photo_update(user_id, "b2", media_group_id="g2"),
+            photo_update(user_id, "b3"),
+        )
+        await asyncio.sleep(0.5)
+        await bot.issue_buffer.flush()
+        return await bot.user_states.get(user_id)
+
+    state = run(scenario())
+
+    assert [i.photo_url for i in _issues(inspection_id)] == ["b1", "b2", "b3"]
+    assert state["issues_count"] == 3
+    # ждём комментарий к одиночному фото, а не к альбому
+    assert state["last_issue_id"] == _issues(inspection_id)[-1].id
+    assert "last_issue_ids" not in state
@@ -0,0 +1,72 @@
+"""
+Коллаж «ДО / ПОСЛЕ»: фото скачиваются через локальную заглушку Bot API
+(getFile и /file/bot<token>/...), рисуются в пуле процессов, готовый
+file_id запоминается и повторно не рисуется.
+"""
+
+import asyncio
+import sys
+from io import BytesIO
+
+from aiogram import types
+from PIL import Image
+
+import bot
+
+
+def _jpeg(width: int, height: int, color: str) -> bytes:
+    out = BytesIO()
+    Image.new("RGB", (width, height), color).save(out, "JPEG")
+    return out.getvalue()
+
+
+def _photo_message(file_id: str) -> types.Message:
+    return types.Message.model_validate({
+        "message_id": 1,
+        "date": 0,
+        "chat": {"id": 1, "type": "private"},
+        "photo": [{"file_id": file_id, "file_unique_id": f"u-{file_id}", "width": 10, "height": 10}],
+    })
+
+
+def test_collage_downloads_through_bot_api_and_is_cached(monkeypatch, run, telegram):
+    monkeypatch.setitem(telegram.files, "collage-before", _jpeg(400, 300, "red"))
+    monkeypatch.setitem(telegram.files, "collage-after", _jpeg(300, 300, "green"))
+    renderer = bot.CollageRenderer(2, 8, bot.COLLAGE_FONT)
+    downloads = len(telegram.called("getFile"))
+
+    async def scenario():
+        # два админа одновременно — одна отрисовка
+        first, second = await asyncio.gather(*(
+            renderer.collage(7, "u-after", "collage-before", "collage-after", "Замечание #7")
+            for _ in range(2)
+        ))
+        renderer.remember(7, "u-after", _photo_message("collage-file-id"))
+        cached = await renderer.collage(7, "u-after", "collage-before", "collage-after", "Замечание #7")
+        return first, second, cached
+
+    try:
+        first, second, cached = run(scenario())
+    finally:
+        renderer.shutdown()
+
+    assert len(telegram.called("getFile")) == downloads + 2
+    image = Image.open(BytesIO(first.data))
+    assert image.format == "JPEG"
+    # 720 по высоте на каждое фото: 960 + 12 + 720, плюс шапка 64
+    assert image.size == (960 + 12 + 720, 64 + 720)
+    assert second.data == first.data
+    assert cached == "collage-file-id"
+    assert (renderer.rendered, renderer.cache_hits) == (1, 1)
+
+
+def test_collage_worker_does_not_import_bot(monkeypatch):
+    # как при запуске python bot.py: главный модуль — бот
+    monkeypatch.setitem(sys.modules, "__main__", bot)
+    pool = bot.ProcessPoolExecutor(1, mp_context=bot.multiprocessing.get_context("spawn"))
+    try:
+        with bot.collage_as_main():
+            loaded = pool.submit(eval, "sorted(__import__('sys').modules.keys() & {'bot', 'aiogram', 'sqlalchemy'})")
+        assert loaded.result(timeout=60) == []
+    finally:
+        pool.shutdown()
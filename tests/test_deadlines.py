@@ -0,0 +1,62 @@
+"""Напоминания о просроченных замечаниях: возвращённое в работу замечание снова ждёт напоминания."""
+
+from datetime import date, datetime, timedelta
+
+import pytest
+
+import bot
+
+
+def _overdue_issue() -> int:
+    s = bot.get_session()
+    user = bot.User(tg_id=7001, name="Аудитор")
+    s.add(user)
+    s.flush()
+    department_id = next(iter(bot.department_registry._names))
+    inspection = bot.Inspection(
+        department_id=department_id,
+        inspector_id=user.id,
+        date=date.today() - timedelta(days=bot.FIX_DEADLINE_DAYS + 5),
+    )
+    s.add(inspection)
+    s.commit()
+    issue_id = 900_001
+    record = {
+        "id": issue_id,
+        "inspection_id": inspection.id,
+        "department_id": department_id,
+        "photo_url": "deadline-photo",
+        "comment": "Просрочено",
+        "created_at": datetime.utcnow().isoformat(),
+    }
+    s.close()
+    bot.db_insert_issues([record])
+    return issue_id
+
+
+@pytest.fixture
+def own_outbox():
+    """Уведомления теста удаляются, чтобы не уйти в чужих тестах."""
+    s = bot.get_session()
+    before = {row.id for row in s.query(bot.OutboxMessage.id)}
+    s.close()
+    yield
+    s = bot.get_session()
+    s.query(bot.OutboxMessage).filter(bot.OutboxMessage.id.not_in(before)).delete()
+    s.commit()
+    s.close()
+
+
+def test_returned_issue_is_reminded_again(own_outbox):
+    issue_id = _overdue_issue()
+    assert [i for i, _ in bot.db_issue_deadlines([issue_id])] == [issue_id]
+
+    assert bot.db_remind_overdue([issue_id]) == 1
+    assert bot.db_issue_deadlines([issue_id]) == []
+
+    assert bot.db_submit_fix(issue_id, "fixed-photo", 7001, "Мастер", "Исправлено")
+    assert bot.db_return_issue(issue_id)
+
+    # снова в сроках и снова напоминается
+    assert [i for i, _ in bot.db_issue_deadlines([issue_id])] == [issue_id]
+    assert bot.db_remind_overdue([issue_id]) == 1
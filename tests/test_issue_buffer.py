@@ -0,0 +1,88 @@
+"""
+Буфер замечаний (IssueBuffer): после падения recover() дописывает в БД всё,
+что осталось в журналах, — ровно по одному разу и с последним комментарием.
+"""
+
+import json
+from datetime import datetime
+
+import bot
+
+
+def _inspection() -> tuple[int, int]:
+    s = bot.get_session()
+    user = bot.User(tg_id=7101, name="Аудитор")
+    s.add(user)
+    s.flush()
+    department_id = next(iter(bot.department_registry._names))
+    inspection = bot.Inspection(department_id=department_id, inspector_id=user.id)
+    s.add(inspection)
+    s.commit()
+    ids = inspection.id, department_id
+    s.close()
+    return ids
+
+
+def _add(issue_id: int, inspection_id: int, department_id: int) -> dict:
+    return {
+        "op": "add",
+        "id": issue_id,
+        "inspection_id": inspection_id,
+        "department_id": department_id,
+        "photo_url": f"journal-photo-{issue_id}",
+        "comment": None,
+        "created_at": datetime.utcnow().isoformat(),
+    }
+
+
+def _write(path, entries: list[dict], tail: str = ""):
+    path.write_text("".join(json.dumps(e, ensure_ascii=False) + "\n" for e in entries) + tail, encoding="utf-8")
+
+
+def _issues(issue_ids: list[int]) -> dict[int, str | None]:
+    s = bot.get_session()
+    rows = s.query(bot.Issue.id, bot.Issue.comment).filter(bot.Issue.id.in_(issue_ids)).all()
+    s.close()
+    return dict(rows)
+
+
+def test_recover_replays_flushing_and_live_journal_once(tmp_path):
+    inspection_id, department_id = _inspection()
+    journal = tmp_path / "issues.journal"
+    flushing = tmp_path / "issues.journal.flushing"
+    # упали посреди flush: пачка в *.flushing, а в живом журнале — новое
+    # замечание и комментарии, пришедшие уже после переименования
+    _write(flushing, [_add(800_001, inspection_id, department_id)])
+    _write(
+        journal,
+        [
+            _add(800_002, inspection_id, department_id),
+            {"op": "comment", "id": 800_001, "comment": "Трещина в стене"},
+            {"op": "comment", "id": 800_002, "comment": "Нет таблички"},
+        ],
+        tail='{"op": "comment", "id": 800_0',  # недописанная строка
+    )
+    buffer = bot.IssueBuffer(str(journal), 100, 60, 10)
+
+    assert buffer.recover() == 2
+    assert _issues([800_001, 800_002]) == {800_001: "Трещина в стене", 800_002: "Нет таблички"}
+    assert not journal.exists() and not flushing.exists()
+
+    assert buffer.recover() == 0
+    assert len(_issues([800_001, 800_002])) == 2
+    assert bot.db_verify_stats() == []
+
+
+def test_startup_recovers_worker_journals(monkeypatch, tmp_path):
+    base = str(tmp_path / "issues.journal")
+    for suffix in ("", ".1", ".0.flushing", ".flushing", ".0"):
+        (tmp_path / f"issues.journal{suffix}").write_text("")
+    monkeypatch.setattr(bot, "ISSUE_JOURNAL", base)
+
+    assert bot.issue_journals() == [
+        base + ".flushing",
+        base,
+        base + ".0.flushing",
+        base + ".0",
+        base + ".1",
+    ]
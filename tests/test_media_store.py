@@ -0,0 +1,66 @@
+"""
+Локальное хранилище фото (MEDIA_DIR): альбом, который Telegram не принял
+из-за file_id, повторяется с копиями с диска, а новые file_id запоминаются.
+"""
+
+from io import BytesIO
+
+from PIL import Image
+
+import bot
+
+
+def _jpeg(color: str) -> bytes:
+    out = BytesIO()
+    Image.new("RGB", (64, 48), color).save(out, "JPEG")
+    return out.getvalue()
+
+
+def _album_media(params: dict) -> list[str]:
+    return [m["media"] for m in bot.json.loads(params["media"])]
+
+
+def test_album_falls_back_to_local_copies(monkeypatch, tmp_path, run, telegram):
+    store = bot.MediaStore(str(tmp_path), 10 * 1024 * 1024)
+    monkeypatch.setattr(bot, "media_store", store)
+    monkeypatch.setitem(telegram.files, "album-a", _jpeg("red"))
+    monkeypatch.setitem(telegram.files, "album-b", _jpeg("blue"))
+    photos = [("album-a", "#1"), ("album-b", "#2")]
+
+    async def scenario():
+        for file_id in ("album-a", "album-b"):
+            await store._fetch(file_id, f"u-{file_id}")
+        stored = await store.read("album-b")
+        # album-a Telegram больше не принимает (например, другой бот)
+        monkeypatch.setattr(telegram, "dead_files", {"album-a", "album-gone"})
+        sent = len(telegram.called("sendMediaGroup"))
+        failed = await store.send_album(1, photos)
+        from_disk = telegram.called("sendMediaGroup")[sent:]
+
+        sent = len(telegram.called("sendMediaGroup"))
+        failed_again = await store.send_album(1, photos)
+        again = telegram.called("sendMediaGroup")[sent:]
+
+        # чужое фото без локальной копии — по одному, остальные уходят
+        sent_photos = len(telegram.called("sendPhoto"))
+        unavailable = await store.send_album(1, [("album-b", "#2"), ("album-gone", "#3")])
+        single = telegram.called("sendPhoto")[sent_photos:]
+        return stored, failed, from_disk, failed_again, again, unavailable, single
+
+    stored, failed, from_disk, failed_again, again, unavailable, single = run(scenario())
+
+    assert stored == telegram.files["album-b"]
+    assert failed == set()
+    assert len(from_disk) == 2
+    assert _album_media(from_disk[0]) == ["album-a", "album-b"]
+    # какой file_id не принят, неизвестно — с диска идут все сохранённые фото
+    assert all(m.startswith("attach://") for m in _album_media(from_disk[1]))
+    assert store.uploads == 2
+
+    # загруженное с диска фото уходит по новому file_id с первой попытки
+    assert failed_again == set()
+    assert len(again) == 1
+    assert all(m.startswith("sent-") for m in _album_media(again[0]))
+
+    assert unavailable == {"album-gone"}
+    assert [p["photo"].startswith("sent-") for p in single] == [True, False]
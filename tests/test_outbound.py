@@ -0,0 +1,83 @@
+"""
+Планировщик исходящих (OutboundScheduler): повтор после TelegramRetryAfter
+и отказ после retries повторов, очерёдность внутри чата и параллельность
+между чатами. Вместо сети — поддельный make_request.
+"""
+
+import asyncio
+import time
+
+import pytest
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import SendMessage
+
+import bot
+
+
+def _scheduler(retries: int = 3) -> bot.OutboundScheduler:
+    # лимиты с запасом — меряется только повтор и очерёдность
+    return bot.OutboundScheduler(global_rate=1000, chat_rate=1000, group_rate=1000, retries=retries)
+
+
+def test_retry_after_waits_and_repeats():
+    scheduler = _scheduler()
+    calls = []
+
+    async def make_request(_bot, method):
+        calls.append(time.monotonic())
+        if len(calls) == 1:
+            raise TelegramRetryAfter(method, "Too Many Requests: retry after 1", 1)
+        return "ok"
+
+    started = time.monotonic()
+    result = asyncio.run(scheduler(make_request, None, SendMessage(chat_id=1, text="привет")))
+
+    assert result == "ok"
+    assert len(calls) == 2
+    assert calls[1] - started >= 1
+    assert (scheduler.sent, scheduler.retried, scheduler.waiting) == (1, 1, 0)
+
+
+def test_retry_after_gives_up_after_retries():
+    scheduler = _scheduler(retries=2)
+    calls = 0
+
+    async def make_request(_bot, method):
+        nonlocal calls
+        calls += 1
+        raise TelegramRetryAfter(method, "Too Many Requests: retry after 0", 0)
+
+    with pytest.raises(TelegramRetryAfter):
+        asyncio.run(scheduler(make_request, None, SendMessage(chat_id=1, text="привет")))
+
+    assert calls == 3
+    assert (scheduler.sent, scheduler.retried, scheduler.waiting) == (0, 2, 0)
+
+
+def test_one_chat_in_order_different_chats_in_parallel():
+    scheduler = _scheduler()
+    delay = 0.1
+    spans: dict[int, list[tuple[str, float, float]]] = {1: [], -100: []}
+
+    async def make_request(_bot, method):
+        started = time.monotonic()
+        await asyncio.sleep(delay)
+        spans[method.chat_id].append((method.text, started, time.monotonic()))
+        return method.text
+
+    async def scenario():
+        sends = [SendMessage(chat_id=chat_id, text=f"{chat_id}:{i}") for i in range(3) for chat_id in spans]
+        started = time.monotonic()
+        results = await asyncio.gather(*(scheduler(make_request, None, m) for m in sends))
+        return results, time.monotonic() - started
+
+    results, elapsed = asyncio.run(scenario())
+
+    assert results == [m for i in range(3) for m in (f"1:{i}", f"-100:{i}")]
+    for chat_id, chat_spans in spans.items():
+        assert [text for text, _, _ in chat_spans] == [f"{chat_id}:{i}" for i in range(3)]
+        # следующий запрос в чат — только после ответа на предыдущий
+        for (_, _, prev_end), (_, start, _) in zip(chat_spans, chat_spans[1:]):
+            assert start >= prev_end
+    # по очереди было бы 6 * delay, два чата параллельно — 3 * delay
+    assert elapsed < 4.5 * delay
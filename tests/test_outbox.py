@@ -0,0 +1,90 @@
+"""
+Outbox: доставка «хотя бы один раз» — неудачная отправка повторяется после
+паузы (backoff), строка с истёкшей арендой забирается снова, доставленная
+больше не отправляется. Время «проходит» сдвигом next_attempt_at назад.
+"""
+
+from datetime import datetime, timedelta
+
+from sqlalchemy import update
+
+import bot
+
+CHAT = 8801
+
+
+def _enqueue(issue_id: int) -> int:
+    s = bot.get_session()
+    bot.enqueue_outbox(s, "fix_returned", CHAT, {"issue_id": issue_id, "dept_name": "Стройка", "comment": "Трещина"})
+    s.commit()
+    outbox_id = s.query(bot.OutboxMessage.id).order_by(bot.OutboxMessage.id.desc()).first()[0]
+    s.close()
+    return outbox_id
+
+
+def _row(outbox_id: int):
+    s = bot.get_session()
+    row = s.get(bot.OutboxMessage, outbox_id)
+    s.close()
+    return row
+
+
+def _pass_time(outbox_id: int, seconds: int):
+    with bot.engine.begin() as conn:
+        conn.execute(
+            update(bot.OutboxMessage)
+            .where(bot.OutboxMessage.id == outbox_id)
+            .values(next_attempt_at=bot.OutboxMessage.next_attempt_at - timedelta(seconds=seconds))
+        )
+
+
+def _sent_to_chat(telegram) -> list[str]:
+    # заглушка записывает и неудачные вызовы — это попытки доставки
+    return [p["text"] for p in telegram.called("sendMessage") if p["chat_id"] == str(CHAT)]
+
+
+def test_failed_send_is_retried_after_backoff_and_not_resent(monkeypatch, run, telegram):
+    worker = bot.OutboxWorker(batch_size=50, poll_interval=60)
+    outbox_id = _enqueue(501)
+    monkeypatch.setitem(telegram.failures, "sendMessage", 1)
+
+    started = datetime.utcnow()
+    run(worker.run_once())
+    row = _row(outbox_id)
+    assert row.attempts == 1
+    # первая пауза — 5 * 2 ** attempts секунд
+    assert started + timedelta(seconds=9) < row.next_attempt_at < datetime.utcnow() + timedelta(seconds=11)
+    assert worker.failed == 1
+    assert len(_sent_to_chat(telegram)) == 1
+
+    # пауза ещё не прошла — уведомление не трогаем
+    run(worker.run_once())
+    assert len(_sent_to_chat(telegram)) == 1
+    assert _row(outbox_id).attempts == 1
+
+    _pass_time(outbox_id, 10)
+    run(worker.run_once())
+    assert _row(outbox_id) is None
+    assert len(_sent_to_chat(telegram)) == 2
+    assert worker.delivered >= 1
+
+    # доставленное повторно не уходит
+    run(worker.run_once())
+    assert len(_sent_to_chat(telegram)) == 2
+
+
+def test_expired_lease_is_claimed_again():
+    outbox_id = _enqueue(502)
+
+    first = [row.id for row in bot.db_claim_outbox(50, 60)]
+    assert outbox_id in first
+    # пока аренда действует, второй обработчик строку не видит
+    assert outbox_id not in [row.id for row in bot.db_claim_outbox(50, 60)]
+
+    # первый обработчик упал, не отчитавшись; аренда истекла
+    _pass_time(outbox_id, 61)
+    again = [row for row in bot.db_claim_outbox(50, 60) if row.id == outbox_id]
+    assert len(again) == 1 and again[0].attempts == 0
+
+    bot.db_finish_outbox([outbox_id], [])
+    assert _row(outbox_id) is None
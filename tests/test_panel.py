@@ -0,0 +1,50 @@
+"""PanelEditor: серия обновлений панели сворачивается в правки, последний текст не теряется."""
+
+import asyncio
+import time
+
+import bot
+
+
+def _editor(monkeypatch, interval: float, edit_time: float):
+    editor = bot.PanelEditor(interval)
+    edits = []
+
+    async def slow_edit(key, text):
+        editor._last_edit[key] = time.monotonic()
+        edits.append(text)
+        # правка ждёт очередь чата и ведро токенов
+        await asyncio.sleep(edit_time)
+
+    monkeypatch.setattr(editor, "_edit", slow_edit)
+    return editor, edits
+
+
+def test_update_during_edit_is_not_lost(monkeypatch):
+    editor, edits = _editor(monkeypatch, interval=0, edit_time=0.1)
+
+    async def scenario():
+        editor.update(1, 10, "count=1")
+        await asyncio.sleep(0.05)
+        editor.update(1, 10, "count=2")
+        await asyncio.sleep(0.3)
+
+    asyncio.run(scenario())
+
+    assert edits == ["count=1", "count=2"]
+    assert not editor._tasks and not editor._texts
+
+
+def test_burst_collapses_to_last_text(monkeypatch):
+    editor, edits = _editor(monkeypatch, interval=0.2, edit_time=0)
+
+    async def scenario():
+        editor.update(1, 10, "count=1")
+        await asyncio.sleep(0.01)
+        for i in range(2, 6):
+            editor.update(1, 10, f"count={i}")
+        await asyncio.sleep(0.4)
+
+    asyncio.run(scenario())
+
+    assert edits == ["count=1", "count=5"]
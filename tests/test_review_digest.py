@@ -0,0 +1,78 @@
+"""Сводка исправлений для админа доставляется, даже если часть фото недоступна."""
+
+import json
+
+import pytest
+
+import bot
+
+ADMIN = 5001
+
+
+def _payload(issue_id: int, before, after) -> dict:
+    return {
+        "issue_id": issue_id,
+        "dept_name": "Стройка",
+        "original_photo_id": before,
+        "original_comment": f"Замечание {issue_id}",
+        "fixed_photo_id": after,
+        "fixed_photo_unique_id": None,
+        "fixer_name": "Мастер",
+        "fix_comment": "Исправлено",
+    }
+
+
+def _digests() -> int:
+    s = bot.get_session()
+    count = s.query(bot.ReviewDigest).count()
+    s.close()
+    return count
+
+
+@pytest.fixture
+def dead_photo(telegram):
+    telegram.dead_files.add("dead")
+    yield
+    telegram.dead_files.discard("dead")
+
+
+def test_dead_and_missing_photos_do_not_block_digest(dead_photo, run, telegram):
+    digests = _digests()
+    payloads = [_payload(1001, "ok-1", "dead"), _payload(1002, None, "ok-2")]
+
+    run(bot.deliver_review_digest(ADMIN, payloads))
+
+    # альбом с битым фото не ушёл — фото отправлены по одному
+    sent_photos = [p["photo"] for p in telegram.called("sendPhoto") if int(p["chat_id"]) == ADMIN]
+    assert "ok-1" in sent_photos and "ok-2" in sent_photos
+    for media in telegram.called("sendMediaGroup"):
+        assert all(m["media"] for m in json.loads(media["media"]))
+
+    text = [p for p in telegram.called("sendMessage") if int(p["chat_id"]) == ADMIN][-1]["text"]
+    assert "#1001" in text and "(фото недоступно)" in text.split("#1002")[0]
+    assert "(фото недоступно)" not in text.split("#1002")[1]
+    assert _digests() == digests + 1
+
+
+def test_failed_delivery_leaves_no_digest(monkeypatch, run):
+    digests = _digests()
+
+    async def fail(*args, **kwargs):
+        raise RuntimeError("Telegram недоступен")
+
+    monkeypatch.setattr(bot.bot, "send_message", fail)
+    with pytest.raises(RuntimeError):
+        run(bot.deliver_review_digest(ADMIN, [_payload(1003, "ok-3", "ok-4")]))
+
+    assert _digests() == digests
+
+
+def test_drop_digest_buttons_keeps_other_issues_and_accept_all():
+    markup = bot.review_digest_kb(17, [7, 17])
+
+    left = bot.drop_digest_buttons(markup, 17)
+    assert [[b.text for b in row] for row in left.inline_keyboard] == [
+        ["✅ Принять все (2)"],
+        ["✅ #7", "↩️ #7"],
+    ]
+    assert bot.drop_digest_buttons(left, 7) is None
@@ -0,0 +1,56 @@
+"""
+Запросы к БД идут через run_db в пуле потоков, поэтому медленный запрос
+одного пользователя не задерживает апдейты других.
+"""
+
+import asyncio
+import time
+
+import bot
+from tests.updates import message_update
+
+# «медленный коммит SQLite»: блокирующая пауза внутри функции работы с БД
+DB_DELAY = 0.3
+
+
+def _slow_history_stats(monkeypatch):
+    original = bot.db_history_stats
+
+    def slow(*args):
+        time.sleep(DB_DELAY)
+        return original(*args)
+
+    monkeypatch.setattr(bot, "db_history_stats", slow)
+
+
+async def _feed_concurrently(updates: list[dict]) -> float:
+    started = time.perf_counter()
+    await asyncio.gather(*(bot.dp.feed_raw_update(bot.bot, u) for u in updates))
+    return time.perf_counter() - started
+
+
+def test_updates_of_different_users_overlap(monkeypatch, run, telegram):
+    _slow_history_stats(monkeypatch)
+    monkeypatch.setattr(bot, "ADMIN_IDS", {101, 102})
+    sent = len(telegram.called("sendMessage"))
+
+    elapsed = run(_feed_concurrently([
+        message_update(101, "ИСТОРИЯ ОБХОДОВ"),
+        message_update(102, "ИСТОРИЯ ОБХОДОВ"),
+    ]))
+
+    assert len(telegram.called("sendMessage")) == sent + 2
+    # последовательно было бы 2 * DB_DELAY
+    assert elapsed < 1.5 * DB_DELAY
+
+
+def test_updates_of_one_user_stay_ordered(monkeypatch, run, telegram):
+    _slow_history_stats(monkeypatch)
+    monkeypatch.setattr(bot, "ADMIN_IDS", {101})
+
+    elapsed = run(_feed_concurrently([
+        message_update(101, "ИСТОРИЯ ОБХОДОВ"),
+        message_update(101, "ИСТОРИЯ ОБХОДОВ"),
+    ]))
+
+    assert elapsed >= 2 * DB_DELAY
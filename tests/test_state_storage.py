@@ -0,0 +1,86 @@
+"""Хранилища состояний диалога: память (TTL + LRU), таблица SQLite и Redis (fakeredis)."""
+
+import asyncio
+
+import fakeredis
+import pytest
+
+import bot
+
+
+def test_memory_storage_ttl_and_lru_eviction():
+    async def scenario():
+        storage = bot.MemoryStateStorage(ttl=60, max_size=2)
+        await storage.set(1, {"mode": "inspection"})
+        await storage.set(2, {"mode": "fix"})
+        assert await storage.get(1) == {"mode": "inspection"}
+        # 1 только что читали — вытесняется 2
+        await storage.set(3, {"mode": None})
+        assert await storage.get(2) is None
+        assert await storage.size() == 2
+        assert storage.evictions == 1
+
+        # короткий TTL: 4 истекает при чтении, 5 — при sweep
+        storage.ttl = 0.05
+        await storage.set(4, {"mode": "fix"})
+        await storage.set(5, {"mode": "fix"})
+        await asyncio.sleep(0.1)
+        assert await storage.get(4) is None
+        await storage.sweep()
+        return await storage.size(), storage.evictions, await storage.status_lines()
+
+    size, evictions, status = asyncio.run(scenario())
+    # 2, 1 и 3 — по LRU, 4 и 5 — по TTL
+    assert (size, evictions) == (0, 5)
+    assert status == ["Состояния пользователей (memory): 0, вытеснено 5"]
+
+
+def test_sqlite_storage_survives_new_instance():
+    async def scenario():
+        await bot.SQLiteStateStorage(ttl=60).set(9001, {"mode": "fix", "issue_ids": [5, 6]})
+        reopened = bot.SQLiteStateStorage(ttl=60)
+        state = await reopened.get(9001)
+        await reopened.pop(9001)
+        return state, await reopened.get(9001)
+
+    assert asyncio.run(scenario()) == ({"mode": "fix", "issue_ids": [5, 6]}, None)
+
+
+def test_sqlite_storage_evicts_expired_state():
+    async def scenario():
+        storage = bot.SQLiteStateStorage(ttl=0)
+        await storage.set(9002, {"mode": "inspection"})
+        await asyncio.sleep(0.01)
+        await storage.sweep()
+        return await storage.get(9002), storage.evictions
+
+    assert asyncio.run(scenario()) == (None, 1)
+
+
+@pytest.fixture
+def fake_redis(monkeypatch):
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(
+        "redis.asyncio.from_url",
+        lambda url, **kwargs: fakeredis.FakeAsyncRedis(server=server, **kwargs),
+    )
+    return server
+
+
+def test_redis_storage_round_trip(fake_redis):
+    async def scenario():
+        storage = bot.RedisStateStorage(ttl=120, url="redis://stub")
+        await storage.set(1, {"mode": "inspection", "dept_id": 3})
+        await storage.set(2, {"mode": "fix"})
+        got = await storage.get(1)
+        ttl = await storage._redis.ttl(f"{storage.PREFIX}1")
+        size = await storage.size()
+        await storage.pop(1)
+        return got, ttl, size, await storage.get(1), await storage.size(), await storage.status_lines()
+
+    got, ttl, size, popped, size_after, status = asyncio.run(scenario())
+    assert got == {"mode": "inspection", "dept_id": 3}
+    assert 0 < ttl <= 120
+    assert (size, popped, size_after) == (2, None, 1)
+    # ключи истекают на сервере — бот не выдумывает 0 вытеснений
+    assert status == ["Состояния пользователей (redis): 1, вытеснено неизвестно"]
@@ -0,0 +1,57 @@
+"""
+Очередь апдейтов пользователя (UpdateSerializer): сверх max_depth апдейт
+отбрасывается и пользователю об этом говорят; время ожидания копится для /status.
+"""
+
+import asyncio
+
+from aiogram import Dispatcher
+
+import bot
+from tests.updates import callback_update, message_update
+
+HANDLER_DELAY = 0.2
+
+
+def _dispatcher(serializer: bot.UpdateSerializer) -> Dispatcher:
+    dp = Dispatcher()
+    dp.update.outer_middleware(serializer)
+
+    @dp.message()
+    async def slow(message):
+        await asyncio.sleep(HANDLER_DELAY)
+
+    @dp.callback_query()
+    async def slow_callback(callback):
+        await asyncio.sleep(HANDLER_DELAY)
+
+    return dp
+
+
+def test_overflow_is_dropped_with_notice_and_waits_are_measured(run, telegram):
+    serializer = bot.UpdateSerializer(concurrency=4, max_depth=2)
+    dp = _dispatcher(serializer)
+    notices = len(telegram.called("sendMessage"))
+    answers = len(telegram.called("answerCallbackQuery"))
+
+    async def scenario():
+        updates = [message_update(301, f"замечание {i}") for i in range(4)]
+        updates.append(callback_update(301, "fix_dept:1"))
+        updates.append(message_update(302, "другой пользователь"))
+        await asyncio.gather(*(dp.feed_raw_update(bot.bot, u) for u in updates))
+
+    run(scenario())
+
+    # у 301 в очереди двое, остальные трое — отброшены; 302 не затронут
+    assert serializer.dropped == 3
+    assert serializer.handled == 3
+    sent = telegram.called("sendMessage")[notices:]
+    assert [(p["chat_id"], p["text"]) for p in sent] == [("301", serializer.DROPPED_TEXT)]
+    answered = telegram.called("answerCallbackQuery")[answers:]
+    assert [p["text"] for p in answered] == [serializer.DROPPED_TEXT]
+
+    # второй апдейт 301 ждал, пока обработается первый
+    assert serializer.max_wait >= HANDLER_DELAY * 0.9
+    counters, waits = serializer.status_lines()
+    assert "обработано 3" in counters and "отброшено 3" in counters
+    assert waits.startswith("Ожидание в очереди: среднее")
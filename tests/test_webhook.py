@@ -0,0 +1,66 @@
+"""
+Режим webhook: записанные апдейты отправляются POST-запросом в приложение
+build_webhook_app, как это делает Telegram. Проверяются секретный токен,
+мгновенный 200 OK и время от запроса до ответа хэндлера (sendMessage).
+"""
+
+import asyncio
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from aiohttp.test_utils import TestClient, TestServer
+
+import bot
+
+SECRET = "test-secret"
+PATH = "/webhook"
+
+with open(os.path.join(os.path.dirname(__file__), "data", "webhook_updates.json"), encoding="utf-8") as f:
+    RECORDED_UPDATES = json.load(f)
+
+
+async def _wait_sent(telegram, count: int, timeout: float = 5):
+    deadline = time.monotonic() + timeout
+    while len(telegram.calls_of("sendMessage")) < count and time.monotonic() < deadline:
+        await asyncio.sleep(0.005)
+    return telegram.calls_of("sendMessage")
+
+
+async def _webhook_scenario(telegram) -> list[float]:
+    async with TestClient(TestServer(bot.build_webhook_app(PATH, None))) as client:
+        resp = await client.post(PATH, json=RECORDED_UPDATES[0])
+        assert resp.status == 401
+
+        latencies = []
+        for update in RECORDED_UPDATES:
+            before = len(telegram.calls_of("sendMessage"))
+            started = time.perf_counter()
+            resp = await client.post(
+                PATH, json=update, headers={"X-Telegram-Bot-Api-Secret-Token": SECRET}
+            )
+            assert resp.status == 200
+            sent = await _wait_sent(telegram, before + 1)
+            assert len(sent) > before, f"хэндлер не ответил на апдейт {update['update_id']}"
+            latencies.append(sent[before][1] - started)
+        return latencies
+
+
+def test_webhook_recorded_updates(monkeypatch, run, telegram):
+    monkeypatch.setattr(bot, "WEBHOOK_SECRET", SECRET)
+    # приложение при остановке закрывает пул БД — даём ему свой
+    monkeypatch.setattr(bot, "db_executor", ThreadPoolExecutor(max_workers=2))
+    rejected = len(telegram.calls_of("sendMessage"))
+
+    latencies = run(_webhook_scenario(telegram))
+
+    # апдейт без секрета не дошёл до хэндлеров: ответов ровно по числу записанных
+    assert len(telegram.calls_of("sendMessage")) == rejected + len(RECORDED_UPDATES)
+    latencies.sort()
+    print(
+        f"\nwebhook: {len(latencies)} апдейтов, задержка до ответа хэндлера "
+        f"медиана {latencies[len(latencies) // 2] * 1000:.1f} мс, "
+        f"максимум {latencies[-1] * 1000:.1f} мс"
+    )
+    assert latencies[-1] < 2
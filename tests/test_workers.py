@@ -0,0 +1,36 @@
+"""Раскладка апдейтов по процессам-обработчикам (--workers)."""
+
+from aiogram.types import Update
+
+import bot
+from tests.updates import callback_update, message_update
+
+
+def _as_polled(raw: dict) -> dict:
+    # так апдейт из get_updates уходит обработчику (poll_to_workers)
+    return bot.update_to_raw(Update.model_validate(raw))
+
+
+def test_shard_key_is_author_for_messages_and_callbacks():
+    assert bot.update_shard_key(message_update(777, "СДЕЛАТЬ ОБХОД")) == 777
+    assert bot.update_shard_key(callback_update(777, "fix:5")) == 777
+
+
+def test_shard_key_survives_polling_dump():
+    for raw in (message_update(777, "текст"), callback_update(777, "fix_dept:1")):
+        assert bot.update_shard_key(_as_polled(raw)) == 777
+
+
+def test_one_user_always_goes_to_one_worker():
+    queues = [_Queue() for _ in range(4)]
+    for raw in (message_update(777, "СДЕЛАТЬ ОБХОД"), callback_update(777, "ins_dept:1"), message_update(777, "текст")):
+        bot.route_update(_as_polled(raw), queues)
+    assert sorted(len(q.items) for q in queues) == [0, 0, 0, 3]
+
+
+class _Queue:
+    def __init__(self):
+        self.items = []
+
+    def put(self, item):
+        self.items.append(item)
@@ -0,0 +1,59 @@
+"""Апдейты Telegram в том виде, в каком их присылает Bot API."""
+
+import itertools
+import time
+
+_update_ids = itertools.count(1000)
+
+
+def _user(user_id: int) -> dict:
+    return {"id": user_id, "is_bot": False, "first_name": f"user{user_id}", "language_code": "ru"}
+
+
+def message_update(user_id: int, text: str) -> dict:
+    update_id = next(_update_ids)
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "from": _user(user_id),
+            "chat": {"id": user_id, "type": "private", "first_name": f"user{user_id}"},
+            "date": int(time.time()),
+            "text": text,
+        },
+    }
+
+
+def callback_update(user_id: int, data: str) -> dict:
+    update_id = next(_update_ids)
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": _user(user_id),
+            "message": {
+                "message_id": 1,
+                "from": {"id": 123456, "is_bot": True, "first_name": "stub"},
+                "chat": {"id": user_id, "type": "private", "first_name": f"user{user_id}"},
+                "date": int(time.time()),
+                "text": "Выбери отдел",
+            },
+            "chat_instance": "1",
+            "data": data,
+        },
+    }
+
+
+def photo_update(user_id: int, file_id: str, caption: str | None = None, media_group_id: str | None = None) -> dict:
+    update = message_update(user_id, "")
+    message = update["message"]
+    del message["text"]
+    message["photo"] = [
+        {"file_id": f"{file_id}-s", "file_unique_id": f"u-{file_id}-s", "width": 90, "height": 67},
+        {"file_id": file_id, "file_unique_id": f"u-{file_id}", "width": 1280, "height": 960},
+    ]
+    if caption:
+        message["caption"] = caption
+    if media_group_id:
+        message["media_group_id"] = media_group_id
+    return update